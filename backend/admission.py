@@ -0,0 +1,244 @@
+"""
+Admission control for /generate-prompt.
+
+Under a traffic spike every gunicorn thread blocks on upstream calls and new
+requests sit in the socket backlog until the client gives up. The controller
+lets at most ADMISSION_MAX_CONCURRENT requests run the pipeline at once and
+queues up to ADMISSION_MAX_QUEUE more. A full queue is rejected right away
+with 429 and a Retry-After estimate. Queued requests normally wait up to
+ADMISSION_MAX_WAIT seconds, but when queueing delay has stayed above
+ADMISSION_TARGET_DELAY_MS for a whole ADMISSION_INTERVAL (CoDel's signal
+for a standing queue rather than a burst), they are only given the target
+delay before being shed. Queue depth, admissions and rejections are exported
+on /metrics.
+
+Under gunicorn a queued request still holds one of GUNICORN_THREADS threads,
+and requests past the thread count wait in the socket backlog where the
+controller never sees them. So the server needs threads >= max_concurrent +
+max_queue, plus a few for the other routes. Without explicit limits the
+controller takes a quarter of the threads as slots, keeps an eighth free and
+queues on the rest (see thread_limits).
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from metrics import Counter, Gauge
+
+REJECT_REASONS = ("queue_full", "timeout")
+
+
+def thread_limits(threads):
+    """(max_concurrent, max_queue) that fit in a pool of threads server threads."""
+    # Kept free for /stats, /metrics, /jobs and the other routes
+    reserved = max(1, threads // 8)
+    max_concurrent = max(1, threads // 4)
+    return max_concurrent, max(0, threads - reserved - max_concurrent)
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Server is busy ({reason.replace('_', ' ')}), retry in {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, notify):
+        self.enqueued = time.monotonic()
+        self.notify = notify
+        self.granted = False
+
+
+class Ticket:
+    """A pipeline slot; release() hands it to the next queued request. Releasing twice is a no-op."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.controller._release(time.monotonic() - self.admitted_at)
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent=8, max_queue=16, max_wait=10.0, target_delay=0.1, interval=1.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.target_delay = target_delay
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = deque()
+        # CoDel state: smallest queueing delay seen in the current interval
+        self._min_delay = math.inf
+        self._interval_end = time.monotonic() + interval
+        self._overloaded = False
+        # EWMA of how long a request holds its slot, for Retry-After
+        self._service_time = None
+        self._counters = {"admitted": 0, "queued": 0, "queue_seconds": 0.0}
+        self._rejected = dict.fromkeys(REJECT_REASONS, 0)
+
+    @classmethod
+    def from_env(cls, threads=None):
+        """
+        threads is the size of the server's thread pool when every request
+        holds a thread (gunicorn), or None when waiting is free (asgi).
+        """
+        max_concurrent, max_queue = thread_limits(threads) if threads else (8, 16)
+        max_concurrent = int(os.environ.get("ADMISSION_MAX_CONCURRENT", max_concurrent))
+        max_queue = int(os.environ.get("ADMISSION_MAX_QUEUE", max_queue))
+        if threads and max_concurrent + max_queue > threads:
+            logging.warning(
+                f"ADMISSION_MAX_CONCURRENT + ADMISSION_MAX_QUEUE ({max_concurrent + max_queue}) is more than the "
+                f"{threads} server threads; requests past the thread count wait in the socket backlog and are never shed"
+            )
+        return cls(
+            max_concurrent=max_concurrent,
+            max_queue=max_queue,
+            max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 10)),
+            target_delay=float(os.environ.get("ADMISSION_TARGET_DELAY_MS", 100)) / 1000,
+            interval=float(os.environ.get("ADMISSION_INTERVAL", 1)),
+        )
+
+    # All of the following run with self._lock held
+
+    def _roll_interval(self, now):
+        if now >= self._interval_end:
+            # A standing queue: even the luckiest request this interval waited too long
+            self._overloaded = self._min_delay != math.inf and self._min_delay > self.target_delay
+            self._min_delay = math.inf
+            self._interval_end = now + self.interval
+
+    def _record_delay(self, delay):
+        now = time.monotonic()
+        self._roll_interval(now)
+        self._min_delay = min(self._min_delay, delay)
+        self._counters["queue_seconds"] += delay
+
+    def _retry_after(self):
+        service_time = self._service_time or 1.0
+        rounds = (len(self._waiters) + self._active) / max(1, self.max_concurrent)
+        return max(1, min(60, math.ceil(service_time * rounds)))
+
+    def _reject(self, reason):
+        self._rejected[reason] += 1
+        raise AdmissionRejected(reason, self._retry_after())
+
+    def _enter(self, notify):
+        """Admit at once (returns (None, None)) or queue (returns (waiter, timeout)); raises if the queue is full."""
+        with self._lock:
+            if self._active < self.max_concurrent and not self._waiters:
+                self._active += 1
+                self._counters["admitted"] += 1
+                self._record_delay(0.0)
+                return None, None
+            if len(self._waiters) >= self.max_queue:
+                self._reject("queue_full")
+            waiter = _Waiter(notify)
+            self._waiters.append(waiter)
+            self._counters["queued"] += 1
+            self._roll_interval(time.monotonic())
+            return waiter, self.target_delay if self._overloaded else self.max_wait
+
+    def _settle(self, waiter):
+        """A queued request stopped waiting: admitted if it was handed a slot, else shed."""
+        with self._lock:
+            if waiter.granted:
+                return
+            self._waiters.remove(waiter)
+            self._record_delay(time.monotonic() - waiter.enqueued)
+            self._reject("timeout")
+
+    def _abandon(self, waiter):
+        """A queued request went away (e.g. the client disconnected)."""
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                return
+        self._release(0.0)
+
+    def _release(self, held_seconds):
+        with self._lock:
+            if held_seconds:
+                self._service_time = held_seconds if self._service_time is None else self._service_time + 0.2 * (held_seconds - self._service_time)
+            if self._waiters:
+                # The slot passes straight to the oldest waiter
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                self._counters["admitted"] += 1
+                self._record_delay(time.monotonic() - waiter.enqueued)
+                waiter.notify()
+                return
+            self._active -= 1
+
+    def acquire(self):
+        """Wait for a slot; returns a Ticket or raises AdmissionRejected."""
+        event = threading.Event()
+        waiter, timeout = self._enter(event.set)
+        if waiter is not None:
+            event.wait(timeout)
+            self._settle(waiter)
+        return Ticket(self)
+
+    async def acquire_async(self):
+        """Async version of acquire()."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter, timeout = self._enter(notify)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), timeout)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                self._abandon(waiter)
+                raise
+            self._settle(waiter)
+        return Ticket(self)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["rejected"] = dict(self._rejected)
+            stats["active"] = self._active
+            stats["queue_depth"] = len(self._waiters)
+            stats["overloaded"] = self._overloaded
+            stats["service_time"] = round(self._service_time, 3) if self._service_time is not None else None
+        stats["queue_seconds"] = round(stats["queue_seconds"], 3)
+        stats["max_concurrent"] = self.max_concurrent
+        stats["max_queue"] = self.max_queue
+        return stats
+
+
+def render_metrics(stats):
+    """Admission metrics in the Prometheus text format, from a stats() snapshot."""
+    active = Gauge("sketchify_admission_active", "Generation requests holding a pipeline slot.")
+    active.inc(stats["active"])
+    queue_depth = Gauge("sketchify_admission_queue_depth", "Generation requests waiting for a pipeline slot.")
+    queue_depth.inc(stats["queue_depth"])
+    admitted = Counter("sketchify_admission_admitted_total", "Generation requests admitted to the pipeline.")
+    admitted.inc(stats["admitted"])
+    queue_seconds = Counter("sketchify_admission_queue_seconds_total", "Time admitted and shed requests spent queued.")
+    queue_seconds.inc(stats["queue_seconds"])
+    rejected = Counter("sketchify_admission_rejected_total", "Generation requests rejected with 429, by reason.", ("reason",))
+    for reason in REJECT_REASONS:
+        rejected.inc(stats["rejected"][reason], reason=reason)
+
+    lines = []
+    for metric in (active, queue_depth, admitted, queue_seconds, rejected):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,53 @@
+"""
+Memo of the theme-independent part of a sketch analysis.
+
+The one-pass Gemini call describes what is drawn (SKETCH_CONTENT) and gives it
+a title that never mentions the theme. Both are kept here, keyed by the hash
+of the sketch bytes, so a follow-up request for the same canvas in another
+theme can build its transformation prompt and description from text alone:
+a text-only Gemini call ("text" mode) or a local template ("local" mode),
+instead of another multimodal call.
+"""
+import os
+import threading
+
+from result_cache import ResultCache, sketch_hash
+
+MODES = ("text", "local")
+
+
+class AnalysisMemo:
+    def __init__(self, cache=None, mode="text"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown analysis memo mode {mode!r}, expected one of {MODES}")
+        self.cache = cache if cache is not None else ResultCache()
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._counters = {"text": 0, "local": 0, "text_failures": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            cache=ResultCache.from_env(prefix="ANALYSIS_MEMO"),
+            mode=os.environ.get("ANALYSIS_MEMO_MODE", "text"),
+        )
+
+    def remember(self, image_bytes, sketch_content, title):
+        self.cache.put(sketch_hash(image_bytes), {"sketch_content": sketch_content, "title": title})
+
+    def recall(self, image_bytes):
+        """The memoized {"sketch_content", "title"} for these sketch bytes, or None."""
+        return self.cache.get(sketch_hash(image_bytes))
+
+    def record(self, outcome):
+        """Count how a memo hit was turned into a full analysis ("text", "local" or "text_failures")."""
+        with self._lock:
+            self._counters[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["vision_calls_saved"] = stats["text"] + stats["local"]
+        stats["mode"] = self.mode
+        stats["cache"] = self.cache.stats()
+        return stats
@@ -1,18 +1,35 @@
 import os
-from flask import Flask, request, jsonify
-import base64
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import logging
 from dotenv import load_dotenv
-from io import BytesIO
-from PIL import Image
-import requests
-from openai import OpenAI
-import traceback
-import binascii
 import json
 import re
-from themes import get_theme_prompt, THEMES
+import time
+from concurrent.futures import ThreadPoolExecutor
+from theme_registry import CompiledTheme, ThemeRegistry
+from prompt_budget import PromptBudget, estimate_chat_tokens
+from upstream import GEMINI_BASE_URL, get_client as get_upstream_client, pipeline_threads, upstream_stats
+from result_cache import ResultCache, make_cache_key
+from coalescing import SingleFlight
+from hedging import Hedger
+from providers import ImagenProvider, router_from_env
+from resilience import BreakerRegistry, Deadline, RetryPolicy, upstream_error_status
+from sketch_index import SketchIndex, dhash
+from analysis_memo import AnalysisMemo
+from preprocess import SketchPreprocessor
+from ingest import SketchIngestor
+from jobs import JobQueueFull, runner_from_env
+from steps import Step, StepRunner, collect, completed, relay
+from admission import AdmissionController, AdmissionRejected, render_metrics as render_admission_metrics
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, PipelineMetrics
+from request_log import RequestLogger, configure_logging, install_flask_hooks
+from transport import encode_binary_response, read_form_upload, read_raw_upload, requested_response_format
+from transcode import OUTPUT_FIELDS, Transcoder
+from structured_output import (
+    ONE_PASS_FIELDS, ONE_PASS_SCHEMA, ParseStats, ProfileStats,
+    is_schema_rejection, output_mode, parse_json_fields, profile_max_tokens, response_format, response_profile, word_limit,
+)
 
 # Load environment variables (for local development)
 load_dotenv()
@@ -21,8 +38,9 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Structured JSON logging through a background writer (see request_log.py)
+configure_logging()
+request_logger = RequestLogger.from_env()
 
 # Check if running in Google Cloud Run
 def is_running_in_cloud_run():
@@ -53,18 +71,17 @@ def setup_credentials():
             # Set the environment variable to use this file
             os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = temp_key_path
             
-            print("Successfully loaded service account key from Secret Manager")
+            logging.info("Successfully loaded service account key from Secret Manager")
             
         except Exception as e:
-            logging.error(f"Error setting up credentials from Secret Manager: {e}")
-            traceback.print_exc()
+            logging.exception(f"Error setting up credentials from Secret Manager: {e}")
     else:
         # Local development - use the file path
         SERVICE_ACCOUNT_KEY_PATH = os.path.join(os.path.dirname(__file__), "sketchify-service-key.json")
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_KEY_PATH
         
         if not os.path.exists(SERVICE_ACCOUNT_KEY_PATH):
-            print(f"WARNING: Service account key file not found at {SERVICE_ACCOUNT_KEY_PATH}")
+            logging.warning(f"Service account key file not found at {SERVICE_ACCOUNT_KEY_PATH}")
 
 # Setup credentials
 setup_credentials()
@@ -76,189 +93,1197 @@ api_key = os.getenv("GEMINI_API_KEY")
 gemini_model = "gemini-2.0-flash"
 imagen_model = "imagen-3.0-generate-002" 
 
-def get_client():
-    return OpenAI(
-        api_key=api_key,
-        base_url="https://generativelanguage.googleapis.com/v1beta/openai/"
+# Finished results for resubmitted sketches, keyed on sketch + options (see result_cache.py)
+result_cache = ResultCache.from_env() if os.environ.get("RESULT_CACHE_ENABLED", "1") != "0" else None
+
+# Gemini analyses of earlier sketches, looked up by perceptual hash (see sketch_index.py)
+sketch_index = SketchIndex.from_env() if os.environ.get("SKETCH_INDEX_ENABLED", "1") != "0" else None
+
+# Theme-independent sketch analyses, so re-theming a canvas skips the vision call (see analysis_memo.py)
+analysis_memo = AnalysisMemo.from_env() if os.environ.get("ANALYSIS_MEMO_ENABLED", "1") != "0" else None
+
+# Skips the PIL round-trip for canvases that are already clean PNGs (see ingest.py)
+sketch_ingestor = SketchIngestor.from_env()
+
+# Crops, downsizes and recolours the sketch before it is uploaded to Gemini (see preprocess.py)
+sketch_preprocessor = SketchPreprocessor.from_env() if os.environ.get("SKETCH_PREPROCESS_ENABLED", "1") != "0" else None
+
+# Identical generations already in progress, keyed like the result cache (see coalescing.py)
+in_flight = SingleFlight.from_env() if os.environ.get("COALESCE_ENABLED", "1") != "0" else None
+
+# Hedges slow Imagen calls with a second identical call (see hedging.py)
+image_hedger = Hedger.from_env(pipeline_threads()) if os.environ.get("HEDGE_ENABLED", "0") == "1" else None
+
+# Retries and per-upstream circuit breakers, shared by every upstream call (see resilience.py)
+upstream_breakers = BreakerRegistry.from_env()
+retry_policy = RetryPolicy.from_env()
+
+def build_image_router(async_client_factory=None):
+    """
+    Imagen plus any other backends listed in IMAGE_PROVIDERS, behind a
+    latency-aware router (see providers.py). An async server passes the
+    factory for its own client.
+    """
+    imagen_provider = ImagenProvider(
+        request_kwargs=lambda prompt, quality: imagen_request_kwargs(prompt, quality),
+        client_factory=lambda: get_client(),
+        async_client_factory=async_client_factory,
+        hedger=image_hedger,
+        cost=float(os.environ.get("IMAGEN_COST", 0.04)),
     )
+    return router_from_env(imagen_provider, upstream_breakers, retry_policy)
+
+image_router = build_image_router()
+
+# Token budgets for prompt parts sent upstream (see prompt_budget.py)
+prompt_budget = PromptBudget.from_env()
+
+# Themes compiled once, hot-reloaded from THEMES_FILE (see theme_registry.py);
+# the theme text quoted to Gemini is fitted to its budget at compile time
+theme_registry = ThemeRegistry.from_env(context_filter=lambda text: prompt_budget.fit("theme_context", text))
+
+def get_theme_prompt(theme_name):
+    """(system prompt, user text, temperature) of a theme; unknown names get Default."""
+    theme = theme_registry.get(theme_name)
+    return theme.system_content, theme.user_text, theme.temperature
+
+def compiled_theme(theme_name, theme_context, theme_prompt=None):
+    """
+    The registry's compiled theme when theme_context is its live text, else
+    one compiled for the text given.
+    """
+    theme = theme_registry.peek(theme_name)
+    if theme is not None and theme.system_content == theme_context and theme_prompt in (None, theme.user_text):
+        return theme
+    enhancers = theme.enhancers if theme is not None else None
+    return CompiledTheme(theme_name, theme_context, theme_prompt or "", enhancers=enhancers, context_filter=theme_registry.context_filter)
+
+# Per-stage latency histograms and pipeline counters for GET /metrics (see metrics.py)
+pipeline_metrics = PipelineMetrics()
+
+# One-pass replies as JSON-schema structured output, with parse outcomes per theme (see structured_output.py).
+# parse_stats.mode is the mode in use, labelled once the upstream has rejected the schema
+GEMINI_OUTPUT_MODE = output_mode()
+parse_stats = ParseStats(GEMINI_OUTPUT_MODE)
+
+# How much the one-pass call asks for, with token usage and latency per profile
+GEMINI_RESPONSE_PROFILE = response_profile()
+profile_stats = ProfileStats()
+
+# Output stage: generated PNGs re-encoded to the requested format and size tiers
+image_transcoder = Transcoder.from_env()
+
+# Bounded concurrency and queue for /generate-prompt; overload is shed with 429 (see admission.py).
+# Under gunicorn the limits must fit in its thread pool (asgi_app.py has its own controller)
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "1") != "0"
+server_threads = int(os.environ["GUNICORN_THREADS"]) if os.environ.get("GUNICORN_THREADS") else None
+admission = AdmissionController.from_env(server_threads) if ADMISSION_ENABLED else None
+
+def metric_labels(theme, complexity):
+    """
+    Theme/complexity labels for pipeline metrics. Unknown themes render with
+    the Default theme and are counted as such, so clients can't grow the
+    label set; "multi" marks the shared stages of a fan-out request.
+    """
+    if theme != "multi" and theme not in theme_registry:
+        theme = "Default"
+    return {"theme": theme, "complexity": image_quality(str(complexity))}
+
+def request_metric_labels(data):
+    if is_theme_fanout(data):
+        return metric_labels("multi", data.get("complexity", "standard"))
+    return metric_labels(data.get("theme", "Default"), data.get("complexity", "standard"))
+
+def record_parse_outcome(theme_name, outcome, labels=None):
+    labels = labels or metric_labels(theme_name, "standard")
+    parse_stats.record(labels["theme"], outcome)
+    pipeline_metrics.parse(parse_stats.mode, outcome, labels)
+
+def record_profile_usage(seconds, chat_kwargs, response, labels=None):
+    usage = getattr(response, "usage", None)
+    profile_stats.record(GEMINI_RESPONSE_PROFILE, seconds, usage)
+    pipeline_metrics.tokens(GEMINI_RESPONSE_PROFILE, usage, labels)
+    prompt_budget.record_usage("analysis", estimate_chat_tokens(chat_kwargs["messages"]), usage)
+
+def get_client():
+    # Shared client backed by the process-wide keep-alive pool (see upstream.py);
+    # retries are handled by retry_policy instead of the client
+    return get_upstream_client(api_key=api_key, base_url=GEMINI_BASE_URL, max_retries=0)
+
+def call_gemini(chat_kwargs, deadline=None, labels=None):
+    """
+    Gemini chat completion within the request deadline, retried on transient
+    errors and guarded by the "gemini" circuit breaker.
+    """
+    client = get_client()
+    try:
+        with pipeline_metrics.stage("gemini", labels):
+            return retry_policy.call(
+                lambda timeout: client.chat.completions.create(**chat_kwargs, timeout=timeout),
+                upstream_breakers.get("gemini"), deadline or Deadline(), "analysis",
+            )
+    except Exception as e:
+        pipeline_metrics.upstream_error("gemini", e, labels)
+        raise
 
 def create_transformation_prompt(theme_name, theme_context, theme_prompt, user_prompt=""):
     """
     Create a detailed transformation prompt using theme information from themes.py
     """
-    # Add style-specific enhancers for common themes to improve results
-    style_enhancers = {
-        "Minimalism": "clean lines, elegant simplicity, essential elements only, minimalist design",
-        "Abstract": "abstract interpretation, non-literal, expressive colors, emotional resonance, abstract art style, free-form shapes",
-        "Realism": "photorealistic details, true-to-life lighting and textures, accurate lighting and shadows, precise proportions, lifelike quality",
-        "Anime": "anime style art, expressive eyes, vibrant colors, manga aesthetics, dynamic poses",
-        "Cartoon": "cartoon style, bold outlines, exaggerated features, vibrant colors, playful aesthetic, whimsical elements, animated look",
-        "Nature": "natural elements, organic forms, environmental harmony"
-    }
-    
-    # Extract key concepts from the theme context (system prompt)
-    # Remove instructions that are specific to description tasks
-    clean_context = theme_context.replace("these are instructions for a diffusion model.", "")
-    clean_context = clean_context.replace("Describe the sketch", "Transform the sketch")
-    clean_context = clean_context.replace("in 1-2 sentences", "")
-    
-    # Extract style focus points from theme prompt (user prompt)
-    # Remove instructions about descriptions and focus on style elements
-    focus_points = theme_prompt.replace("Translate this sketch into", "Create")
-    focus_points = focus_points.replace("description", "image")
-    
-    # Create a content-preserving transformation prompt
-    transformation_prompt = f"Transform this sketch into a high-quality {theme_name} style image while preserving its key elements and composition. "
-    
-    # Add extracted style guidance from theme context
-    if clean_context:
-        # Find a good stopping point to extract the style guidance
-        if "." in clean_context:
-            # Use the first couple of sentences that define the style
-            style_guidance = ". ".join(clean_context.split(".")[:2]) + "."
-            transformation_prompt += f"{style_guidance} "
-    
-    # Add style enhancers if available for this theme
-    if theme_name in style_enhancers:
-        transformation_prompt += f"Include these style elements: {style_enhancers[theme_name]}. "
-    
-    # Add focus points from the theme prompt
-    if "Focus on" in focus_points:
-        focus_text = focus_points[focus_points.index("Focus on"):]
-        transformation_prompt += f"{focus_text} "
-    
-    # Add user prompt if provided
-    if user_prompt:
-        transformation_prompt += f"Additional details: {user_prompt}. "
-    
-    return transformation_prompt
+    # The theme part is compiled once per theme (see theme_registry.py)
+    return compiled_theme(theme_name, theme_context, theme_prompt).fallback_prompt(user_prompt)
 
-def all_in_one_gemini_request(image_base64, theme_name, theme_context, theme_prompt, user_prompt=""):
+def build_all_in_one_prompt(theme_name, theme_context, user_prompt="", output_mode=None, profile=None):
     """
-    Make a single Gemini API call that:
-    1. Analyzes the sketch
-    2. Creates a style-specific prompt
-    3. Generates a descriptive title
-    4. Creates a user-friendly description
+    Build the one-pass prompt that asks Gemini for the analysis, transformation
+    prompt, title and description, as a JSON object in structured mode or in
+    a labelled format otherwise. The lean profile asks for a one-sentence
+    analysis and puts a word limit on every field. The user's request comes
+    last, so the theme-specific text before it is a stable prefix that the
+    upstream can cache across requests.
     """
-    client = get_client()
-    
-    # Create a prompt that requests multiple outputs in a structured format
+    profile = profile or GEMINI_RESPONSE_PROFILE
     all_in_one_prompt = f"""
 You are an expert AI art assistant tasked with analyzing a sketch and providing information for style transformation.
 
 First, examine the sketch carefully and identify exactly what is drawn.
 """
 
-    # Only add the user request section if there actually is one
+    transformation_instruction = compiled_theme(theme_name, theme_context).transformation_instruction
+    # Add user request instruction only if there is one
     if user_prompt:
-        all_in_one_prompt += f"\nIMPORTANT USER REQUEST: {user_prompt}\n"
+        transformation_instruction += ". MAKE SURE to incorporate the user request given at the end"
 
-    all_in_one_prompt += f"""
-    Then, provide the following information in this exact format:
+    if profile == "verbose":
+        sketch_instruction = "Write a detailed factual analysis of what's in the sketch - objects, figures, composition"
+    else:
+        sketch_instruction = "Name the main objects or figures in the sketch in one short sentence"
 
-    SKETCH_CONTENT: [Write a detailed factual analysis of what's in the sketch - objects, figures, composition]
+    sections = [
+        ("SKETCH_CONTENT", sketch_instruction),
+        ("TRANSFORMATION_PROMPT", transformation_instruction),
+        ("TITLE", f"Create a memorable, specific 3-6 word title that focuses on the actual content of the sketch, NOT mentioning \"{theme_name}\", \"art\", \"sketch\" or \"AI\""),
+        ("DESCRIPTION", f"Write a brief, engaging 2-3 sentence description of how the sketch would look when transformed into {theme_name} style. Make it sound like a gallery caption, focusing on the actual content while mentioning the style elements"),
+    ]
 
-    TRANSFORMATION_PROMPT: [Create a detailed prompt to transform this sketch into {theme_name} style while preserving the original content. Use these style elements: {theme_context}"""
+    if profile == "lean":
+        sections = [(label, f"{instruction} (at most {word_limit(profile, label.lower())} words)") for label, instruction in sections]
 
-    # Add user request instruction only if there is one
-    if user_prompt:
-        all_in_one_prompt += f". MAKE SURE to incorporate this user request: {user_prompt}"
+    if (output_mode or parse_stats.mode) == "structured":
+        all_in_one_prompt += """
+    Then, respond with a JSON object with these string fields:
 
-    all_in_one_prompt += f"""]
+"""
+        all_in_one_prompt += "\n\n".join(f"    {label.lower()}: {instruction}" for label, instruction in sections)
+        all_in_one_prompt += """
 
-    TITLE: [Create a memorable, specific 3-6 word title that focuses on the actual content of the sketch, NOT mentioning "{theme_name}", "art", "sketch" or "AI"]
+    Respond with the JSON object only.
+    """
+        return all_in_one_prompt + user_request_section(user_prompt)
 
-    DESCRIPTION: [Write a brief, engaging 2-3 sentence description of how the sketch would look when transformed into {theme_name} style. Make it sound like a gallery caption, focusing on the actual content while mentioning the style elements]
+    all_in_one_prompt += """
+    Then, provide the following information in this exact format:
+
+"""
+    all_in_one_prompt += "\n\n".join(f"    {label}: [{instruction}]" for label, instruction in sections)
+    all_in_one_prompt += """
 
     Follow this format exactly. Each section should be on its own line, with the exact labels as shown.
     """
+    return all_in_one_prompt + user_request_section(user_prompt)
+
+def user_request_section(user_prompt):
+    # Only add the user request section if there actually is one
+    return f"\nIMPORTANT USER REQUEST: {user_prompt}\n" if user_prompt else ""
+
+def one_pass_response_format():
+    """JSON-schema `response_format` for the one-pass call in structured mode."""
+    if parse_stats.mode != "structured":
+        return None
+    return response_format("sketch_analysis", ONE_PASS_SCHEMA)
+
+def all_in_one_request_kwargs(all_in_one_prompt, image_base64, response_format=None, max_tokens=None):
+    """
+    Keyword arguments for the one-pass chat completion call, shared by the
+    sync (Flask) and async (ASGI) clients.
+    """
+    chat_kwargs = {
+        "model": gemini_model,
+        "temperature": 0.7,
+        "messages": [
+            {
+                "role": "system",
+                "content": "You analyze sketches and provide detailed information for style transformation, titles, and descriptions."
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": all_in_one_prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/png;base64,{image_base64}"}
+                    }
+                ]
+            }
+        ]
+    }
+    if response_format is not None:
+        chat_kwargs["response_format"] = response_format
+    if max_tokens is not None:
+        chat_kwargs["max_tokens"] = max_tokens
+    return chat_kwargs
+
+def parse_one_pass_fields(full_response):
+    """
+    The one-pass fields found in a reply, in one pass over the text: as JSON,
+    as almost-JSON, or as LABEL: sections. Returns (values, outcome).
+    """
+    values, outcome = parse_json_fields(full_response, ONE_PASS_FIELDS)
+    if not values:
+        sections = split_labelled_sections(full_response)
+        values = {label.lower(): text for label, text in sections.items() if label.lower() in ONE_PASS_FIELDS and text}
+        outcome = "labelled"
+    if "transformation_prompt" not in values:
+        outcome = "failed"
+    return values, outcome
+
+def parse_all_in_one_response(full_response, theme_name, theme_context, theme_prompt, user_prompt=""):
+    """
+    Split the one-pass response into its sections, falling back to local
+    defaults for any section that is missing.
+    """
+    values, outcome = parse_one_pass_fields(full_response)
+
+    # Extract the matches or use defaults
+    sketch_content = values.get("sketch_content") or "A sketch"
+    fallback = outcome == "failed"
+    transformation_prompt = values.get("transformation_prompt") or create_transformation_prompt(theme_name, theme_context, theme_prompt, user_prompt)
+    title = values.get("title") or f"{theme_name} Creation"
+    description = values.get("description") or f"A {theme_name.lower()} style artwork based on the sketch."
+
+    # Clean up any quotation marks
+    title = title.strip('"\'')
+    description = description.strip('"\'')
+
+    return {
+        "sketch_content": sketch_content,
+        "transformation_prompt": transformation_prompt,
+        "title": title,
+        "description": description,
+        "fallback": fallback,
+        "parse_outcome": outcome
+    }
+
+def fallback_gemini_response(theme_name, theme_context, theme_prompt, user_prompt=""):
+    """
+    Local stand-in for the one-pass response when the Gemini call fails.
+    """
+    transformation_prompt = create_transformation_prompt(theme_name, theme_context, theme_prompt, user_prompt)
+
+    return {
+        "sketch_content": "A sketch",
+        "transformation_prompt": transformation_prompt,
+        "title": f"{theme_name} Creation",
+        "description": f"A {theme_name.lower()} style artwork based on the sketch.",
+        "fallback": True
+    }
+
+def all_in_one_gemini_request(image_base64, theme_name, theme_context, theme_prompt, user_prompt="", deadline=None, labels=None):
+    """
+    Make a single Gemini API call that:
+    1. Analyzes the sketch
+    2. Creates a style-specific prompt
+    3. Generates a descriptive title
+    4. Creates a user-friendly description
+    """
+    return step_runner.run(all_in_one_gemini_steps(image_base64, theme_name, theme_context, theme_prompt, user_prompt, deadline, labels))
+
+def all_in_one_gemini_steps(image_base64, theme_name, theme_context, theme_prompt, user_prompt="", deadline=None, labels=None):
+    """all_in_one_gemini_request as a sub-pipeline (see steps.py)."""
+    # Create a prompt that requests multiple outputs in a structured format
+    all_in_one_prompt = build_all_in_one_prompt(theme_name, theme_context, user_prompt)
     
     try:
-        response = client.chat.completions.create(
-            model=gemini_model,
-            temperature=0.7,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You analyze sketches and provide detailed information for style transformation, titles, and descriptions."
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": all_in_one_prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{image_base64}"}
-                        }
-                    ]
-                }
-            ]
+        chat_kwargs = all_in_one_request_kwargs(
+            all_in_one_prompt, image_base64, one_pass_response_format(), profile_max_tokens(GEMINI_RESPONSE_PROFILE)
         )
+        call_start = time.perf_counter()
+        try:
+            response = yield Step("call_gemini", chat_kwargs, deadline, labels)
+        except Exception as e:
+            if "response_format" not in chat_kwargs or not is_schema_rejection(e):
+                raise
+            # The upstream won't take the JSON schema: ask again, and from now on, for labelled text
+            logging.warning(f"Structured output rejected, switching to labelled output: {e}")
+            parse_stats.schema_rejected()
+            chat_kwargs = all_in_one_request_kwargs(
+                build_all_in_one_prompt(theme_name, theme_context, user_prompt), image_base64, None, chat_kwargs.get("max_tokens")
+            )
+            response = yield Step("call_gemini", chat_kwargs, deadline, labels)
+        record_profile_usage(time.perf_counter() - call_start, chat_kwargs, response, labels)
         
         full_response = response.choices[0].message.content.strip()
-        print(f"Full Gemini response: {full_response}")
-        
-        # Extract the different sections using regex
-        sketch_content_match = re.search(r'SKETCH_CONTENT:\s*(.*?)(?=\n\n[A-Z_]+:|$)', full_response, re.DOTALL)
-        transformation_match = re.search(r'TRANSFORMATION_PROMPT:\s*(.*?)(?=\n\n[A-Z_]+:|$)', full_response, re.DOTALL)
-        title_match = re.search(r'TITLE:\s*(.*?)(?=\n\n[A-Z_]+:|$)', full_response, re.DOTALL)
-        description_match = re.search(r'DESCRIPTION:\s*(.*?)(?=\n\n[A-Z_]+:|$)', full_response, re.DOTALL)
-        
-        # Extract the matches or use defaults
-        sketch_content = sketch_content_match.group(1).strip() if sketch_content_match else "A sketch"
-        transformation_prompt = transformation_match.group(1).strip() if transformation_match else create_transformation_prompt(theme_name, theme_context, theme_prompt, user_prompt)
-        title = title_match.group(1).strip() if title_match else f"{theme_name} Creation"
-        description = description_match.group(1).strip() if description_match else f"A {theme_name.lower()} style artwork based on the sketch."
-        
-        # Clean up any quotation marks
-        title = title.strip('"\'')
-        description = description.strip('"\'')
+        logging.debug(f"Full Gemini response: {full_response}")
         
-        return {
-            "sketch_content": sketch_content,
-            "transformation_prompt": transformation_prompt,
-            "title": title,
-            "description": description
-        }
+        with pipeline_metrics.stage("parse", labels):
+            parsed = parse_all_in_one_response(full_response, theme_name, theme_context, theme_prompt, user_prompt)
+        record_parse_outcome(theme_name, parsed["parse_outcome"], labels)
+        if parsed["fallback"]:
+            # No TRANSFORMATION_PROMPT in the reply, so create_transformation_prompt was used
+            pipeline_metrics.fallback("parse", labels)
+        return parsed
     except Exception as e:
-        logging.error(f"Error in all_in_one_gemini_request: {e}")
-        traceback.print_exc()
+        logging.exception(f"Error in all_in_one_gemini_request: {e}")
         
         # Fallback to manual prompt creation
-        transformation_prompt = create_transformation_prompt(theme_name, theme_context, theme_prompt, user_prompt)
-        
-        return {
-            "sketch_content": "A sketch",
+        pipeline_metrics.fallback("gemini_error", labels)
+        return fallback_gemini_response(theme_name, theme_context, theme_prompt, user_prompt)
+
+def recall_sketch_analysis(image_bytes):
+    if analysis_memo is None:
+        return None
+    return analysis_memo.recall(image_bytes)
+
+def remember_sketch_analysis(image_bytes, sketch_content, title, fallback=False):
+    # Fallback placeholders say nothing about the sketch
+    if analysis_memo is None or fallback or sketch_content == "A sketch":
+        return
+    analysis_memo.remember(image_bytes, sketch_content, title)
+
+def build_retheme_prompt(sketch_content, theme_name, theme_context, user_prompt=""):
+    """
+    Text-only prompt that restyles an already analysed sketch: the memoized
+    SKETCH_CONTENT stands in for the image.
+    """
+    retheme_prompt = f"""
+You are an expert AI art assistant. A sketch has already been analyzed; this is what it shows:
+
+{sketch_content}
+"""
+
+    if user_prompt:
+        retheme_prompt += f"\nIMPORTANT USER REQUEST: {user_prompt}\n"
+
+    retheme_prompt += f"""
+    Provide the following information in this exact format:
+
+    TRANSFORMATION_PROMPT: [{compiled_theme(theme_name, theme_context).transformation_instruction}"""
+
+    if user_prompt:
+        retheme_prompt += f". MAKE SURE to incorporate this user request: {user_prompt}"
+
+    retheme_prompt += f"""]
+
+    DESCRIPTION: [Write a brief, engaging 2-3 sentence description of how the sketch would look when transformed into {theme_name} style. Make it sound like a gallery caption, focusing on the actual content while mentioning the style elements]
+
+    Follow this format exactly. Each section should be on its own line, with the exact labels as shown.
+    """
+    return retheme_prompt
+
+def retheme_request_kwargs(retheme_prompt):
+    """Keyword arguments for the text-only re-theming call."""
+    return {
+        "model": gemini_model,
+        "temperature": 0.7,
+        "messages": [
+            {
+                "role": "system",
+                "content": "You turn sketch analyses into style transformation prompts and descriptions."
+            },
+            {
+                "role": "user",
+                "content": retheme_prompt
+            }
+        ]
+    }
+
+def local_retheme_response(memo, theme_name, theme_context, theme_prompt, user_prompt=""):
+    """
+    Local template for a memoized sketch: the theme's transformation prompt
+    plus what the analysis saw.
+    """
+    transformation_prompt = create_transformation_prompt(theme_name, theme_context, theme_prompt, user_prompt)
+    return {
+        "sketch_content": memo["sketch_content"],
+        "transformation_prompt": transformation_prompt + f"The sketch shows: {memo['sketch_content']}",
+        "title": memo["title"],
+        "description": f"{summarize_description(memo['sketch_content'])} Reimagined in {theme_name.lower()} style.",
+        "fallback": False
+    }
+
+def parse_retheme_response(full_response, memo, theme_name, theme_context, theme_prompt, user_prompt=""):
+    """
+    Sections of a text-only re-theming response, or None if it has no
+    transformation prompt.
+    """
+    sections = split_labelled_sections(full_response)
+    if not sections.get("TRANSFORMATION_PROMPT"):
+        return None
+    local = local_retheme_response(memo, theme_name, theme_context, theme_prompt, user_prompt)
+    return dict(
+        local,
+        transformation_prompt=sections["TRANSFORMATION_PROMPT"],
+        description=(sections.get("DESCRIPTION") or local["description"]).strip('"\''),
+    )
+
+def retheme_gemini_request(memo, theme_name, theme_context, theme_prompt, user_prompt="", deadline=None, labels=None):
+    """
+    Analysis for a memoized sketch in a new theme, from a text-only Gemini
+    call or the local template (ANALYSIS_MEMO_MODE).
+    """
+    return step_runner.run(retheme_gemini_steps(memo, theme_name, theme_context, theme_prompt, user_prompt, deadline, labels))
+
+def retheme_gemini_steps(memo, theme_name, theme_context, theme_prompt, user_prompt="", deadline=None, labels=None):
+    """retheme_gemini_request as a sub-pipeline (see steps.py)."""
+    if analysis_memo.mode == "text":
+        try:
+            response = yield Step(
+                "call_gemini",
+                retheme_request_kwargs(build_retheme_prompt(memo["sketch_content"], theme_name, theme_context, user_prompt)),
+                deadline,
+                labels,
+            )
+            full_response = response.choices[0].message.content.strip()
+            logging.debug(f"Full Gemini re-theme response: {full_response}")
+
+            with pipeline_metrics.stage("parse", labels):
+                parsed = parse_retheme_response(full_response, memo, theme_name, theme_context, theme_prompt, user_prompt)
+            if parsed is not None:
+                analysis_memo.record("text")
+                return parsed
+        except Exception as e:
+            logging.exception(f"Error in retheme_gemini_request: {e}")
+        analysis_memo.record("text_failures")
+        pipeline_metrics.fallback("retheme", labels)
+        analysis_memo.record("local")
+        return dict(local_retheme_response(memo, theme_name, theme_context, theme_prompt, user_prompt), fallback=True)
+
+    analysis_memo.record("local")
+    return local_retheme_response(memo, theme_name, theme_context, theme_prompt, user_prompt)
+
+def decode_sketch(image_data, labels=None):
+    """
+    Decode the base64 canvas (with or without a data URL prefix). Clean PNGs
+    are forwarded untouched; anything else is re-saved through PIL so the
+    upstream always gets clean PNG data (see ingest.py).
+    Returns (clean_base64, image_bytes, image).
+    """
+    sketch = sketch_ingestor.ingest(image_data)
+    for stage, seconds in sketch.timings.items():
+        pipeline_metrics.observe(stage, seconds, labels)
+    return sketch.base64, sketch.png_bytes, sketch.image
+
+def prepare_gemini_upload(clean_base64, image_bytes, image):
+    """
+    Base64 PNG to send to the vision model: the preprocessed sketch when
+    preprocessing is enabled and changes it, otherwise the canvas as ingested.
+    """
+    if sketch_preprocessor is None:
+        return clean_base64
+    upload_base64, report = sketch_preprocessor.process_base64(image, bytes_before=len(image_bytes), original_base64=clean_base64)
+    logging.info(f"Preprocessed sketch: {report['bytes_before']} -> {report['bytes_after']} bytes, "
+                 f"{report['size_before']} -> {report['size_after']} {report['mode']} in {report['ms']} ms")
+    return upload_base64
+
+def read_generation_request(data):
+    """
+    Pull the /generate-prompt fields out of the JSON body, applying defaults.
+    """
+    return {
+        "image": data.get("image"),
+        "theme": data.get("theme", "Default"),
+        "prompt": prompt_budget.fit("user_prompt", data.get("prompt", "")),  # Additional prompt from the user
+        "complexity": data.get("complexity", "standard"),  # Image quality setting
+    }
+
+def imagen_request_kwargs(transformation_prompt, complexity):
+    """
+    Keyword arguments for the Imagen call, shared by the sync and async clients.
+    """
+    return {
+        "model": imagen_model,
+        "prompt": transformation_prompt,
+        "response_format": 'b64_json',
+        "n": 1,
+        "quality": image_quality(complexity),
+    }
+
+def image_quality(complexity):
+    # Set quality based on complexity parameter
+    return "hd" if complexity.lower() == "hd" else "standard"
+
+def generate_image_steps(transformation_prompt, complexity, deadline=None, labels=None):
+    """
+    Render the transformation prompt with the best available provider.
+    Returns (img_base64, provider_name).
+    """
+    try:
+        image_prompt = prompt_budget.fit("image_prompt", transformation_prompt)
+        with pipeline_metrics.stage("image", labels):
+            return (yield Step("render_image", image_prompt, image_quality(complexity), deadline))
+    except Exception as e:
+        pipeline_metrics.upstream_error("image", e, labels)
+        raise
+
+def render_image(image_prompt, quality, deadline):
+    return image_router.generate(image_prompt, quality, deadline)
+
+def lookup_cached_result(cache_key):
+    if result_cache is None:
+        return None
+    return result_cache.get(cache_key)
+
+def store_result(cache_key, body, fallback=False):
+    # A degraded result (Gemini error, open breaker, unparsable reply) would be served
+    # for the whole TTL, so a retry should get a real analysis instead
+    if result_cache is not None and not fallback:
+        result_cache.put(cache_key, body)
+
+def find_similar_analysis(image, theme_name, user_prompt=""):
+    """
+    Look for an earlier Gemini analysis of a near-identical sketch with the
+    same theme and user prompt. Returns (perceptual_hash, gemini_response or None).
+    """
+    if sketch_index is None:
+        return None, None
+    perceptual_hash = dhash(image)
+    match = sketch_index.lookup(perceptual_hash, namespace=(theme_name, (user_prompt or "").strip()))
+    if match is None:
+        return perceptual_hash, None
+    distance, gemini_response = match
+    logging.info(f"Reusing analysis of a similar sketch (distance {distance})")
+    return perceptual_hash, gemini_response
+
+def remember_analysis(perceptual_hash, theme_name, user_prompt, gemini_response):
+    # Local fallbacks are not worth reusing; the next similar sketch should get a real analysis
+    if sketch_index is None or perceptual_hash is None or gemini_response.get("fallback"):
+        return
+    sketch_index.add(perceptual_hash, (theme_name, (user_prompt or "").strip()), gemini_response)
+
+def join_flight(cache_key):
+    if in_flight is None:
+        return None, True
+    return in_flight.join(cache_key)
+
+def wait_flight(flight, timeout):
+    return flight.wait(timeout)
+
+def finish_flight(cache_key, flight, outcome):
+    if flight is None:
+        return
+    # Only complete runs are shared; a run cut short lets the followers run their own
+    if not outcome or outcome[-1][0] not in ("timing", "error"):
+        outcome = None
+    in_flight.finish(cache_key, flight, outcome)
+
+def replay_flight(outcome, start):
+    """Events for a coalesced request, taken from the leader's outcome."""
+    for event, payload in outcome:
+        if event == "timing":
+            yield "timing", {"cached": False, "coalesced": True, "total_ms": elapsed_ms(start)}
+        else:
+            yield event, payload
+
+def summarize_description(description):
+    return description[:100] + "..." if len(description) > 100 else description
+
+def build_generation_response(img_base64, title, description):
+    # Return the response format expected by the client
+    return {
+        "image": img_base64,
+        "description": description,
+        "prompt": summarize_description(description),
+        "title": title
+    }
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 1)
+
+def generation_events(data):
+    """
+    All-in-one image generation pipeline using just two API calls:
+    1. Gemini (for analysis, prompt, title, and description)
+    2. Imagen (for image generation)
+    Yields (event, payload) pairs as results become available: "title" and
+    "description" once the analysis is done, then "image", then "timing".
+    Failures are yielded as a single "error" event carrying a status code.
+    """
+    start = time.perf_counter()
+    deadline = Deadline()
+    fields = read_generation_request(data)
+    image_data = fields["image"]
+    theme_data = fields["theme"]
+    prompt_data = fields["prompt"]
+    complexity_data = fields["complexity"]
+
+    logging.debug(f"Received prompt: {prompt_data}")
+    logging.debug(f"Theme: {theme_data}")
+    logging.debug(f"Complexity: {complexity_data}")
+
+    # Get theme info from the theme registry
+    theme = theme_registry.use(theme_data)
+    theme_context, theme_prompt, temperature = theme.system_content, theme.user_text, theme.temperature
+    logging.info(f"Using theme: {theme_data} with temperature: {temperature}")
+
+    if not image_data:
+        logging.debug("No image found!")
+        yield "error", {"error": "No image provided", "status": 400}
+        return
+    prompt_error = prompt_budget.check("user_prompt", data.get("prompt"))
+    if prompt_error:
+        yield "error", {"error": prompt_error, "status": 400}
+        return
+
+    labels = metric_labels(theme_data, complexity_data)
+
+    # Process the image through PIL to ensure clean data
+    try:
+        clean_base64, image_bytes, image = yield Step("decode_sketch", image_data, labels)
+
+        logging.debug(f"Successfully processed image, size: {len(image_bytes)} bytes")
+
+        # Identical resubmissions are served from the result cache
+        cache_key = make_cache_key(image_bytes, theme_data, prompt_data, complexity_data)
+        cached = yield Step("lookup_cached_result", cache_key)
+        pipeline_metrics.cache("result", "hit" if cached is not None else "miss", labels)
+        if cached is not None:
+            logging.info("Returning cached result")
+            yield "title", {"title": cached["title"]}
+            yield "description", {"description": cached["description"], "prompt": cached["prompt"]}
+            yield "image", {"image": cached["image"]}
+            yield "timing", {"cached": True, "total_ms": elapsed_ms(start)}
+            return
+
+        # Identical requests that are already running share the leader's result
+        flight, leader = join_flight(cache_key)
+        if not leader:
+            logging.info("Waiting on an identical in-flight request")
+            outcome = yield Step("wait_flight", flight, in_flight.wait_timeout)
+            if outcome is not None:
+                pipeline_metrics.cache("flight", "coalesced", labels)
+                yield from replay_flight(outcome, start)
+                return
+            in_flight.record_rerun()
+            flight = None
+
+    except Exception as e:
+        logging.exception(f"Error processing image: {e}")
+        yield "error", {"error": f"Image processing error: {str(e)}", "status": 500}
+        return
+
+    outcome = []
+
+    def record(item):
+        outcome.append(item)
+        yield item
+
+    try:
+        yield from relay(upstream_events(fields, theme_context, theme_prompt, clean_base64, image_bytes, image, cache_key, start, deadline), record)
+    finally:
+        finish_flight(cache_key, flight, outcome)
+
+def upstream_events(fields, theme_context, theme_prompt, clean_base64, image_bytes, image, cache_key, start, deadline):
+    """
+    The uncached part of the pipeline: the Gemini analysis and the Imagen call,
+    both within the request's deadline.
+    """
+    theme_data = fields["theme"]
+    prompt_data = fields["prompt"]
+    complexity_data = fields["complexity"]
+    labels = metric_labels(theme_data, complexity_data)
+
+    try:
+        # STEP 1: Single call to Gemini for analysis, prompt, title, and description,
+        # unless a near-identical sketch was already analysed for this theme, or this
+        # exact sketch was analysed for another theme and only needs re-theming
+        analysis_start = time.perf_counter()
+        perceptual_hash, gemini_response = yield Step("find_similar_analysis", image, theme_data, prompt_data)
+        reused_analysis = gemini_response is not None
+        analysis_source = "similar"
+        if gemini_response is None:
+            memo = recall_sketch_analysis(image_bytes)
+            if memo is not None:
+                analysis_source = "memo"
+                gemini_response = yield Step("retheme_gemini_request", memo, theme_data, theme_context, theme_prompt, prompt_data, deadline, labels)
+            else:
+                analysis_source = "vision"
+                gemini_response = yield Step(
+                    "all_in_one_gemini_request",
+                    image_base64=(yield Step("prepare_gemini_upload", clean_base64, image_bytes, image)),
+                    theme_name=theme_data,
+                    theme_context=theme_context,
+                    theme_prompt=theme_prompt,
+                    user_prompt=prompt_data,
+                    deadline=deadline,
+                    labels=labels
+                )
+                remember_sketch_analysis(image_bytes, gemini_response["sketch_content"], gemini_response["title"], gemini_response.get("fallback"))
+            remember_analysis(perceptual_hash, theme_data, prompt_data, gemini_response)
+        analysis_ms = elapsed_ms(analysis_start)
+        pipeline_metrics.cache("analysis", analysis_source, labels)
+
+        # Extract the components from the response
+        sketch_content = gemini_response["sketch_content"]
+        transformation_prompt = gemini_response["transformation_prompt"]
+        title = gemini_response["title"]
+        description = gemini_response["description"]
+
+        logging.debug(f"Sketch content: {sketch_content}")
+        logging.debug(f"Transformation prompt: {transformation_prompt}")
+        logging.debug(f"Title: {title}")
+        logging.debug(f"Description: {description}")
+
+        # The text is ready long before the image; streaming clients can show it now
+        yield "title", {"title": title}
+        yield "description", {"description": description, "prompt": summarize_description(description)}
+
+        # STEP 2: Generate image using Imagen
+        image_start = time.perf_counter()
+        img_base64, provider = yield from generate_image_steps(transformation_prompt, complexity_data, deadline, labels)
+        image_ms = elapsed_ms(image_start)
+
+        yield Step("store_result", cache_key, build_generation_response(img_base64, title, description), gemini_response.get("fallback"))
+        yield "image", {"image": img_base64}
+        yield "timing", {
+            "cached": False,
+            "reused_analysis": reused_analysis,
+            "analysis_source": analysis_source,
+            "analysis_ms": analysis_ms,
+            "provider": provider,
+            "image_ms": image_ms,
+            "total_ms": elapsed_ms(start),
+        }
+
+    except Exception as e:
+        logging.exception(f"Error processing image: {e}")
+        yield "error", {"error": f"Image processing error: {str(e)}", "status": upstream_error_status(e)}
+
+def collect_generation(events):
+    """
+    Fold a sequence of pipeline events into the regular JSON response.
+    Returns (response_body, status_code).
+    """
+    result = {}
+    for event, payload in events:
+        if event == "error":
+            return {"error": payload["error"]}, payload["status"]
+        result.update(payload)
+    body = build_generation_response(result["image"], result["title"], result["description"])
+    body.update({field: result[field] for field in OUTPUT_FIELDS if field in result})
+    return body, 200
+
+# Multi-theme fan-out: one sketch analysis, then one Imagen call per theme
+THEME_FANOUT_MAX = int(os.environ.get("THEME_FANOUT_MAX", 6))
+fanout_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("THEME_FANOUT_WORKERS", 8)), thread_name_prefix="fanout")
+
+def read_theme_list(themes):
+    """
+    Returns (theme names, error) for the `themes` list of a fan-out request.
+    """
+    if not isinstance(themes, list) or not themes:
+        return None, "themes must be a non-empty list of theme names"
+    names = []
+    for theme in themes:
+        if not isinstance(theme, str) or theme not in theme_registry:
+            return None, f"Unknown theme: {theme}"
+        if theme not in names:
+            names.append(theme)
+    if len(names) > THEME_FANOUT_MAX:
+        return None, f"At most {THEME_FANOUT_MAX} themes per request"
+    return names, None
+
+def build_multi_theme_prompt(theme_names, user_prompt=""):
+    """
+    Build the one-pass prompt that analyses the sketch once and asks for a
+    transformation prompt and description per theme, labelled PROMPT_<n> and
+    DESCRIPTION_<n> in the order of theme_names.
+    """
+    multi_theme_prompt = f"""
+You are an expert AI art assistant tasked with analyzing a sketch and providing information for several style transformations.
+
+First, examine the sketch carefully and identify exactly what is drawn.
+"""
+
+    # Only add the user request section if there actually is one
+    if user_prompt:
+        multi_theme_prompt += f"\nIMPORTANT USER REQUEST: {user_prompt}\n"
+
+    multi_theme_prompt += f"""
+    Then, provide the following information in this exact format:
+
+    SKETCH_CONTENT: [Write a detailed factual analysis of what's in the sketch - objects, figures, composition]
+
+    TITLE: [Create a memorable, specific 3-6 word title that focuses on the actual content of the sketch, NOT mentioning any art style, "art", "sketch" or "AI"]
+"""
+
+    for number, theme_name in enumerate(theme_names, start=1):
+        multi_theme_prompt += f"""
+    PROMPT_{number}: [{theme_registry.get(theme_name).transformation_instruction}"""
+        if user_prompt:
+            multi_theme_prompt += f". MAKE SURE to incorporate this user request: {user_prompt}"
+        multi_theme_prompt += f"""]
+
+    DESCRIPTION_{number}: [Write a brief, engaging 2-3 sentence description of how the sketch would look when transformed into {theme_name} style. Make it sound like a gallery caption]
+"""
+
+    multi_theme_prompt += """
+    Follow this format exactly. Each section should be on its own line, with the exact labels as shown.
+    """
+    return multi_theme_prompt
+
+def split_labelled_sections(full_response):
+    """Map each LABEL: section of a labelled response to its text."""
+    parts = re.split(r'^\s*([A-Z][A-Z0-9_]*):', full_response, flags=re.MULTILINE)
+    return {label: text.strip() for label, text in zip(parts[1::2], parts[2::2])}
+
+def parse_multi_theme_response(full_response, theme_names, user_prompt=""):
+    """
+    Split the labelled multi-theme response, falling back to local defaults
+    for any section that is missing.
+    """
+    sections = split_labelled_sections(full_response)
+    sketch_content = sections.get("SKETCH_CONTENT") or "A sketch"
+    title = (sections.get("TITLE") or "Untitled Creation").strip('"\'')
+
+    themes = {}
+    fallback_themes = []
+    for number, theme_name in enumerate(theme_names, start=1):
+        transformation_prompt = sections.get(f"PROMPT_{number}")
+        if not transformation_prompt:
+            fallback_themes.append(theme_name)
+            # Same local prompt as the single-theme fallback, plus what the analysis saw
+            transformation_prompt = theme_registry.get(theme_name).fallback_prompt(user_prompt)
+            if sketch_content != "A sketch":
+                transformation_prompt += f"The sketch shows: {sketch_content}"
+        description = sections.get(f"DESCRIPTION_{number}") or f"A {theme_name.lower()} style artwork based on the sketch."
+        themes[theme_name] = {
             "transformation_prompt": transformation_prompt,
-            "title": f"{theme_name} Creation",
-            "description": f"A {theme_name.lower()} style artwork based on the sketch."
+            "description": description.strip('"\''),
+        }
+
+    return {
+        "sketch_content": sketch_content,
+        "title": title,
+        "themes": themes,
+        # Themes whose transformation prompt was built locally
+        "fallback_themes": fallback_themes,
+    }
+
+def count_theme_fallbacks(analysis, complexity, kind):
+    for theme_name in analysis["fallback_themes"]:
+        pipeline_metrics.fallback(kind, metric_labels(theme_name, complexity))
+
+def multi_theme_gemini_request(image_base64, theme_names, user_prompt="", deadline=None, complexity="standard"):
+    """
+    One Gemini call that analyses the sketch for every requested theme.
+    """
+    return step_runner.run(multi_theme_gemini_steps(image_base64, theme_names, user_prompt, deadline, complexity))
+
+def multi_theme_gemini_steps(image_base64, theme_names, user_prompt="", deadline=None, complexity="standard"):
+    """multi_theme_gemini_request as a sub-pipeline (see steps.py)."""
+    multi_theme_prompt = build_multi_theme_prompt(theme_names, user_prompt)
+    labels = metric_labels("multi", complexity)
+
+    try:
+        response = yield Step("call_gemini", all_in_one_request_kwargs(multi_theme_prompt, image_base64), deadline, labels)
+
+        full_response = response.choices[0].message.content.strip()
+        logging.debug(f"Full Gemini response: {full_response}")
+
+        with pipeline_metrics.stage("parse", labels):
+            analysis = parse_multi_theme_response(full_response, theme_names, user_prompt)
+        count_theme_fallbacks(analysis, complexity, "parse")
+        return analysis
+    except Exception as e:
+        logging.exception(f"Error in multi_theme_gemini_request: {e}")
+
+        # Every section falls back to the local defaults
+        analysis = parse_multi_theme_response("", theme_names, user_prompt)
+        count_theme_fallbacks(analysis, complexity, "gemini_error")
+        return analysis
+
+def theme_error(theme_name, error):
+    logging.warning(f"Error rendering {theme_name}: {error}")
+    return {"theme": theme_name, "status": upstream_error_status(error), "error": f"Image generation error: {str(error)}"}
+
+def render_theme_steps(theme_name, analysis, complexity, cache_key, deadline):
+    """The "theme" event payload for one theme of a fan-out, rendered and cached."""
+    try:
+        transformation_prompt = analysis["themes"][theme_name]["transformation_prompt"]
+        img_base64, provider = yield from generate_image_steps(transformation_prompt, complexity, deadline, metric_labels(theme_name, complexity))
+        body = build_generation_response(img_base64, analysis["title"], analysis["themes"][theme_name]["description"])
+        yield Step("store_result", cache_key, body, theme_name in analysis.get("fallback_themes", ()))
+        return dict(body, theme=theme_name, status=200, cached=False, provider=provider)
+    except Exception as e:
+        logging.exception(f"Rendering {theme_name} failed")
+        return theme_error(theme_name, e)
+
+def theme_fanout_events(data):
+    """
+    Multi-theme pipeline: decode and analyse the sketch once, then render
+    every theme in parallel. Yields "analysis" once the shared analysis is
+    done, a "theme" event per theme as it finishes (cached themes first),
+    then "timing". A theme that fails is reported on its own event.
+    """
+    start = time.perf_counter()
+    deadline = Deadline()
+    fields = read_generation_request(data)
+    theme_names, error = read_theme_list(data.get("themes"))
+    if error:
+        yield "error", {"error": error, "status": 400}
+        return
+    if not fields["image"]:
+        yield "error", {"error": "No image provided", "status": 400}
+        return
+    prompt_error = prompt_budget.check("user_prompt", data.get("prompt"))
+    if prompt_error:
+        yield "error", {"error": prompt_error, "status": 400}
+        return
+
+    logging.info(f"Themes: {theme_names}")
+    for theme in theme_names:
+        theme_registry.use(theme)
+
+    try:
+        clean_base64, image_bytes, image = yield Step("decode_sketch", fields["image"], metric_labels("multi", fields["complexity"]))
+
+        # Themes this sketch was already rendered in come straight from the result cache
+        cache_keys = {theme: make_cache_key(image_bytes, theme, fields["prompt"], fields["complexity"]) for theme in theme_names}
+        pending = []
+        for theme in theme_names:
+            cached = yield Step("lookup_cached_result", cache_keys[theme])
+            pipeline_metrics.cache("result", "hit" if cached is not None else "miss", metric_labels(theme, fields["complexity"]))
+            if cached is not None:
+                yield "theme", dict(cached, theme=theme, status=200, cached=True)
+            else:
+                pending.append(theme)
+        if not pending:
+            yield "timing", {"cached": True, "total_ms": elapsed_ms(start)}
+            return
+
+        # STEP 1: One Gemini call covering every remaining theme
+        analysis_start = time.perf_counter()
+        analysis = yield Step(
+            "multi_theme_gemini_request",
+            image_base64=(yield Step("prepare_gemini_upload", clean_base64, image_bytes, image)),
+            theme_names=pending,
+            user_prompt=fields["prompt"],
+            deadline=deadline,
+            complexity=fields["complexity"]
+        )
+        analysis_ms = elapsed_ms(analysis_start)
+        remember_sketch_analysis(image_bytes, analysis["sketch_content"], analysis["title"])
+        yield "analysis", {"title": analysis["title"], "sketch_content": analysis["sketch_content"]}
+
+        # STEP 2: Imagen calls for all themes at once
+        image_start = time.perf_counter()
+        yield from completed("theme", [
+            render_theme_steps(theme, analysis, fields["complexity"], cache_keys[theme], deadline)
+            for theme in pending
+        ], "fanout")
+
+        yield "timing", {
+            "cached": False,
+            "analysis_ms": analysis_ms,
+            "image_ms": elapsed_ms(image_start),
+            "total_ms": elapsed_ms(start),
         }
 
+    except Exception as e:
+        logging.exception(f"Error processing image: {e}")
+        yield "error", {"error": f"Image processing error: {str(e)}", "status": upstream_error_status(e)}
+
+def collect_theme_fanout(events):
+    """
+    Fold multi-theme events into {"results": {theme: response}}.
+    Returns (response_body, status_code).
+    """
+    results = {}
+    for event, payload in events:
+        if event == "error":
+            return {"error": payload["error"]}, payload["status"]
+        if event == "theme":
+            payload = dict(payload)
+            results[payload.pop("theme")] = payload
+    return {"results": results}, 200
+
+def is_theme_fanout(data):
+    return isinstance(data, dict) and data.get("themes") is not None
+
+def has_image(event, payload):
+    # "image" events and successful "theme" events
+    return event in ("image", "theme") and "image" in payload
+
+def transcode_payload(event, payload, options, labels):
+    """
+    The event payload with its image transcoded (see transcode.py); events
+    without an image pass through.
+    """
+    if not has_image(event, payload):
+        return payload
+    if event == "theme":
+        labels = metric_labels(payload["theme"], labels["complexity"])
+    with pipeline_metrics.stage("transcode", labels):
+        return dict(payload, **image_transcoder.transcode(payload["image"], options))
+
+def transcode_events(events, data):
+    """
+    Output stage: re-encode generated images to the requested format and
+    tiers. Bad output options fail the request before the pipeline runs.
+    """
+    options, error = image_transcoder.read_options(data)
+    if error:
+        yield "error", {"error": error, "status": 400}
+        return
+    if options is None:
+        yield from events
+        return
+    labels = request_metric_labels(data)
+
+    def transcode(item):
+        event, payload = item
+        if has_image(event, payload):
+            payload = yield Step("transcode_payload", event, payload, options, labels)
+        yield event, payload
+
+    yield from relay(events, transcode)
+
+def pipeline_events(data):
+    """Events for a /generate-prompt payload: multi-theme if `themes` is given."""
+    events = theme_fanout_events(data) if is_theme_fanout(data) else generation_events(data)
+    return transcode_events(events, data)
+
+def run_generation(data):
+    """
+    Run the pipeline to completion. Returns (response_body, status_code).
+    """
+    return step_runner.run(run_generation_steps(data))
+
+def run_generation_steps(data):
+    """run_generation as a sub-pipeline (see steps.py)."""
+    events = yield from collect(pipeline_events(data))
+    if is_theme_fanout(data):
+        return collect_theme_fanout(events)
+    return collect_generation(events)
+
+# Streaming responses: Server-Sent Events or newline-delimited JSON
+STREAM_MIMETYPES = {
+    "sse": "text/event-stream",
+    "ndjson": "application/x-ndjson",
+}
+
+def requested_stream_format(accept_header, requested=None):
+    """
+    Streaming format asked for by the client through a `stream` query/body
+    value or the Accept header, or None for the regular JSON response.
+    """
+    if requested:
+        requested = str(requested).lower()
+        if requested in STREAM_MIMETYPES:
+            return requested
+        if requested in ("1", "true"):
+            return "sse"
+    accept_header = accept_header or ""
+    for stream_format, mimetype in STREAM_MIMETYPES.items():
+        if mimetype in accept_header:
+            return stream_format
+    return None
+
+def format_stream_event(stream_format, event, payload):
+    if event == "error":
+        payload = {"error": payload["error"], "status": payload["status"]}
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+    return json.dumps(dict(payload, event=event)) + "\n"
+
+# Background generation jobs for POST /jobs (see jobs.py)
+job_runner = runner_from_env(run_generation)
+
+# Longest a GET /jobs/<id>?wait=... long-poll may block. Long-polling is meant for
+# asgi_app.py; here every waiting client holds a server thread, so the wait is short
+JOB_MAX_WAIT = float(os.environ.get("JOB_MAX_WAIT", 30))
+JOB_THREADED_MAX_WAIT = float(os.environ.get("JOB_THREADED_MAX_WAIT", 2))
+
+def job_wait_seconds(requested, limit=JOB_MAX_WAIT):
+    try:
+        return min(max(float(requested or 0), 0.0), limit)
+    except ValueError:
+        return 0.0
+
+# Batch generation for POST /generate-batch
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 50))
+# Items generated at once across all batches, so big uploads stay under the upstream rate limits
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch")
+
+def read_batch_request(data):
+    """
+    Returns (items, error) for a {"items": [...]} batch payload.
+    """
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return None, "Expected a non-empty list of items"
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, f"A batch may hold at most {BATCH_MAX_ITEMS} items"
+    return items, None
+
+def run_batch_item_steps(index, item):
+    """
+    Run one batch item through the pipeline. Failures are reported on the
+    item so they never fail the rest of the batch.
+    """
+    if not isinstance(item, dict):
+        body, status = {"error": "Batch items must be objects"}, 400
+    else:
+        try:
+            body, status = yield from run_generation_steps(item)
+        except Exception as e:
+            logging.exception(f"Batch item {index} failed: {e}")
+            body, status = {"error": str(e)}, 500
+    return dict(body, index=index, status=status)
+
+def summarize_batch(results):
+    succeeded = sum(1 for result in results if result["status"] == 200)
+    return {"items": len(results), "succeeded": succeeded, "failed": len(results) - succeeded}
+
+def batch_events(items):
+    """
+    Yields an "item" event per result in completion order, then "done".
+    Items still waiting for a worker are dropped if the client went away.
+    """
+    results = []
+
+    def record(item):
+        results.append(item[1])
+        yield item
+
+    yield from relay(completed("item", [run_batch_item_steps(index, item) for index, item in enumerate(items)], "batch"), record)
+    yield "done", summarize_batch(results)
+
+# Pipeline steps run in the request thread; the step names are functions of this
+# module, looked up when the step runs (see steps.py)
+step_runner = StepRunner(lambda name: globals()[name], pools={"fanout": fanout_executor, "batch": batch_executor})
+
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({
         "message": "Welcome to Sketchify.ai Single-Call API",
         "endpoints": [
-            {"path": "/generate-prompt", "method": "POST", "description": "Generate an image from a sketch with a single API call"}
+            {"path": "/generate-prompt", "method": "POST", "description": "Generate an image from a sketch with a single API call"},
+            {"path": "/generate-batch", "method": "POST", "description": "Generate images for a list of sketches, streaming each result as it completes"},
+            {"path": "/jobs", "method": "POST", "description": "Queue a generation job and return its id immediately"},
+            {"path": "/jobs/<id>", "method": "GET", "description": "Job status and result (?wait=seconds to long-poll)"},
+            {"path": "/stats", "method": "GET", "description": "Runtime statistics for upstream connections and caches"},
+            {"path": "/breakers", "method": "GET", "description": "Circuit breaker state for each upstream"},
+            {"path": "/metrics", "method": "GET", "description": "Prometheus metrics: per-stage latency, in-flight stages, upstream errors, cache and fallback counts"}
         ]
     })
 
-@app.before_request
-def log_request_info():
-    app.logger.debug('Headers: %s', request.headers)
-    app.logger.debug('Body: %s', request.get_data())
-    app.logger.debug('Path: %s', request.path)
-    if request.path == '/generate-prompt' and request.method == 'POST':
-        app.logger.debug('Theme: %s', request.json.get('theme'))
-
-@app.after_request
-def log_response_info(response):
-    app.logger.debug('Response Status: %s', response.status)
-    return response
+# One sampled, redacted log line per request instead of dumping headers and bodies
+install_flask_hooks(app, request_logger)
 
 @app.route('/test', methods=['GET', 'POST'])
 def test():
@@ -268,118 +1293,169 @@ def test():
         "api_key": api_key is not None
     })
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        "upstream": upstream_stats(),
+        "result_cache": result_cache.stats() if result_cache else None,
+        "sketch_index": sketch_index.stats() if sketch_index else None,
+        "analysis_memo": analysis_memo.stats() if analysis_memo else None,
+        "preprocess": sketch_preprocessor.stats() if sketch_preprocessor else None,
+        "ingest": sketch_ingestor.stats(),
+        "coalescing": in_flight.stats() if in_flight else None,
+        "hedging": image_hedger.stats() if image_hedger else None,
+        "providers": image_router.stats(),
+        "jobs": job_runner.stats(),
+        "logging": request_logger.stats(),
+        "transcode": image_transcoder.stats(),
+        "parsing": parse_stats.stats(),
+        "response_profiles": dict(profile_stats.stats(), active=GEMINI_RESPONSE_PROFILE),
+        "themes": theme_registry.stats(),
+        "prompt_budget": prompt_budget.stats(),
+        "admission": admission.stats() if admission else None
+    })
+
+def read_request_payload():
+    """
+    The /generate-prompt payload: JSON with a base64 image by default, or a
+    multipart/form-data or raw image/* upload with the image as bytes.
+    """
+    if request.mimetype == "multipart/form-data":
+        return read_form_upload(request.form, request.files)
+    if request.mimetype.startswith("image/"):
+        return read_raw_upload(request.get_data(), request.args.getlist)
+    return request.json
+
 @app.route('/generate-prompt', methods=['POST'])
 def generate_prompt():
     """
     All-in-one image generation endpoint using just two API calls:
     1. Gemini (for analysis, prompt, title, and description)
     2. Imagen (for image generation)
+    Passing a `themes` list instead of `theme` analyses the sketch once and
+    renders it in every listed theme. Images can also be uploaded and
+    returned as binary instead of base64 JSON (see transport.py), and
+    transcoded to smaller formats and size tiers (see transcode.py).
+    Requests past the admission limits get 429 with Retry-After.
+    """
+    if admission is None:
+        return generate_prompt_response()
+    try:
+        ticket = admission.acquire()
+    except AdmissionRejected as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    try:
+        response = app.make_response(generate_prompt_response())
+    except BaseException:
+        ticket.release()
+        raise
+    if response.is_streamed:
+        # Streamed responses keep their slot until the last event is sent or the client goes away
+        response.response = release_after(response.response, ticket)
+    else:
+        ticket.release()
+    return response
+
+def release_after(chunks, ticket):
+    try:
+        yield from chunks
+    finally:
+        ticket.release()
+
+def generate_prompt_response():
+    try:
+        data = read_request_payload()
+
+        stream_format = requested_stream_format(request.headers.get("Accept"), request.args.get("stream") or data.get("stream"))
+        if stream_format and data.get("image"):
+            # Opt-in streaming: title/description first, then the image, then timings
+            events = (format_stream_event(stream_format, event, payload) for event, payload in step_runner.events(pipeline_events(data)))
+            return Response(
+                stream_with_context(events),
+                mimetype=STREAM_MIMETYPES[stream_format],
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+        body, status = run_generation(data)
+        response_format = requested_response_format(request.headers.get("Accept"), request.args.get("response") or data.get("response"))
+        if status == 200 and response_format and "image" in body:
+            with pipeline_metrics.stage("serialize", request_metric_labels(data)):
+                payload, content_type, headers = encode_binary_response(body, response_format)
+            return Response(payload, status=200, content_type=content_type, headers=headers)
+
+        with pipeline_metrics.stage("serialize", request_metric_labels(data)):
+            response = jsonify(body)
+        return response, status
+            
+    except Exception as e:
+        logging.exception(f"Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/generate-batch', methods=['POST'])
+def generate_batch():
+    """
+    Run the /generate-prompt pipeline over {"items": [...]} and stream one
+    result per item as it completes (NDJSON by default, SSE on request).
     """
     try:
         data = request.json
-        print("Full request data:", data)
+        items, error = read_batch_request(data)
+        if error:
+            return jsonify({"error": error}), 400
 
-        image_data = data.get("image")
-        theme_data = data.get("theme", "Default")
-        prompt_data = data.get("prompt", "")  # Additional prompt from the user
-        complexity_data = data.get("complexity", "standard")  # Image quality setting
+        logging.info(f"Batch of {len(items)} items")
+        stream_format = requested_stream_format(request.headers.get("Accept"), request.args.get("stream") or data.get("stream")) or "ndjson"
+        events = (format_stream_event(stream_format, event, payload) for event, payload in step_runner.events(batch_events(items)))
+        return Response(
+            stream_with_context(events),
+            mimetype=STREAM_MIMETYPES[stream_format],
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    except Exception as e:
+        logging.exception(f"Error: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        print(f"Received prompt: {prompt_data}")
-        print(f"Theme: {theme_data}")
-        print(f"Complexity: {complexity_data}")
+@app.route('/breakers', methods=['GET'])
+def breakers():
+    return jsonify({
+        "breakers": upstream_breakers.stats(),
+        "retries": retry_policy.stats()
+    })
 
-        # Get theme info from themes.py
-        theme_context, theme_prompt, temperature = get_theme_prompt(theme_data)
-        logging.info(f"Using theme: {theme_data} with temperature: {temperature}")
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    text = pipeline_metrics.render()
+    if admission is not None:
+        text += render_admission_metrics(admission.stats())
+    return Response(text, content_type=METRICS_CONTENT_TYPE)
 
-        if not image_data:
-            print("No image found!")
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+    Accept the same payload as /generate-prompt and run it in the background.
+    """
+    try:
+        data = request.json
+        if not data.get("image"):
             return jsonify({"error": "No image provided"}), 400
-        
-        # Extract base64 data
-        if "," in image_data:
-            image_base64 = image_data.split(",")[1]
-        else:
-            image_base64 = image_data
-            
-        # Process the image through PIL to ensure clean data
-        try:
-            # Add padding if needed
-            missing_padding = len(image_base64) % 4
-            if missing_padding:
-                image_base64 += "=" * (4 - missing_padding)
-                
-            # Decode base64
-            try:
-                image_binary = base64.b64decode(image_base64)
-            except binascii.Error:
-                image_binary = base64.b64decode(image_base64, validate=False)
-                
-            # Process through PIL
-            image = Image.open(BytesIO(image_binary))
-            buffered = BytesIO()
-            image.save(buffered, format="PNG")
-            image_bytes = buffered.getvalue()
-            clean_base64 = base64.b64encode(image_bytes).decode("utf-8")
-            
-            print(f"Successfully processed image, size: {len(image_bytes)} bytes")
-            
-            # Get client
-            client = get_client()
-            
-            # STEP 1: Single call to Gemini for analysis, prompt, title, and description
-            gemini_response = all_in_one_gemini_request(
-                image_base64=clean_base64,
-                theme_name=theme_data,
-                theme_context=theme_context,
-                theme_prompt=theme_prompt,
-                user_prompt=prompt_data
-            )
-            
-            # Extract the components from the response
-            sketch_content = gemini_response["sketch_content"]
-            transformation_prompt = gemini_response["transformation_prompt"]
-            title = gemini_response["title"]
-            description = gemini_response["description"]
-            
-            print(f"Sketch content: {sketch_content}")
-            print(f"Transformation prompt: {transformation_prompt}")
-            print(f"Title: {title}")
-            print(f"Description: {description}")
-            
-            # Set quality based on complexity parameter
-            quality = "hd" if complexity_data.lower() == "hd" else "standard"
-            
-            # STEP 2: Generate image using Imagen
-            imagen_response = client.images.generate(
-                model=imagen_model,
-                prompt=transformation_prompt,
-                response_format='b64_json',
-                n=1,
-                quality=quality,
-            )
-            
-            # Extract the image
-            img_base64 = imagen_response.data[0].b64_json
-            
-            # Return the response format expected by the client
-            return jsonify({
-                "image": img_base64,
-                "description": description,
-                "prompt": description[:100] + "..." if len(description) > 100 else description,
-                "title": title
-            }), 200
-            
-        except Exception as e:
-            print(f"Error processing image: {e}")
-            traceback.print_exc()
-            return jsonify({"error": f"Image processing error: {str(e)}"}), 500
-            
+        job = job_runner.submit(data)
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
     except Exception as e:
-        logging.error(f"Error: {e}")
-        traceback.print_exc()
+        logging.exception(f"Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+    job["status_url"] = f"/jobs/{job['id']}"
+    return jsonify(job), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    wait = job_wait_seconds(request.args.get("wait"), JOB_THREADED_MAX_WAIT)
+    job = job_runner.store.wait(job_id, wait) if wait else job_runner.store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=port)
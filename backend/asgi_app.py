@@ -0,0 +1,476 @@
+"""
+ASGI entry point for the Sketchify.ai API.
+
+Serves the same /generate-prompt contract as app.py, but runs the pipeline on
+asyncio with the async upstream client, so a single worker can keep hundreds of
+Gemini/Imagen calls waiting at once instead of one per gunicorn thread.
+The pipeline itself is app.py's (see steps.py): this module only supplies
+async versions of the upstream calls and runs every other step on a worker
+thread. The Flask app in app.py remains the fallback entry point.
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8080
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from app import (
+    api_key,
+    requested_stream_format,
+    format_stream_event,
+    STREAM_MIMETYPES,
+    result_cache,
+    sketch_index,
+    sketch_preprocessor,
+    sketch_ingestor,
+    job_runner,
+    job_wait_seconds,
+    in_flight,
+    BATCH_CONCURRENCY,
+    read_batch_request,
+    request_metric_labels,
+    pipeline_events,
+    batch_events,
+    run_generation_steps,
+)
+import app as app_module
+from jobs import JobQueueFull, FINISHED
+from admission import AdmissionController, AdmissionRejected, render_metrics as render_admission_metrics
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from steps import AsyncStepRunner
+from transport import encode_binary_response, is_binary_upload, read_binary_upload, requested_response_format
+from resilience import Deadline
+from upstream import GEMINI_BASE_URL, get_async_client, get_manager, upstream_stats
+
+# Largest request body we are willing to buffer (canvas PNGs are a few MB)
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_BYTES", 32 * 1024 * 1024))
+
+# Waiting for a slot doesn't hold a thread here, so the limits don't depend on GUNICORN_THREADS
+admission = AdmissionController.from_env() if app_module.ADMISSION_ENABLED else None
+
+
+def get_client():
+    return get_async_client(api_key=api_key, base_url=GEMINI_BASE_URL, max_retries=0)
+
+# Same providers as app.image_router, with Imagen on this server's async client
+image_router = app_module.build_image_router(async_client_factory=lambda: get_client())
+
+
+# Async pipeline steps (see steps.py)
+
+async def call_gemini(chat_kwargs, deadline=None, labels=None):
+    """
+    Async version of app.call_gemini.
+    """
+    client = get_client()
+    try:
+        with app_module.pipeline_metrics.stage("gemini", labels):
+            return await app_module.retry_policy.call_async(
+                lambda timeout: client.chat.completions.create(**chat_kwargs, timeout=timeout),
+                app_module.upstream_breakers.get("gemini"), deadline or Deadline(), "analysis",
+            )
+    except Exception as e:
+        app_module.pipeline_metrics.upstream_error("gemini", e, labels)
+        raise
+
+async def render_image(image_prompt, quality, deadline):
+    # A losing hedged call is cancelled
+    return await image_router.agenerate(image_prompt, quality, deadline)
+
+async def wait_flight(flight, timeout):
+    return await flight.wait_async(timeout)
+
+async def all_in_one_gemini_request(image_base64, theme_name, theme_context, theme_prompt, user_prompt="", deadline=None, labels=None):
+    """
+    Async version of app.all_in_one_gemini_request.
+    """
+    return await step_runner.run(app_module.all_in_one_gemini_steps(image_base64, theme_name, theme_context, theme_prompt, user_prompt, deadline, labels))
+
+async def retheme_gemini_request(memo, theme_name, theme_context, theme_prompt, user_prompt="", deadline=None, labels=None):
+    """
+    Async version of app.retheme_gemini_request.
+    """
+    return await step_runner.run(app_module.retheme_gemini_steps(memo, theme_name, theme_context, theme_prompt, user_prompt, deadline, labels))
+
+async def multi_theme_gemini_request(image_base64, theme_names, user_prompt="", deadline=None, complexity="standard"):
+    """
+    Async version of app.multi_theme_gemini_request.
+    """
+    return await step_runner.run(app_module.multi_theme_gemini_steps(image_base64, theme_names, user_prompt, deadline, complexity))
+
+ASYNC_STEPS = (
+    "call_gemini",
+    "render_image",
+    "wait_flight",
+    "all_in_one_gemini_request",
+    "retheme_gemini_request",
+    "multi_theme_gemini_request",
+)
+
+# The rest (decoding, cache and index lookups, transcoding) run on worker threads
+step_runner = AsyncStepRunner(
+    lambda name: globals()[name] if name in ASYNC_STEPS else None,
+    app_module.step_runner,
+    limits={"batch": BATCH_CONCURRENCY},
+)
+
+async def run_generation(data):
+    """
+    Async version of app.run_generation. Returns (response_body, status_code).
+    """
+    return await step_runner.run(run_generation_steps(data))
+
+
+class StreamingBody:
+    """Route result for responses sent as a sequence of body chunks."""
+
+    def __init__(self, mimetype, chunks, headers=()):
+        self.mimetype = mimetype
+        self.chunks = chunks
+        self.headers = list(headers)
+
+
+class RawBody:
+    """Route result for a non-JSON body sent in one piece (images, metrics)."""
+
+    def __init__(self, content_type, payload, headers=None, status=200):
+        self.content_type = content_type
+        self.payload = payload
+        self.headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in (headers or {}).items()]
+        self.status = status
+
+
+# Routes
+
+async def home(data, scope):
+    return {
+        "message": "Welcome to Sketchify.ai Single-Call API",
+        "endpoints": [
+            {"path": "/generate-prompt", "method": "POST", "description": "Generate an image from a sketch with a single API call"},
+            {"path": "/generate-batch", "method": "POST", "description": "Generate images for a list of sketches, streaming each result as it completes"},
+            {"path": "/jobs", "method": "POST", "description": "Queue a generation job and return its id immediately"},
+            {"path": "/jobs/<id>", "method": "GET", "description": "Job status and result (?wait=seconds to long-poll)"},
+            {"path": "/stats", "method": "GET", "description": "Runtime statistics for upstream connections and caches"},
+            {"path": "/breakers", "method": "GET", "description": "Circuit breaker state for each upstream"},
+            {"path": "/metrics", "method": "GET", "description": "Prometheus metrics: per-stage latency, in-flight stages, upstream errors, cache and fallback counts"}
+        ]
+    }, 200
+
+async def test(data, scope):
+    return {
+        "status": "connected",
+        "service_account": os.environ.get("GOOGLE_APPLICATION_CREDENTIALS") is not None,
+        "api_key": api_key is not None
+    }, 200
+
+async def stats(data, scope):
+    return {
+        "upstream": upstream_stats(),
+        "result_cache": result_cache.stats() if result_cache else None,
+        "sketch_index": sketch_index.stats() if sketch_index else None,
+        "analysis_memo": app_module.analysis_memo.stats() if app_module.analysis_memo else None,
+        "preprocess": sketch_preprocessor.stats() if sketch_preprocessor else None,
+        "ingest": sketch_ingestor.stats(),
+        "coalescing": in_flight.stats() if in_flight else None,
+        "hedging": app_module.image_hedger.stats() if app_module.image_hedger else None,
+        "providers": image_router.stats(),
+        "jobs": job_runner.stats(),
+        "logging": app_module.request_logger.stats(),
+        "transcode": app_module.image_transcoder.stats(),
+        "parsing": app_module.parse_stats.stats(),
+        "response_profiles": dict(app_module.profile_stats.stats(), active=app_module.GEMINI_RESPONSE_PROFILE),
+        "themes": app_module.theme_registry.stats(),
+        "prompt_budget": app_module.prompt_budget.stats(),
+        "admission": admission.stats() if admission else None
+    }, 200
+
+async def generate_prompt(data, scope):
+    if admission is None:
+        return await generate_prompt_response(data, scope)
+    try:
+        ticket = await admission.acquire_async()
+    except AdmissionRejected as e:
+        return {"error": str(e)}, 429, [(b"retry-after", str(e.retry_after).encode("latin-1"))]
+    try:
+        result = await generate_prompt_response(data, scope)
+    except BaseException:
+        ticket.release()
+        raise
+    if isinstance(result, StreamingBody):
+        # Streamed responses keep their slot until the last event is sent
+        result.chunks = release_after(result.chunks, ticket)
+    else:
+        ticket.release()
+    return result
+
+async def release_after(chunks, ticket):
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        ticket.release()
+
+async def generate_prompt_response(data, scope):
+    try:
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        requested = (query.get("stream") or [None])[0] or data.get("stream")
+        stream_format = requested_stream_format(_header(scope, b"accept"), requested)
+        if stream_format and data.get("image"):
+            # Opt-in streaming: title/description first, then the image, then timings
+            chunks = (
+                format_stream_event(stream_format, event, payload).encode("utf-8")
+                async for event, payload in step_runner.events(pipeline_events(data))
+            )
+            return StreamingBody(STREAM_MIMETYPES[stream_format], chunks, [(b"cache-control", b"no-cache")])
+
+        # Lets send_json time the response serialization under this request's labels
+        scope["metric_labels"] = request_metric_labels(data)
+        body, status = await run_generation(data)
+
+        requested = (query.get("response") or [None])[0] or data.get("response")
+        response_format = requested_response_format(_header(scope, b"accept"), requested)
+        if status == 200 and response_format and "image" in body:
+            with app_module.pipeline_metrics.stage("serialize", scope["metric_labels"]):
+                payload, content_type, headers = encode_binary_response(body, response_format)
+            return RawBody(content_type, payload, headers)
+        return body, status
+    except Exception as e:
+        logging.exception(f"Error: {e}")
+        return {"error": str(e)}, 500
+
+async def generate_batch(data, scope):
+    items, error = read_batch_request(data)
+    if error:
+        return {"error": error}, 400
+
+    logging.info(f"Batch of {len(items)} items")
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    requested = (query.get("stream") or [None])[0] or data.get("stream")
+    stream_format = requested_stream_format(_header(scope, b"accept"), requested) or "ndjson"
+    chunks = (
+        format_stream_event(stream_format, event, payload).encode("utf-8")
+        async for event, payload in step_runner.events(batch_events(items))
+    )
+    return StreamingBody(STREAM_MIMETYPES[stream_format], chunks, [(b"cache-control", b"no-cache")])
+
+async def breakers(data, scope):
+    return {
+        "breakers": app_module.upstream_breakers.stats(),
+        "retries": app_module.retry_policy.stats()
+    }, 200
+
+async def metrics(data, scope):
+    text = app_module.pipeline_metrics.render()
+    if admission is not None:
+        text += render_admission_metrics(admission.stats())
+    return RawBody(METRICS_CONTENT_TYPE, text.encode("utf-8"))
+
+async def create_job(data, scope):
+    try:
+        if not data.get("image"):
+            return {"error": "No image provided"}, 400
+        # Job stores may write to disk (see jobs.py); keep that off the event loop
+        job = await asyncio.to_thread(job_runner.submit, data)
+    except JobQueueFull as e:
+        return {"error": str(e)}, 503, [(b"retry-after", b"5")]
+    except Exception as e:
+        logging.exception(f"Error: {e}")
+        return {"error": str(e)}, 500
+
+    job["status_url"] = f"/jobs/{job['id']}"
+    return job, 202
+
+async def get_job(data, scope):
+    job_id = scope["path"][len("/jobs/"):]
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    wait = job_wait_seconds((query.get("wait") or [None])[0])
+
+    # Long-poll by checking the store instead of parking a thread per waiting client
+    deadline = time.monotonic() + wait
+    job = await asyncio.to_thread(job_runner.store.get, job_id)
+    while job is not None and job["status"] not in FINISHED and time.monotonic() < deadline:
+        await asyncio.sleep(0.25)
+        job = await asyncio.to_thread(job_runner.store.get, job_id)
+
+    if job is None:
+        return {"error": "Job not found"}, 404
+    return job, 200
+
+ROUTES = {
+    ("GET", "/"): home,
+    ("GET", "/test"): test,
+    ("POST", "/test"): test,
+    ("GET", "/stats"): stats,
+    ("GET", "/breakers"): breakers,
+    ("GET", "/metrics"): metrics,
+    ("POST", "/generate-prompt"): generate_prompt,
+    ("POST", "/generate-batch"): generate_batch,
+    ("POST", "/jobs"): create_job,
+}
+
+def resolve_route(method, path):
+    handler = ROUTES.get((method, path))
+    if handler is None and method == "GET" and path.startswith("/jobs/") and len(path) > len("/jobs/"):
+        handler = get_job
+    return handler
+
+
+# ASGI plumbing
+
+def _header(scope, name):
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+def _cors_headers(scope, preflight=False):
+    # Mirrors the permissive defaults flask_cors applies to app.py
+    headers = [(b"access-control-allow-origin", b"*")]
+    if preflight:
+        methods = _header(scope, b"access-control-request-method") or "GET, POST, OPTIONS"
+        headers.append((b"access-control-allow-methods", methods.encode("latin-1")))
+        requested = _header(scope, b"access-control-request-headers")
+        if requested:
+            headers.append((b"access-control-allow-headers", requested.encode("latin-1")))
+    return headers
+
+async def _read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise ValueError("Request body too large")
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+async def send_json(send, scope, body, status, extra_headers=()):
+    labels = scope.get("metric_labels")
+    if labels is None:
+        payload = json.dumps(body).encode("utf-8")
+    else:
+        with app_module.pipeline_metrics.stage("serialize", labels):
+            payload = json.dumps(body).encode("utf-8")
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(payload)).encode("latin-1")),
+    ] + list(extra_headers) + _cors_headers(scope)
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": payload})
+
+async def send_raw(send, scope, raw_body):
+    headers = [
+        (b"content-type", raw_body.content_type.encode("latin-1")),
+        (b"content-length", str(len(raw_body.payload)).encode("latin-1")),
+    ] + raw_body.headers + _cors_headers(scope)
+    await send({"type": "http.response.start", "status": raw_body.status, "headers": headers})
+    await send({"type": "http.response.body", "body": raw_body.payload})
+
+async def send_stream(send, scope, streaming_body):
+    headers = [(b"content-type", streaming_body.mimetype.encode("latin-1"))] + streaming_body.headers + _cors_headers(scope)
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    try:
+        async for chunk in streaming_body.chunks:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        # Runs the generator's cleanup now rather than at garbage collection if the client went away
+        await streaming_body.chunks.aclose()
+    await send({"type": "http.response.body", "body": b""})
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await get_manager().aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    # One sampled, redacted log line per request (see request_log.py)
+    start = time.perf_counter()
+    request_info = {"status": 500, "body_bytes": None, "payload": None}
+
+    async def send_logged(message):
+        if message["type"] == "http.response.start":
+            request_info["status"] = message["status"]
+        await send(message)
+
+    try:
+        await _handle_http(scope, receive, send_logged, request_info)
+    finally:
+        app_module.request_logger.log(
+            scope["method"], scope["path"], request_info["status"], (time.perf_counter() - start) * 1000,
+            body_bytes=request_info["body_bytes"], payload=request_info["payload"],
+        )
+
+async def _handle_http(scope, receive, send, request_info):
+    method = scope["method"]
+    path = scope["path"]
+
+    if method == "OPTIONS":
+        await send({"type": "http.response.start", "status": 200, "headers": _cors_headers(scope, preflight=True)})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    handler = resolve_route(method, path)
+    if handler is None:
+        if any(route_path == path for _, route_path in ROUTES):
+            await send_json(send, scope, {"error": "Method not allowed"}, 405)
+        else:
+            await send_json(send, scope, {"error": "Not found"}, 404)
+        return
+
+    try:
+        raw_body = await _read_body(receive)
+    except ValueError as e:
+        await send_json(send, scope, {"error": str(e)}, 413)
+        return
+    if raw_body is None:
+        # Client went away before sending the whole body
+        request_info["status"] = 499
+        return
+    request_info["body_bytes"] = len(raw_body)
+
+    data = None
+    if method == "POST":
+        content_type = _header(scope, b"content-type") or ""
+        try:
+            if is_binary_upload(content_type.split(";")[0].strip().lower()):
+                # Multipart and raw image uploads (see transport.py)
+                query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+                data = read_binary_upload(raw_body, content_type, lambda name: query.get(name, []))
+            else:
+                data = json.loads(raw_body or b"null")
+        except ValueError as e:
+            # Malformed JSON or uploads are the client's fault, as in Flask
+            await send_json(send, scope, {"error": f"Invalid request body: {e}"}, 400)
+            return
+    request_info["payload"] = data
+
+    result = await handler(data, scope)
+    if isinstance(result, StreamingBody):
+        await send_stream(send, scope, result)
+        return
+    if isinstance(result, RawBody):
+        await send_raw(send, scope, result)
+        return
+    # Routes return (body, status) or (body, status, extra_headers)
+    body, status, *extra_headers = result
+    await send_json(send, scope, body, status, *extra_headers)
@@ -0,0 +1,111 @@
+"""
+Single-flight coalescing of identical in-flight generations.
+
+Repeated taps on "generate" and mobile retries start the same pipeline while
+the first one is still running. The first request for a key becomes the
+leader and runs the pipeline; identical requests arriving before it finishes
+join its flight and receive the leader's outcome instead of calling Gemini
+and Imagen again. Flights can be awaited from threads (Flask, job workers)
+and from the asyncio server alike.
+"""
+import os
+import asyncio
+import threading
+
+# Upstream calls made by one uncached pipeline run (Gemini + Imagen)
+UPSTREAM_CALLS_PER_RUN = 2
+
+
+class Flight:
+    """One in-flight pipeline run; its outcome is set once by the leader."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._callbacks = []
+        self.outcome = None
+
+    def set_outcome(self, outcome):
+        with self._lock:
+            self.outcome = outcome
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(outcome)
+
+    def wait(self, timeout=None):
+        """Block until the leader finishes; returns its outcome or None on timeout."""
+        if self._done.wait(timeout):
+            return self.outcome
+        return None
+
+    async def wait_async(self, timeout=None):
+        """Async version of wait() that doesn't tie up a thread while waiting."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(outcome):
+            try:
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(outcome))
+            except RuntimeError:
+                # The waiting loop has already shut down
+                pass
+
+        with self._lock:
+            if self._done.is_set():
+                return self.outcome
+            self._callbacks.append(resolve)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class SingleFlight:
+    def __init__(self, wait_timeout=120):
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._counters = {"leaders": 0, "coalesced": 0, "reruns": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(wait_timeout=float(os.environ.get("COALESCE_WAIT_SECONDS", 120)))
+
+    def join(self, key):
+        """
+        Returns (flight, is_leader). The leader must call finish() exactly
+        once; everyone else waits on the flight.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._counters["coalesced"] += 1
+                return flight, False
+            flight = Flight()
+            self._flights[key] = flight
+            self._counters["leaders"] += 1
+            return flight, True
+
+    def finish(self, key, flight, outcome):
+        """
+        Publish the leader's outcome. None tells followers the leader gave up
+        (e.g. the streaming client disconnected) and they should run their own.
+        """
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.set_outcome(outcome)
+
+    def record_rerun(self):
+        """A follower timed out or its leader gave up, so it ran the pipeline itself."""
+        with self._lock:
+            self._counters["reruns"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["in_flight"] = len(self._flights)
+        stats["upstream_calls_saved"] = (stats["coalesced"] - stats["reruns"]) * UPSTREAM_CALLS_PER_RUN
+        stats["wait_timeout"] = self.wait_timeout
+        return stats
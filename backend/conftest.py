@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+def chat_response(content, usage=None):
+    """A chat completion shaped like the OpenAI client's"""
+    message = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+def image_response(b64_json):
+    """An image generation response shaped like the OpenAI client's"""
+    return SimpleNamespace(data=[SimpleNamespace(b64_json=b64_json)])
+
+
+class FakeUpstream:
+    """
+    Stands in for the upstream client and the one-pass Gemini call.
+
+    `analysis` replaces the one-pass call: a dict, or a callable taking its
+    keyword arguments. Left as None, the real call runs against the fake chat
+    endpoint, which answers with `chat` (a string, or a callable taking the
+    request). Images come back as `image`, which may also be a callable taking
+    the request. Every call is appended to `calls`
+    and its keyword arguments to `requests[name]`.
+    """
+
+    def __init__(self, analysis=None, chat=None, image="aW1n", usage=None, is_async=False):
+        self.analysis = analysis
+        self.chat_content = chat
+        self.image = image
+        self.usage = usage
+        self.calls = []
+        self.requests = {"gemini": [], "chat": [], "imagen": []}
+        if is_async:
+            async def create(**kwargs):
+                return self._chat(kwargs)
+
+            async def generate(**kwargs):
+                return self._generate(kwargs)
+        else:
+            def create(**kwargs):
+                return self._chat(kwargs)
+
+            def generate(**kwargs):
+                return self._generate(kwargs)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+        self.images = SimpleNamespace(generate=generate)
+
+    def _record(self, name, kwargs):
+        self.calls.append(name)
+        self.requests[name].append(kwargs)
+
+    def _chat(self, kwargs):
+        self._record("chat", kwargs)
+        content = self.chat_content(kwargs) if callable(self.chat_content) else self.chat_content
+        return chat_response(content, self.usage)
+
+    def _generate(self, kwargs):
+        self._record("imagen", kwargs)
+        return image_response(self.image(kwargs) if callable(self.image) else self.image)
+
+    def gemini(self, kwargs):
+        """The replacement one-pass result, or None to run the real call."""
+        if self.analysis is None:
+            return None
+        self._record("gemini", kwargs)
+        return self.analysis(**kwargs) if callable(self.analysis) else dict(self.analysis)
+
+
+# Options for FakeUpstream can be passed with indirect parametrization:
+# @pytest.mark.parametrize("fake_upstream", [{"analysis": {...}}], indirect=True)
+@pytest.fixture
+def fake_upstream(request, monkeypatch):
+    """Route the Flask app's upstream calls to a FakeUpstream"""
+    import app as app_module
+
+    upstream = FakeUpstream(**getattr(request, "param", {}))
+    real_gemini = app_module.all_in_one_gemini_request
+
+    def gemini(**kwargs):
+        result = upstream.gemini(kwargs)
+        return real_gemini(**kwargs) if result is None else result
+
+    monkeypatch.setattr(app_module, "all_in_one_gemini_request", gemini)
+    monkeypatch.setattr(app_module, "get_client", lambda: upstream)
+    return upstream
+
+
+@pytest.fixture
+def fake_async_upstream(request, monkeypatch):
+    """Route the ASGI app's upstream calls to an async FakeUpstream"""
+    import asgi_app
+
+    upstream = FakeUpstream(**getattr(request, "param", {}), is_async=True)
+    real_gemini = asgi_app.all_in_one_gemini_request
+
+    async def gemini(**kwargs):
+        result = upstream.gemini(kwargs)
+        return await real_gemini(**kwargs) if result is None else result
+
+    monkeypatch.setattr(asgi_app, "all_in_one_gemini_request", gemini)
+    monkeypatch.setattr(asgi_app, "get_client", lambda: upstream)
+    return upstream
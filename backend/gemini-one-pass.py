@@ -7,19 +7,20 @@ from dotenv import load_dotenv
 from io import BytesIO
 from PIL import Image
 import requests
-from openai import OpenAI
 import traceback
 import binascii
 import json
 import re
+from upstream import GEMINI_BASE_URL, get_client as get_upstream_client
 from themes import get_theme_prompt, THEMES
+from request_log import RequestLogger, configure_logging, install_flask_hooks
 
 load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Structured JSON logging through a background writer (see request_log.py)
+configure_logging()
 
 # Path to service account key file
 SERVICE_ACCOUNT_KEY_PATH = os.path.join(os.path.dirname(__file__), "sketchify-service-key.json")
@@ -33,10 +34,7 @@ gemini_model = "gemini-2.0-flash"
 imagen_model = "imagen-3.0-generate-002" 
 
 def get_client():
-    return OpenAI(
-        api_key=api_key,
-        base_url="https://generativelanguage.googleapis.com/v1beta/openai/"
-    )
+    return get_upstream_client(api_key=api_key, base_url=GEMINI_BASE_URL)
 
 def create_transformation_prompt(theme_name, theme_context, theme_prompt, user_prompt=""):
     """
@@ -197,18 +195,8 @@ def home():
         ]
     })
 
-@app.before_request
-def log_request_info():
-    app.logger.debug('Headers: %s', request.headers)
-    app.logger.debug('Body: %s', request.get_data())
-    app.logger.debug('Path: %s', request.path)
-    if request.path == '/generate-prompt' and request.method == 'POST':
-        app.logger.debug('Theme: %s', request.json.get('theme'))
-
-@app.after_request
-def log_response_info(response):
-    app.logger.debug('Response Status: %s', response.status)
-    return response
+# One sampled, redacted log line per request instead of dumping headers and bodies
+install_flask_hooks(app, RequestLogger.from_env())
 
 @app.route('/test', methods=['GET', 'POST'])
 def test():
@@ -227,7 +215,6 @@ def generate_prompt():
     """
     try:
         data = request.json
-        print("Full request data:", data)
 
         image_data = data.get("image")
         theme_data = data.get("theme", "Default")
@@ -7,19 +7,22 @@ from dotenv import load_dotenv
 from io import BytesIO
 from PIL import Image
 import requests
-from openai import OpenAI
 import traceback
 import binascii
 import requests
 import json
+from openai import NOT_GIVEN
+from upstream import GEMINI_BASE_URL, get_client as get_upstream_client
+from titles import generate_with_title, local_title, remaining
 from themes import get_theme_prompt
+from request_log import RequestLogger, configure_logging, install_flask_hooks
 
 load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Structured JSON logging through a background writer (see request_log.py)
+configure_logging()
 
 # Path to service account key file
 SERVICE_ACCOUNT_KEY_PATH = os.path.join(os.path.dirname(__file__), "sketchify-service-key.json")
@@ -33,15 +36,17 @@ gemini_model = "gemini-2.0-flash"
 imagen_model = "imagen-3.0-generate-002" 
 
 def get_client():
-    return OpenAI(
-        api_key=api_key,
-        base_url="https://generativelanguage.googleapis.com/v1beta/openai/"
-    )
+    return get_upstream_client(api_key=api_key, base_url=GEMINI_BASE_URL)
 
-def generate_title_from_description(description, theme):
+def generate_title_from_description(description, theme, deadline=None):
     """
     Generate a descriptive title based on the actual content of the image description.
+    When a time.monotonic() deadline is given, every call is bounded by it and
+    the retry/fallback calls are skipped once it has passed.
     """
+    def time_left():
+        return NOT_GIVEN if deadline is None else remaining(deadline)
+
     client = get_client()
     
     prompt = f"""
@@ -74,7 +79,8 @@ def generate_title_from_description(description, theme):
                     "content": prompt
                 }
             ],
-            max_tokens=15  
+            max_tokens=15,
+            timeout=time_left()  
         )
         
         title = response.choices[0].message.content.strip()
@@ -82,7 +88,7 @@ def generate_title_from_description(description, theme):
         title = title.strip('"\'')
         
         # If the title is still generic, extract key elements from description as fallback
-        if any(generic in title.lower() for generic in ["ai", "sketch", "art", "creative", "artistic", theme.lower()]):
+        if any(generic in title.lower() for generic in ["ai", "sketch", "art", "creative", "artistic", theme.lower()]) and time_left() != 0:
             # Try one more time with stronger instructions
             retry_prompt = f"""
             The image description is: "{description}"
@@ -105,7 +111,8 @@ def generate_title_from_description(description, theme):
                         "content": retry_prompt
                     }
                 ],
-                max_tokens=15
+                max_tokens=15,
+                timeout=time_left()
             )
             
             title = retry_response.choices[0].message.content.strip().strip('"\'')
@@ -114,6 +121,8 @@ def generate_title_from_description(description, theme):
     except Exception as e:
         logging.error(f"Error generating title: {e}")
         # Extract key nouns from description as fallback
+        if time_left() == 0:
+            return local_title(description, theme)
         try:
             # Use a simpler prompt to get key subject
             key_elements_prompt = f"What is the main subject of this image: {description[:100]}? Answer in 2-4 words ONLY."
@@ -121,7 +130,8 @@ def generate_title_from_description(description, theme):
                 model=gemini_model,
                 temperature=0.1,
                 messages=[{"role": "user", "content": key_elements_prompt}],
-                max_tokens=10
+                max_tokens=10,
+                timeout=time_left()
             )
             subject = simple_response.choices[0].message.content.strip().strip('"\'')
             return subject
@@ -138,18 +148,8 @@ def home():
         ]
     })
 
-@app.before_request
-def log_request_info():
-    app.logger.debug('Headers: %s', request.headers)
-    app.logger.debug('Body: %s', request.get_data())
-    app.logger.debug('Path: %s', request.path)
-    if request.path == '/generate-prompt' and request.method == 'POST':
-        app.logger.debug('Theme: %s', request.json.get('theme'))
-
-@app.after_request
-def log_response_info(response):
-    app.logger.debug('Response Status: %s', response.status)
-    return response
+# One sampled, redacted log line per request instead of dumping headers and bodies
+install_flask_hooks(app, RequestLogger.from_env())
 
 @app.route('/test', methods=['GET', 'POST'])
 def test():
@@ -271,20 +271,25 @@ def generate_prompt():
             print(f"Generated description: {description}")
             
             # Generate image using Imagen
-            imagen_response = client.images.generate(
-                model=imagen_model,
-                prompt=description,
-                response_format='b64_json',
-                n=1,
-                quality= quality,
+            def generate_image(deadline):
+                return client.images.generate(
+                    model=imagen_model,
+                    prompt=description,
+                    response_format='b64_json',
+                    n=1,
+                    quality= quality,
+                    timeout=remaining(deadline),
+                )
+            
+            # Generate a creative title based on the description while the image renders
+            imagen_response, title, title_source = generate_with_title(
+                generate_image, generate_title_from_description, description, theme_data
             )
+            logging.info(f"Title ({title_source}): {title}")
             
             # Extract the image
             img_base64 = imagen_response.data[0].b64_json
             
-            # Generate a creative title based on the description
-            title = generate_title_from_description(description, theme_data)
-            
             return jsonify({
                 "image": img_base64,
                 "description": description,
@@ -3,28 +3,37 @@ from flask import Flask, request, json, jsonify
 import base64
 from flask_cors import CORS
 import logging
-import requests
-from openai import OpenAI
-import openai
 from dotenv import load_dotenv
 load_dotenv()
 from io import BytesIO
 from PIL import Image
 import traceback
 from themes import get_theme_prompt
+from openai import NOT_GIVEN
+from upstream import get_client, get_http_session, get_manager
+from titles import generate_with_title, local_title, remaining
+from request_log import RequestLogger, configure_logging, install_flask_hooks
 
 app = Flask(__name__)
-openai.api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI()
+# Shared clients backed by the process-wide keep-alive pool (see upstream.py)
+client = get_client(api_key=os.getenv("OPENAI_API_KEY"), base_url=None)
 CORS(app)
 
+# Structured JSON logging through a background writer (see request_log.py)
+configure_logging()
+
 stable_diffusion_api_url = 'https://api.stability.ai/v2beta/stable-image/generate/ultra'
 stable_diffusion_apiKey = os.getenv("STABILITY_API_KEY")
 
-def generate_title_from_description(description, theme):
+def generate_title_from_description(description, theme, deadline=None):
     """
     Generate a descriptive title based on the actual content of the image description.
+    When a time.monotonic() deadline is given, every call is bounded by it and
+    the retry/fallback calls are skipped once it has passed.
     """
+    def time_left():
+        return NOT_GIVEN if deadline is None else remaining(deadline)
+
     prompt = f"""
     Analyze this image description and create a specific, descriptive title (4-8 words) that focuses on the EXACT SUBJECT and CONTENT of the image. 
     
@@ -55,7 +64,8 @@ def generate_title_from_description(description, theme):
                     "content": prompt
                 }
             ],
-            max_tokens=15  # Keep it concise
+            max_tokens=15,  # Keep it concise
+            timeout=time_left()
         )
         
         title = response.choices[0].message.content.strip()
@@ -63,7 +73,7 @@ def generate_title_from_description(description, theme):
         title = title.strip('"\'')
         
         # If the title is still generic, extract key elements from description as fallback
-        if any(generic in title.lower() for generic in ["ai", "sketch", "art", "creative", "artistic", theme.lower()]):
+        if any(generic in title.lower() for generic in ["ai", "sketch", "art", "creative", "artistic", theme.lower()]) and time_left() != 0:
             # Try one more time with stronger instructions
             retry_prompt = f"""
             The image description is: "{description}"
@@ -86,7 +96,8 @@ def generate_title_from_description(description, theme):
                         "content": retry_prompt
                     }
                 ],
-                max_tokens=15
+                max_tokens=15,
+                timeout=time_left()
             )
             
             title = retry_response.choices[0].message.content.strip().strip('"\'')
@@ -95,6 +106,8 @@ def generate_title_from_description(description, theme):
     except Exception as e:
         logging.error(f"Error generating title: {e}")
         # Extract key nouns from description as fallback
+        if time_left() == 0:
+            return local_title(description, theme)
         try:
             # Use a simpler prompt to get key subject
             key_elements_prompt = f"What is the main subject of this image: {description[:100]}? Answer in 2-4 words ONLY."
@@ -102,7 +115,8 @@ def generate_title_from_description(description, theme):
                 model="gpt-4o-mini",
                 temperature=0.1,
                 messages=[{"role": "user", "content": key_elements_prompt}],
-                max_tokens=10
+                max_tokens=10,
+                timeout=time_left()
             )
             subject = simple_response.choices[0].message.content.strip().strip('"\'')
             return subject
@@ -119,16 +133,8 @@ def home():
         ]
     })
 
-@app.before_request
-def log_request_info():
-    app.logger.debug('Headers: %s', request.headers)
-    app.logger.debug('Body: %s', request.get_data())
-    app.logger.debug('Path: %s', request.path)
-
-@app.after_request
-def log_response_info(response):
-    app.logger.debug('Response Status: %s', response.status)
-    return response
+# One sampled, redacted log line per request instead of dumping headers and bodies
+install_flask_hooks(app, RequestLogger.from_env())
 
 @app.route('/test', methods=['GET', 'POST'])
 def test():
@@ -224,24 +230,29 @@ def generate_prompt():
             description = gpt_response.choices[0].message.content
             print(f"Generated description: {description}")
             
-            # Generate a title based on the description
-            title = generate_title_from_description(description, theme_data)
-            
             # Generate image using Stability AI
-            stability_response = requests.post(
-                stable_diffusion_api_url,
-                headers={
-                    "authorization": f"Bearer {stable_diffusion_apiKey}",
-                    "accept": "image/*"
-                },
-                files={"none": ' '},
-                data={
-                    "prompt": description,
-                    "output_format": "jpeg",
-                    "style_preset": "photographic",
-                    "steps": 40
-                },
+            def generate_image(deadline):
+                return get_http_session().post(
+                    stable_diffusion_api_url,
+                    headers={
+                        "authorization": f"Bearer {stable_diffusion_apiKey}",
+                        "accept": "image/*"
+                    },
+                    files={"none": ' '},
+                    data={
+                        "prompt": description,
+                        "output_format": "jpeg",
+                        "style_preset": "photographic",
+                        "steps": 40
+                    },
+                    timeout=(get_manager().connect_timeout, remaining(deadline)),
+                )
+            
+            # Generate a title based on the description while the image renders
+            stability_response, title, title_source = generate_with_title(
+                generate_image, generate_title_from_description, description, theme_data
             )
+            logging.info(f"Title ({title_source}): {title}")
             
             if stability_response.status_code != 200:
                 logging.error(f"Error from Stability AI: {stability_response.text}")
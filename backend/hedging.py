@@ -0,0 +1,218 @@
+"""
+Hedged upstream calls.
+
+A slow Imagen call now and then dominates our p99. When the first call has
+not returned within an adaptive delay (by default the rolling p90 latency of
+its quality tier) a second identical call is fired and whichever returns
+first wins. The loser is cancelled when running on asyncio and ignored when
+running on a thread. Hedges are capped by a per-minute budget so an
+upstream slowdown can't double our traffic.
+
+Threaded calls run on the hedge executor, sized at two workers per pipeline
+thread. The delay counts from when the primary starts running, not from when
+it was queued, and no hedge is fired while every worker is busy, since a
+queued hedge only adds load. Every finished call is sampled, losers too; a
+cancelled loser counts with the time it had run, a lower bound.
+"""
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+    FIRST_COMPLETED,
+    wait,
+)
+
+
+class Hedger:
+    def __init__(self, percentile=0.9, window=200, min_samples=20, initial_delay=None,
+                 min_delay=0.5, budget_per_minute=10, workers=16):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        # Delay to use before a tier has min_samples latencies (None: don't hedge yet)
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.budget_per_minute = budget_per_minute
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hedge")
+        self._lock = threading.Lock()
+        # Calls submitted to the executor and not finished yet
+        self._outstanding = 0
+        # tier -> recent latencies in seconds
+        self._latencies = {}
+        # time.monotonic() of each hedge fired in the last minute
+        self._fired_at = deque()
+        self._counters = {"calls": 0, "fired": 0, "won": 0, "budget_exhausted": 0, "saturated": 0}
+
+    @classmethod
+    def from_env(cls, pipeline_threads=8):
+        """pipeline_threads is how many threads can make image calls at once (see upstream.pipeline_threads)."""
+        initial_delay = float(os.environ.get("HEDGE_INITIAL_DELAY", 0))
+        return cls(
+            percentile=float(os.environ.get("HEDGE_PERCENTILE", 0.9)),
+            window=int(os.environ.get("HEDGE_WINDOW", 200)),
+            min_samples=int(os.environ.get("HEDGE_MIN_SAMPLES", 20)),
+            initial_delay=initial_delay or None,
+            min_delay=float(os.environ.get("HEDGE_MIN_DELAY", 0.5)),
+            budget_per_minute=int(os.environ.get("HEDGE_BUDGET_PER_MINUTE", 10)),
+            # A primary and a hedge per calling thread
+            workers=int(os.environ.get("HEDGE_WORKERS", 2 * pipeline_threads)),
+        )
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _record(self, tier, seconds):
+        with self._lock:
+            samples = self._latencies.get(tier)
+            if samples is None:
+                samples = self._latencies[tier] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def _quantile(self, samples):
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * self.percentile), len(ordered) - 1)]
+
+    def delay(self, tier):
+        """Seconds to wait before hedging a call in this tier, or None to not hedge."""
+        with self._lock:
+            samples = self._latencies.get(tier, ())
+            if len(samples) < self.min_samples:
+                return self.initial_delay
+            return max(self._quantile(samples), self.min_delay)
+
+    def _take_budget(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._fired_at and now - self._fired_at[0] > 60:
+                self._fired_at.popleft()
+            if len(self._fired_at) >= self.budget_per_minute:
+                self._counters["budget_exhausted"] += 1
+                return False
+            self._fired_at.append(now)
+            self._counters["fired"] += 1
+            return True
+
+    def _timed(self, tier, fn, started=None):
+        if started is not None:
+            started.set()
+        begin = time.monotonic()
+        result = fn()
+        self._record(tier, time.monotonic() - begin)
+        return result
+
+    async def _timed_async(self, tier, make_call):
+        begin = time.monotonic()
+        try:
+            result = await make_call()
+        except asyncio.CancelledError:
+            # A cancelled loser took at least this long
+            self._record(tier, time.monotonic() - begin)
+            raise
+        self._record(tier, time.monotonic() - begin)
+        return result
+
+    def _submit(self, tier, fn, started=None):
+        with self._lock:
+            self._outstanding += 1
+        future = self._executor.submit(self._timed, tier, fn, started)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self._outstanding -= 1
+
+    def _saturated(self):
+        with self._lock:
+            saturated = self._outstanding >= self.workers
+            if saturated:
+                self._counters["saturated"] += 1
+            return saturated
+
+    def call(self, tier, fn):
+        """Run fn() with a hedge fired after delay(tier); returns the first successful result."""
+        self._count("calls")
+        delay = self.delay(tier)
+        if delay is None:
+            return self._timed(tier, fn)
+
+        started = threading.Event()
+        primary = self._submit(tier, fn, started)
+        # Time spent waiting for a worker is not upstream latency
+        started.wait()
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+
+        if self._saturated() or not self._take_budget():
+            return primary.result()
+
+        hedge = self._submit(tier, fn)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    self._count("won")
+                # A call that is already running can't be stopped; it finishes in the background
+                for other in pending:
+                    other.cancel()
+                return result
+        raise error
+
+    async def call_async(self, tier, make_call):
+        """Async version of call(); make_call() returns a fresh awaitable each time."""
+        self._count("calls")
+        delay = self.delay(tier)
+        if delay is None:
+            return await self._timed_async(tier, make_call)
+
+        primary = asyncio.ensure_future(self._timed_async(tier, make_call))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self._take_budget():
+            return await primary
+
+        hedge = asyncio.ensure_future(self._timed_async(tier, make_call))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    if task is hedge:
+                        self._count("won")
+                    return result
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            tiers = {tier: len(samples) for tier, samples in self._latencies.items()}
+        stats["budget_per_minute"] = self.budget_per_minute
+        stats["workers"] = self.workers
+        stats["tiers"] = {}
+        for tier, samples in tiers.items():
+            delay = self.delay(tier)
+            stats["tiers"][tier] = {"samples": samples, "delay_ms": round(delay * 1000, 1) if delay else None}
+        return stats
@@ -0,0 +1,217 @@
+"""
+Sketch ingestion for /generate-prompt.
+
+Most canvases already arrive as clean base64 PNG, so re-encoding them through
+PIL is wasted work. The format is sniffed from the header bytes and the PNG
+structure and dimensions are checked without decoding pixels. A clean PNG is
+forwarded with its original base64 untouched ("passthrough"). A PNG whose
+base64 needed fixing only gets re-encoded to base64 ("rebased"). Anything
+else goes through the full PIL normalization ("normalized"). Binary uploads
+(see transport.py) arrive as bytes and skip the base64 decode altogether.
+
+Passthrough skips the PIL encode here, not pixel decoding: with the sketch
+index and preprocessor on (the default), pixels are still decoded for the
+perceptual hash and preprocessing, and the original base64 only reaches
+Gemini when preprocessing leaves the canvas unchanged (see preprocess.py).
+"""
+import os
+import time
+import base64
+import struct
+import binascii
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IEND = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+# Valid (color type -> allowed bit depths) combinations from the PNG spec
+PNG_BIT_DEPTHS = {
+    0: (1, 2, 4, 8, 16),
+    2: (8, 16),
+    3: (1, 2, 4, 8),
+    4: (8, 16),
+    6: (8, 16),
+}
+
+PATHS = ("passthrough", "rebased", "normalized")
+
+
+def sniff_format(header):
+    """Identify an image format from its first bytes."""
+    if header.startswith(PNG_SIGNATURE):
+        return "png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[:2] == b"BM":
+        return "bmp"
+    if header[4:12] in (b"ftypavif", b"ftypavis"):
+        return "avif"
+    return None
+
+
+def png_dimensions(data):
+    """
+    (width, height) from a PNG's IHDR chunk, or None if the header is not a
+    well-formed PNG header.
+    """
+    if len(data) < 33 or not data.startswith(PNG_SIGNATURE):
+        return None
+    length, chunk_type = struct.unpack(">I4s", data[8:16])
+    if length != 13 or chunk_type != b"IHDR":
+        return None
+    width, height, bit_depth, color_type, compression, filter_method, interlace = struct.unpack(">IIBBBBB", data[16:29])
+    if width == 0 or height == 0:
+        return None
+    if bit_depth not in PNG_BIT_DEPTHS.get(color_type, ()):
+        return None
+    if compression != 0 or filter_method != 0 or interlace not in (0, 1):
+        return None
+    crc = struct.unpack(">I", data[29:33])[0]
+    if binascii.crc32(data[12:29]) & 0xFFFFFFFF != crc:
+        return None
+    return width, height
+
+
+def strip_data_url(image_data):
+    """Return (media_type or None, base64 payload) without splitting the whole string."""
+    comma = image_data.find(",", 0, 256)
+    if comma == -1:
+        return None, image_data
+    header = image_data[:comma]
+    media_type = header[5:].split(";")[0] if header.startswith("data:") else None
+    return media_type, image_data[comma + 1:]
+
+
+class IngestedSketch:
+    """A decoded canvas ready for the pipeline; the PIL image is opened lazily."""
+
+    def __init__(self, base64_data, png_bytes, width, height, path, image=None, timings=None):
+        self.base64 = base64_data
+        self.png_bytes = png_bytes
+        self.width = width
+        self.height = height
+        self.path = path
+        self._image = image
+        # Seconds spent per step: "decode" (base64) and "normalize" (re-encoding)
+        self.timings = timings or {}
+
+    @property
+    def image(self):
+        if self._image is None:
+            # Image.open only parses the header; pixels decode on first use
+            self._image = Image.open(BytesIO(self.png_bytes))
+        return self._image
+
+
+class SketchIngestor:
+    def __init__(self, max_pixels=40_000_000):
+        self.max_pixels = max_pixels
+        self._lock = threading.Lock()
+        self._counters = {path: 0 for path in PATHS}
+        self._counters["rejected"] = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(max_pixels=int(os.environ.get("SKETCH_MAX_PIXELS", 40_000_000)))
+
+    def _count(self, path):
+        with self._lock:
+            self._counters[path] += 1
+
+    def _check_size(self, width, height):
+        if width * height > self.max_pixels:
+            raise ValueError(f"Image is too large ({width}x{height})")
+
+    def ingest(self, image_data):
+        try:
+            return self._ingest(image_data)
+        except Exception:
+            self._count("rejected")
+            raise
+
+    def _ingest(self, image_data):
+        start = time.perf_counter()
+        if isinstance(image_data, (bytes, bytearray)):
+            return self._ingest_bytes(bytes(image_data), start)
+        media_type, image_base64 = strip_data_url(image_data)
+
+        # Fast path: strictly valid base64 of a structurally valid PNG
+        png_bytes = None
+        if len(image_base64) % 4 == 0 and media_type in (None, "image/png"):
+            try:
+                png_bytes = base64.b64decode(image_base64, validate=True)
+            except binascii.Error:
+                png_bytes = None
+        if png_bytes is not None and self._is_clean_png(png_bytes):
+            width, height = png_dimensions(png_bytes)
+            self._check_size(width, height)
+            self._count("passthrough")
+            timings = {"decode": time.perf_counter() - start}
+            return IngestedSketch(image_base64, png_bytes, width, height, "passthrough", timings=timings)
+
+        # Lenient decode, as the original handler did
+        missing_padding = len(image_base64) % 4
+        if missing_padding:
+            image_base64 += "=" * (4 - missing_padding)
+        if png_bytes is None:
+            # Without validate, characters outside the alphabet are skipped
+            png_bytes = base64.b64decode(image_base64)
+        decoded = time.perf_counter()
+        timings = {"decode": decoded - start}
+
+        if self._is_clean_png(png_bytes):
+            width, height = png_dimensions(png_bytes)
+            self._check_size(width, height)
+            self._count("rebased")
+            clean_base64 = base64.b64encode(png_bytes).decode("utf-8")
+            timings["normalize"] = time.perf_counter() - decoded
+            return IngestedSketch(clean_base64, png_bytes, width, height, "rebased", timings=timings)
+
+        return self._normalize(png_bytes, timings, decoded)
+
+    def _ingest_bytes(self, data, start):
+        """A multipart or raw image upload: already binary, so there is nothing to decode."""
+        timings = {}
+        if self._is_clean_png(data):
+            width, height = png_dimensions(data)
+            self._check_size(width, height)
+            self._count("passthrough")
+            # Gemini still takes the image as base64
+            clean_base64 = base64.b64encode(data).decode("utf-8")
+            timings["normalize"] = time.perf_counter() - start
+            return IngestedSketch(clean_base64, data, width, height, "passthrough", timings=timings)
+        return self._normalize(data, timings, start)
+
+    def _normalize(self, png_bytes, timings, decoded):
+        # Slow path: re-save through PIL so the upstream always gets clean PNG data
+        image = Image.open(BytesIO(png_bytes))
+        self._check_size(*image.size)
+        buffered = BytesIO()
+        image.save(buffered, format="PNG")
+        image_bytes = buffered.getvalue()
+        self._count("normalized")
+        clean_base64 = base64.b64encode(image_bytes).decode("utf-8")
+        timings["normalize"] = time.perf_counter() - decoded
+        return IngestedSketch(
+            clean_base64, image_bytes,
+            image.width, image.height, "normalized", image=image, timings=timings,
+        )
+
+    @staticmethod
+    def _is_clean_png(data):
+        return sniff_format(data[:16]) == "png" and data.endswith(PNG_IEND) and png_dimensions(data) is not None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        total = sum(stats[path] for path in PATHS)
+        stats["passthrough_rate"] = round(stats["passthrough"] / total, 4) if total else 0.0
+        stats["max_pixels"] = self.max_pixels
+        return stats
@@ -0,0 +1,266 @@
+"""
+Asynchronous generation jobs.
+
+POST /jobs hands the /generate-prompt payload to a bounded in-process worker
+pool and returns a job id straight away; GET /jobs/<id> reports the status and
+result, optionally long-polling until the job finishes. Job records live in a
+pluggable store: in memory by default, or SQLite so finished results survive
+restarts.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED = (SUCCEEDED, FAILED)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def new_job(job_id):
+    now = time.time()
+    return {
+        "id": job_id,
+        "status": QUEUED,
+        "created_at": now,
+        "updated_at": now,
+        "status_code": None,
+        "result": None,
+        "error": None,
+    }
+
+
+class MemoryJobStore:
+    """Job records in a dict; finished jobs are dropped after `ttl` seconds."""
+
+    def __init__(self, ttl=3600, max_jobs=10000):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        # Least recently updated first, so expiry only looks at the stale end
+        self._jobs = OrderedDict()
+        self._changed = threading.Condition()
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        stale = []
+        for job_id, job in self._jobs.items():
+            if job["updated_at"] >= cutoff:
+                break
+            if job["status"] in FINISHED:
+                stale.append(job_id)
+        for job_id in stale:
+            del self._jobs[job_id]
+        while len(self._jobs) > self.max_jobs:
+            self._jobs.popitem(last=False)
+
+    def create(self, job_id):
+        with self._changed:
+            self._expire()
+            job = new_job(job_id)
+            self._jobs[job_id] = job
+            return dict(job)
+
+    def update(self, job_id, **fields):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields, updated_at=time.time())
+            self._jobs.move_to_end(job_id)
+            self._changed.notify_all()
+
+    def get(self, job_id):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait(self, job_id, timeout):
+        """Block until the job finishes or the timeout passes; returns the job."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None or job["status"] in FINISHED:
+                    return dict(job) if job else None
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return dict(job)
+                self._changed.wait(left)
+
+    def counts(self):
+        with self._changed:
+            counts = {status: 0 for status in (QUEUED, RUNNING, SUCCEEDED, FAILED)}
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+            return counts
+
+
+class SQLiteJobStore:
+    """
+    Job records in a SQLite file. Jobs that were queued or running when the
+    process stopped are marked failed on startup, since their payloads were
+    only held in memory.
+    """
+
+    def __init__(self, path, ttl=24 * 3600, poll_interval=0.5):
+        self.path = path
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL, status_code INTEGER, result TEXT, error TEXT)"
+        )
+        self._db.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE status IN (?, ?)",
+            (FAILED, "Interrupted by a server restart", time.time(), QUEUED, RUNNING),
+        )
+
+    def _row_to_job(self, row):
+        if row is None:
+            return None
+        job_id, status, created_at, updated_at, status_code, result, error = row
+        return {
+            "id": job_id,
+            "status": status,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "status_code": status_code,
+            "result": json.loads(result) if result else None,
+            "error": error,
+        }
+
+    def create(self, job_id):
+        job = new_job(job_id)
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE updated_at < ? AND status IN (?, ?)",
+                             (time.time() - self.ttl, SUCCEEDED, FAILED))
+            self._db.execute(
+                "INSERT INTO jobs (id, status, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (job_id, job["status"], job["created_at"], job["updated_at"]),
+            )
+        return job
+
+    def update(self, job_id, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"]) if fields["result"] is not None else None
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._changed:
+            self._db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            self._changed.notify_all()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, status, created_at, updated_at, status_code, result, error FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        return self._row_to_job(row)
+
+    def wait(self, job_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            left = deadline - time.monotonic()
+            if job is None or job["status"] in FINISHED or left <= 0:
+                return job
+            # Woken early by updates from this process; polls for other writers
+            with self._changed:
+                self._changed.wait(min(left, self.poll_interval))
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in (QUEUED, RUNNING, SUCCEEDED, FAILED)}
+        counts.update(dict(rows))
+        return counts
+
+
+class JobRunner:
+    """
+    Runs `pipeline(payload) -> (body, status_code)` on a bounded worker pool.
+    At most `max_queue` jobs may be waiting for a worker; beyond that submit()
+    raises JobQueueFull.
+    """
+
+    def __init__(self, pipeline, store, workers=4, max_queue=64):
+        self.pipeline = pipeline
+        self.store = store
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counters = {"submitted": 0, "rejected": 0, "succeeded": 0, "failed": 0}
+
+    def submit(self, payload):
+        with self._lock:
+            if self._pending >= self.max_queue + self.workers:
+                self._counters["rejected"] += 1
+                raise JobQueueFull("Too many queued jobs, try again later")
+            self._pending += 1
+            self._counters["submitted"] += 1
+        job_id = uuid.uuid4().hex
+        job = self.store.create(job_id)
+        self._executor.submit(self._run, job_id, payload)
+        return job
+
+    def _run(self, job_id, payload):
+        try:
+            self.store.update(job_id, status=RUNNING)
+            body, status_code = self.pipeline(payload)
+            if status_code == 200:
+                self.store.update(job_id, status=SUCCEEDED, status_code=status_code, result=body)
+                outcome = "succeeded"
+            else:
+                self.store.update(job_id, status=FAILED, status_code=status_code, error=body.get("error"))
+                outcome = "failed"
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed: {e}")
+            self.store.update(job_id, status=FAILED, status_code=500, error=str(e))
+            outcome = "failed"
+        finally:
+            with self._lock:
+                self._pending -= 1
+        with self._lock:
+            self._counters[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["in_progress"] = self._pending
+        stats["workers"] = self.workers
+        stats["max_queue"] = self.max_queue
+        stats["jobs"] = self.store.counts()
+        return stats
+
+
+def store_from_env():
+    if os.environ.get("JOB_STORE", "memory") == "sqlite":
+        return SQLiteJobStore(os.environ.get("JOB_DB_PATH", "/tmp/sketchify-jobs.db"))
+    return MemoryJobStore(ttl=float(os.environ.get("JOB_TTL", 3600)))
+
+
+def runner_from_env(pipeline):
+    return JobRunner(
+        pipeline,
+        store_from_env(),
+        workers=int(os.environ.get("JOB_WORKERS", 4)),
+        max_queue=int(os.environ.get("JOB_QUEUE_SIZE", 64)),
+    )
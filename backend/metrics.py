@@ -0,0 +1,230 @@
+"""
+Prometheus metrics for the generation pipeline.
+
+Every stage (base64 decode, PIL normalization, the Gemini call, response
+parsing, the image call and JSON serialization) is timed into a histogram
+labelled by theme and complexity, alongside in-flight gauges, upstream error
+counters and cache/fallback counters. GET /metrics renders them in the
+Prometheus text format. The few metric types we need are implemented here so
+the servers don't take on another dependency.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+from resilience import CircuitOpenError, DeadlineExceeded, is_transient
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; the upstream calls take from under a second to most of a minute
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+# Labels for calls made outside a request (e.g. from tests or scripts)
+UNLABELLED = {"theme": "none", "complexity": "none"}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._values.get(self._key(labels))
+            return series["count"] if series else 0
+
+    def _samples(self):
+        with self._lock:
+            snapshot = [(key, list(series["buckets"]), series["sum"], series["count"])
+                        for key, series in sorted(self._values.items())]
+        samples = []
+        for key, buckets, total, count in snapshot:
+            cumulative = 0
+            for bound, hits in zip(self.buckets, buckets):
+                cumulative += hits
+                samples.append((f"{self.name}_bucket", key, (("le", _format_value(float(bound))),), cumulative))
+            samples.append((f"{self.name}_sum", key, (), total))
+            samples.append((f"{self.name}_count", key, (), count))
+        return samples
+
+
+def error_type(error):
+    """Coarse, bounded error label for the upstream error counter."""
+    if isinstance(error, DeadlineExceeded):
+        return "deadline"
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status == 429:
+        return "rate_limited"
+    if status is not None:
+        return "server_error" if status >= 500 else "client_error"
+    if is_transient(error):
+        return "connection"
+    return "other"
+
+
+class PipelineMetrics:
+    """The pipeline's metrics, all labelled by theme and complexity."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        labels = ("theme", "complexity")
+        self.stage_seconds = Histogram(
+            "sketchify_stage_seconds", "Time spent in each pipeline stage.",
+            ("stage",) + labels, buckets,
+        )
+        self.in_flight = Gauge(
+            "sketchify_stage_in_flight", "Pipeline stages currently running.",
+            ("stage",) + labels,
+        )
+        self.upstream_errors = Counter(
+            "sketchify_upstream_errors_total", "Failed upstream calls by upstream and error type.",
+            ("upstream", "type") + labels,
+        )
+        self.cache_events = Counter(
+            "sketchify_cache_events_total", "Result cache, analysis reuse and coalescing outcomes.",
+            ("cache", "outcome") + labels,
+        )
+        self.fallbacks = Counter(
+            "sketchify_fallbacks_total", "Locally built analysis fields used instead of Gemini output.",
+            ("kind",) + labels,
+        )
+        self.parse_outcomes = Counter(
+            "sketchify_parse_outcomes_total", "How one-pass Gemini replies were parsed, by output mode.",
+            ("mode", "outcome") + labels,
+        )
+        self.gemini_tokens = Counter(
+            "sketchify_gemini_tokens_total", "Tokens used by one-pass Gemini calls, by response profile.",
+            ("profile", "kind") + labels,
+        )
+        self._metrics = (
+            self.stage_seconds, self.in_flight, self.upstream_errors, self.cache_events, self.fallbacks,
+            self.parse_outcomes, self.gemini_tokens,
+        )
+
+    @contextmanager
+    def stage(self, name, labels):
+        """Time the block as one run of the named stage."""
+        labels = labels or UNLABELLED
+        self.in_flight.inc(stage=name, **labels)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds.observe(time.perf_counter() - start, stage=name, **labels)
+            self.in_flight.dec(stage=name, **labels)
+
+    def observe(self, name, seconds, labels):
+        """Record a stage that was timed elsewhere (e.g. inside the ingestor)."""
+        labels = labels or UNLABELLED
+        self.stage_seconds.observe(seconds, stage=name, **labels)
+
+    def upstream_error(self, upstream, error, labels):
+        labels = labels or UNLABELLED
+        self.upstream_errors.inc(upstream=upstream, type=error_type(error), **labels)
+
+    def cache(self, cache, outcome, labels):
+        labels = labels or UNLABELLED
+        self.cache_events.inc(cache=cache, outcome=outcome, **labels)
+
+    def fallback(self, kind, labels):
+        labels = labels or UNLABELLED
+        self.fallbacks.inc(kind=kind, **labels)
+
+    def parse(self, mode, outcome, labels):
+        labels = labels or UNLABELLED
+        self.parse_outcomes.inc(mode=mode, outcome=outcome, **labels)
+
+    def tokens(self, profile, usage, labels):
+        """Count a completion's reported usage; upstreams that report none are skipped."""
+        if usage is None:
+            return
+        labels = labels or UNLABELLED
+        for kind in ("prompt", "completion"):
+            self.gemini_tokens.inc(getattr(usage, f"{kind}_tokens", 0) or 0, profile=profile, kind=kind, **labels)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,150 @@
+"""
+Sketch preprocessing before the Gemini vision call.
+
+Line-art canvases are mostly empty white space, so the upload is shrunk
+before it is sent: transparency is flattened onto white, whitespace borders
+are cropped, the longest side is capped, colour is dropped when the sketch
+has none and the PNG is re-encoded with optimization. A canvas that none of
+these steps change is forwarded as it arrived, without the (slow) optimized
+re-encode.
+"""
+import os
+import time
+import base64
+import threading
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+COLOR_MODES = ("auto", "color", "grayscale", "1bit")
+
+
+def flatten(image):
+    """Composite transparent canvases onto white and return an RGB image."""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        background = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+        background.alpha_composite(rgba)
+        return background.convert("RGB")
+    return image.convert("RGB")
+
+
+def has_color(rgb, tolerance=16):
+    """True if any pixel's channels differ by more than the tolerance."""
+    r, g, b = rgb.split()
+    for a, c in ((r, g), (g, b), (r, b)):
+        if ImageChops.difference(a, c).getextrema()[1] > tolerance:
+            return True
+    return False
+
+
+class SketchPreprocessor:
+    def __init__(self, max_side=768, color_mode="auto", autocrop=True, padding=16, threshold=245):
+        if color_mode not in COLOR_MODES:
+            raise ValueError(f"Unknown color mode {color_mode!r}, expected one of {COLOR_MODES}")
+        self.max_side = max_side
+        self.color_mode = color_mode
+        self.autocrop = autocrop
+        self.padding = padding
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "unchanged": 0, "bytes_before": 0, "bytes_after": 0, "seconds": 0.0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_side=int(os.environ.get("SKETCH_MAX_SIDE", 768)),
+            color_mode=os.environ.get("SKETCH_COLOR_MODE", "auto"),
+            autocrop=os.environ.get("SKETCH_AUTOCROP", "1") != "0",
+            padding=int(os.environ.get("SKETCH_CROP_PADDING", 16)),
+        )
+
+    def crop(self, rgb):
+        """Crop to the drawn strokes plus padding; blank canvases are left alone."""
+        gray = rgb.convert("L")
+        # Anything darker than the threshold counts as ink
+        ink = gray.point(lambda value: 255 if value < self.threshold else 0)
+        box = ink.getbbox()
+        if not box:
+            return rgb
+        left, top, right, bottom = box
+        box = (
+            max(left - self.padding, 0),
+            max(top - self.padding, 0),
+            min(right + self.padding, rgb.width),
+            min(bottom + self.padding, rgb.height),
+        )
+        return rgb.crop(box)
+
+    def convert(self, rgb):
+        mode = self.color_mode
+        if mode == "auto":
+            mode = "color" if has_color(rgb) else "grayscale"
+        if mode == "grayscale":
+            return rgb.convert("L")
+        if mode == "1bit":
+            return rgb.convert("L").point(lambda value: 255 if value >= 128 else 0, mode="1")
+        return rgb
+
+    def process(self, image, bytes_before=None, keep_unchanged=False):
+        """
+        Returns (png_bytes, report) where report holds the byte sizes,
+        dimensions and milliseconds spent. With keep_unchanged, png_bytes is
+        None when preprocessing left the image as it was, so the caller can
+        send the original instead of a re-encoded copy.
+        """
+        start = time.perf_counter()
+        original_size = image.size
+
+        processed = flatten(image)
+        if self.autocrop:
+            processed = self.crop(processed)
+        if self.max_side and max(processed.size) > self.max_side:
+            processed.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+        processed = self.convert(processed)
+
+        unchanged = keep_unchanged and processed.size == original_size and processed.mode == image.mode
+        if unchanged:
+            png_bytes = None
+            bytes_after = bytes_before
+        else:
+            buffered = BytesIO()
+            processed.save(buffered, format="PNG", optimize=True)
+            png_bytes = buffered.getvalue()
+            bytes_after = len(png_bytes)
+
+        elapsed = time.perf_counter() - start
+        report = {
+            "bytes_before": bytes_before,
+            "bytes_after": bytes_after,
+            "size_before": list(original_size),
+            "size_after": list(processed.size),
+            "mode": processed.mode,
+            "unchanged": unchanged,
+            "ms": round(elapsed * 1000, 2),
+        }
+        with self._lock:
+            self._counters["requests"] += 1
+            self._counters["unchanged"] += 1 if unchanged else 0
+            self._counters["bytes_before"] += bytes_before or 0
+            self._counters["bytes_after"] += bytes_after or 0
+            self._counters["seconds"] += elapsed
+        return png_bytes, report
+
+    def process_base64(self, image, bytes_before=None, original_base64=None):
+        """Like process(), as base64; original_base64 is returned as is if nothing changed."""
+        png_bytes, report = self.process(image, bytes_before, keep_unchanged=original_base64 is not None)
+        if png_bytes is None:
+            return original_base64, report
+        return base64.b64encode(png_bytes).decode("utf-8"), report
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        requests = stats["requests"]
+        stats["avg_ms"] = round(stats.pop("seconds") * 1000 / requests, 2) if requests else 0.0
+        stats["ratio"] = round(stats["bytes_after"] / stats["bytes_before"], 4) if stats["bytes_before"] else None
+        stats["max_side"] = self.max_side
+        stats["color_mode"] = self.color_mode
+        stats["autocrop"] = self.autocrop
+        return stats
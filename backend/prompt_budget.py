@@ -0,0 +1,138 @@
+"""
+Token budgets for the prompts sent to Gemini and Imagen.
+
+The one-pass prompt inlined each theme's whole system prompt, including the
+"instructions for a diffusion model" boilerplate, and the transformation
+prompt went to Imagen with no length limit. PromptBudget estimates the
+tokens of each prompt part and fits it to a per-part budget: theme text
+loses its boilerplate and is trimmed at a sentence boundary, and Imagen
+prompts are trimmed the same way. User prompts over their budget are
+rejected (check) rather than cut, so a request never silently loses part of
+what the user asked for. Estimates use about four
+characters per token, which is close enough for budgeting without a
+tokenizer; the estimate for each Gemini call is compared with the usage the
+upstream reports, so the ratio can be watched in /stats.
+"""
+import os
+import re
+import logging
+import threading
+
+# Phrases in the theme prompts that say nothing about the style
+BOILERPLATE = (
+    "these are instructions for a diffusion model.",
+    "these are instructions for a diffusion model",
+    "in 1-2 sentences",
+    "in 1 sentence",
+)
+
+# Roughly what Gemini charges for one sketch image
+IMAGE_TOKENS = 258
+
+PARTS = ("theme_context", "user_prompt", "image_prompt")
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text
+    return (len(text or "") + 3) // 4
+
+
+def estimate_chat_tokens(messages):
+    """Estimated prompt tokens of chat completion messages, images included."""
+    tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += estimate_tokens(content)
+            continue
+        for part in content:
+            tokens += estimate_tokens(part["text"]) if part["type"] == "text" else IMAGE_TOKENS
+    return tokens
+
+
+def compress_boilerplate(text):
+    """Theme text without boilerplate phrases or repeated whitespace."""
+    for phrase in BOILERPLATE:
+        text = re.sub(re.escape(phrase), "", text, flags=re.IGNORECASE)
+    # Sentences glued together by the themes.py string concatenation
+    text = re.sub(r"\.(?=[A-Z])", ". ", text)
+    text = re.sub(r"\s+", " ", text)
+    return re.sub(r"\s+([.,])", r"\1", text).strip()
+
+
+def trim_to_tokens(text, budget):
+    """Text cut to about budget tokens, at a sentence end when one is close, else at a word."""
+    if estimate_tokens(text) <= budget:
+        return text
+    cut = text[:budget * 4]
+    sentence_end = cut.rfind(". ")
+    if sentence_end >= len(cut) // 2:
+        return cut[:sentence_end + 1]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > 0 else cut).rstrip(" ,;:")
+
+
+class PromptBudget:
+    def __init__(self, theme_context=120, user_prompt=300, image_prompt=400, enabled=True):
+        self.budgets = {"theme_context": theme_context, "user_prompt": user_prompt, "image_prompt": image_prompt}
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._parts = {part: {"fitted": 0, "trimmed": 0, "tokens_before": 0, "tokens_after": 0} for part in PARTS}
+        self._usage = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            theme_context=int(os.environ.get("PROMPT_BUDGET_THEME_CONTEXT", 120)),
+            user_prompt=int(os.environ.get("PROMPT_BUDGET_USER_PROMPT", 300)),
+            image_prompt=int(os.environ.get("PROMPT_BUDGET_IMAGE_PROMPT", 400)),
+            enabled=os.environ.get("PROMPT_BUDGET_ENABLED", "1") != "0",
+        )
+
+    def fit(self, part, text):
+        """text fitted to the budget of one prompt part."""
+        if not self.enabled or not isinstance(text, str) or not text:
+            return text
+        fitted = compress_boilerplate(text) if part == "theme_context" else text.strip()
+        fitted = trim_to_tokens(fitted, self.budgets[part])
+        before, after = estimate_tokens(text), estimate_tokens(fitted)
+        with self._lock:
+            counts = self._parts[part]
+            counts["fitted"] += 1
+            counts["trimmed"] += 1 if after < before else 0
+            counts["tokens_before"] += before
+            counts["tokens_after"] += after
+        return fitted
+
+    def check(self, part, text):
+        """An error message when text is over the part's budget, else None."""
+        if not self.enabled or not isinstance(text, str):
+            return None
+        tokens = estimate_tokens(text.strip())
+        if tokens <= self.budgets[part]:
+            return None
+        return f"{part} is too long: about {tokens} tokens, the limit is {self.budgets[part]} (about {self.budgets[part] * 4} characters)"
+
+    def record_usage(self, stage, estimated, usage):
+        """Compare the estimated prompt tokens of a call with what the upstream reported."""
+        actual = getattr(usage, "prompt_tokens", None) if usage is not None else None
+        if actual:
+            logging.debug(f"{stage} prompt: estimated {estimated} tokens, actual {actual}")
+        with self._lock:
+            counts = self._usage.setdefault(stage, {"calls": 0, "estimated": 0, "reported": 0, "actual": 0})
+            counts["calls"] += 1
+            if actual:
+                counts["reported"] += 1
+                counts["estimated"] += estimated
+                counts["actual"] += actual
+
+    def stats(self):
+        with self._lock:
+            parts = {part: dict(counts) for part, counts in self._parts.items()}
+            usage = {stage: dict(counts) for stage, counts in self._usage.items()}
+        for part, counts in parts.items():
+            counts["budget"] = self.budgets[part]
+            counts["saved_tokens"] = counts["tokens_before"] - counts["tokens_after"]
+        for counts in usage.values():
+            counts["estimate_ratio"] = round(counts["estimated"] / counts["actual"], 3) if counts["actual"] else None
+        return {"enabled": self.enabled, "parts": parts, "usage": usage}
@@ -0,0 +1,390 @@
+"""
+Image-generation providers and a latency-aware router across them.
+
+The backends the separate servers use (Imagen in app.py/gemini.py, Stability
+Ultra in gpt-stability.py) plus OpenAI's image API share one interface:
+generate(prompt, quality) -> base64 image. The router keeps a rolling
+(EWMA) latency and error rate per provider and tries them in order of
+score = latency * (1 + error penalty * error rate) + cost weight * cost,
+failing over to the next one when a call errors. A provider that fails
+several times in a row sits out a cooldown. Providers without a measurement
+are scored with a pessimistic prior latency; they, and ones that haven't been
+used for a while, are tried first on a small share of requests (the probe
+share), so traffic moves back once a provider recovers without a cold or
+flapping one ever taking the bulk of it.
+"""
+import os
+import time
+import base64
+import random
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+from upstream import get_client, get_async_client, get_http_session, get_manager
+from resilience import BreakerRegistry, CircuitOpenError, Deadline, DeadlineExceeded, RetryPolicy
+
+
+class ProviderError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Provider(ABC):
+    name = None
+
+    def __init__(self, cost=0.0):
+        # USD per image, used to break ties between similarly fast providers
+        self.cost = cost
+
+    def available(self):
+        return True
+
+    @abstractmethod
+    def generate(self, prompt, quality, timeout=None):
+        """Render the prompt within timeout seconds; returns the image as base64."""
+
+    async def agenerate(self, prompt, quality, timeout=None):
+        return await asyncio.to_thread(self.generate, prompt, quality, timeout)
+
+
+class ImagenProvider(Provider):
+    """
+    Imagen through Gemini's OpenAI-compatible endpoint. Clients come from
+    factories so the Flask and asyncio servers can each supply their own,
+    and calls are hedged when a hedger is set (see hedging.py).
+    """
+    name = "imagen"
+
+    def __init__(self, request_kwargs, client_factory, async_client_factory=None, hedger=None, cost=0.04):
+        super().__init__(cost)
+        self.request_kwargs = request_kwargs
+        self.client_factory = client_factory
+        self.async_client_factory = async_client_factory
+        self.hedger = hedger
+
+    def generate(self, prompt, quality, timeout=None):
+        client = self.client_factory()
+        imagen_kwargs = dict(self.request_kwargs(prompt, quality), timeout=timeout)
+        if self.hedger is None:
+            response = client.images.generate(**imagen_kwargs)
+        else:
+            response = self.hedger.call(quality, lambda: client.images.generate(**imagen_kwargs))
+        return response.data[0].b64_json
+
+    async def agenerate(self, prompt, quality, timeout=None):
+        if self.async_client_factory is None:
+            return await super().agenerate(prompt, quality, timeout)
+        client = self.async_client_factory()
+        imagen_kwargs = dict(self.request_kwargs(prompt, quality), timeout=timeout)
+        if self.hedger is None:
+            response = await client.images.generate(**imagen_kwargs)
+        else:
+            response = await self.hedger.call_async(quality, lambda: client.images.generate(**imagen_kwargs))
+        return response.data[0].b64_json
+
+
+class OpenAIImageProvider(Provider):
+    name = "openai"
+    # The router asks for the Imagen qualities; each OpenAI model names its own
+    qualities = {
+        "dall-e-3": {"standard": "standard", "hd": "hd"},
+        "gpt-image-1": {"standard": "medium", "hd": "high"},
+    }
+
+    def __init__(self, api_key, model="dall-e-3", cost=0.04):
+        super().__init__(cost)
+        if model not in self.qualities:
+            raise ValueError(f"Unsupported OpenAI image model {model!r}, expected one of {sorted(self.qualities)}")
+        self.api_key = api_key
+        self.model = model
+
+    def available(self):
+        return bool(self.api_key)
+
+    def _request_kwargs(self, prompt, quality, timeout):
+        qualities = self.qualities[self.model]
+        if quality not in qualities:
+            raise ValueError(f"Unknown image quality {quality!r}, expected one of {sorted(qualities)}")
+        kwargs = {
+            "model": self.model,
+            "prompt": prompt,
+            "n": 1,
+            "quality": qualities[quality],
+            "size": "1024x1024",
+            "timeout": timeout,
+        }
+        # gpt-image-1 always answers in base64 and rejects response_format
+        if self.model == "dall-e-3":
+            kwargs["response_format"] = "b64_json"
+        return kwargs
+
+    def generate(self, prompt, quality, timeout=None):
+        # The router retries, so the client doesn't
+        client = get_client(api_key=self.api_key, base_url=None, max_retries=0)
+        return client.images.generate(**self._request_kwargs(prompt, quality, timeout)).data[0].b64_json
+
+    async def agenerate(self, prompt, quality, timeout=None):
+        client = get_async_client(api_key=self.api_key, base_url=None, max_retries=0)
+        response = await client.images.generate(**self._request_kwargs(prompt, quality, timeout))
+        return response.data[0].b64_json
+
+
+class StabilityProvider(Provider):
+    name = "stability"
+    url = "https://api.stability.ai/v2beta/stable-image/generate/ultra"
+
+    def __init__(self, api_key, cost=0.08):
+        super().__init__(cost)
+        self.api_key = api_key
+
+    def available(self):
+        return bool(self.api_key)
+
+    def generate(self, prompt, quality, timeout=None):
+        manager = get_manager()
+        response = get_http_session().post(
+            self.url,
+            headers={
+                "authorization": f"Bearer {self.api_key}",
+                "accept": "image/*"
+            },
+            files={"none": ''},
+            data={
+                "prompt": prompt,
+                "output_format": "png",
+            },
+            timeout=(manager.connect_timeout, timeout or manager.read_timeout),
+        )
+        if response.status_code != 200:
+            raise ProviderError(f"Stability AI returned {response.status_code}: {response.text[:200]}", response.status_code)
+        return base64.b64encode(response.content).decode("utf-8")
+
+
+class ProviderHealth:
+    """Rolling latency and error rate for one provider."""
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.last_used = None
+
+    def record(self, seconds, ok, now):
+        self.requests += 1
+        self.last_used = now
+        if not ok and self.latency is not None:
+            # A fast failure must not make the provider look faster
+            seconds = max(seconds, self.latency)
+        if seconds is not None:
+            self.latency = seconds if self.latency is None else self.latency + self.alpha * (seconds - self.latency)
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+
+
+class ProviderRouter:
+    def __init__(self, providers, alpha=0.2, error_penalty=4.0, cost_weight=25.0,
+                 failure_threshold=3, cooldown=30.0, stale_after=120.0, prior_latency=30.0, probe_share=0.05,
+                 breakers=None, retry_policy=None):
+        self.providers = [provider for provider in providers if provider.available()]
+        if not self.providers:
+            raise ValueError("No image provider is configured")
+        self.error_penalty = error_penalty
+        # Seconds of latency one dollar per image is worth
+        self.cost_weight = cost_weight
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.stale_after = stale_after
+        # Seconds assumed for a provider that hasn't been measured yet
+        self.prior_latency = prior_latency
+        # Fraction of requests that try an unmeasured or stale provider first
+        self.probe_share = probe_share
+        # Each provider call is retried and guarded by a breaker named after the provider
+        self.breakers = breakers if breakers is not None else BreakerRegistry()
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._lock = threading.Lock()
+        self._health = {provider.name: ProviderHealth(alpha) for provider in self.providers}
+        self._counters = {"failovers": 0, "exhausted": 0, "probes": 0}
+
+    def _score(self, provider, health):
+        latency = self.prior_latency if health.latency is None else health.latency
+        return latency * (1 + self.error_penalty * health.error_rate) + provider.cost * self.cost_weight
+
+    def _needs_probe(self, health, now):
+        if health.cooldown_until > now:
+            return False
+        return health.last_used is None or now - health.last_used > self.stale_after
+
+    def order(self):
+        """Providers to try, best first; providers cooling down go last."""
+        now = time.monotonic()
+        with self._lock:
+            ranked = []
+            for position, provider in enumerate(self.providers):
+                health = self._health[provider.name]
+                cooling = health.cooldown_until > now
+                ranked.append((cooling, self._score(provider, health), position, provider))
+        ranked.sort(key=lambda item: item[:3])
+        return [provider for _, _, _, provider in ranked]
+
+    def candidates(self):
+        """
+        order(), except that on probe_share of requests the least recently
+        used unmeasured or stale provider is moved to the front.
+        """
+        ranked = self.order()
+        if random.random() >= self.probe_share:
+            return ranked
+        now = time.monotonic()
+        with self._lock:
+            due = [provider for provider in ranked if self._needs_probe(self._health[provider.name], now)]
+            if not due:
+                return ranked
+            probe = min(due, key=lambda provider: self._health[provider.name].last_used or 0.0)
+            self._counters["probes"] += 1
+        return [probe] + [provider for provider in ranked if provider is not probe]
+
+    def record(self, provider, seconds, ok):
+        now = time.monotonic()
+        with self._lock:
+            health = self._health[provider.name]
+            health.record(seconds, ok, now)
+            if not ok and health.consecutive_failures >= self.failure_threshold:
+                health.cooldown_until = now + self.cooldown
+
+    def _failed(self, provider, seconds, error, remaining):
+        logging.warning(f"Image provider {provider.name} failed after {seconds:.2f}s: {error}")
+        self.record(provider, seconds, ok=False)
+        if remaining:
+            with self._lock:
+                self._counters["failovers"] += 1
+
+    def _exhausted(self, error):
+        with self._lock:
+            self._counters["exhausted"] += 1
+        raise error
+
+    def generate(self, prompt, quality, deadline=None):
+        """
+        Render with the best provider, failing over on errors.
+        Returns (image_base64, provider_name).
+        """
+        deadline = deadline or Deadline()
+        candidates = self.candidates()
+        error = None
+        for index, provider in enumerate(candidates):
+            start = time.monotonic()
+            try:
+                image_base64 = self.retry_policy.call(
+                    lambda timeout: provider.generate(prompt, quality, timeout),
+                    self.breakers.get(provider.name), deadline, "image",
+                )
+            except DeadlineExceeded:
+                raise
+            except CircuitOpenError as e:
+                # Already known to be down; move on without touching its health
+                error = e
+                continue
+            except Exception as e:
+                error = e
+                self._failed(provider, time.monotonic() - start, e, index + 1 < len(candidates))
+                continue
+            self.record(provider, time.monotonic() - start, ok=True)
+            return image_base64, provider.name
+        self._exhausted(error)
+
+    async def agenerate(self, prompt, quality, deadline=None):
+        """Async version of generate()."""
+        deadline = deadline or Deadline()
+        candidates = self.candidates()
+        error = None
+        for index, provider in enumerate(candidates):
+            start = time.monotonic()
+            try:
+                image_base64 = await self.retry_policy.call_async(
+                    lambda timeout: provider.agenerate(prompt, quality, timeout),
+                    self.breakers.get(provider.name), deadline, "image",
+                )
+            except DeadlineExceeded:
+                raise
+            except CircuitOpenError as e:
+                error = e
+                continue
+            except Exception as e:
+                error = e
+                self._failed(provider, time.monotonic() - start, e, index + 1 < len(candidates))
+                continue
+            self.record(provider, time.monotonic() - start, ok=True)
+            return image_base64, provider.name
+        self._exhausted(error)
+
+    def provider(self, name):
+        for provider in self.providers:
+            if provider.name == name:
+                return provider
+        return None
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._counters)
+            stats["providers"] = {}
+            for provider in self.providers:
+                health = self._health[provider.name]
+                stats["providers"][provider.name] = {
+                    "requests": health.requests,
+                    "failures": health.failures,
+                    "latency_ms": round(health.latency * 1000, 1) if health.latency is not None else None,
+                    "error_rate": round(health.error_rate, 4),
+                    "cost": provider.cost,
+                    "score": round(self._score(provider, health), 3),
+                    "cooling_down": health.cooldown_until > now,
+                }
+        stats["order"] = [provider.name for provider in self.order()]
+        return stats
+
+
+def router_from_env(imagen, breakers=None, retry_policy=None):
+    """
+    Router over the providers listed in IMAGE_PROVIDERS (default: imagen only).
+    Providers without an API key are skipped.
+    """
+    available = {
+        "imagen": lambda: imagen,
+        "openai": lambda: OpenAIImageProvider(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            model=os.environ.get("OPENAI_IMAGE_MODEL", "dall-e-3"),
+            cost=float(os.environ.get("OPENAI_IMAGE_COST", 0.04)),
+        ),
+        "stability": lambda: StabilityProvider(
+            api_key=os.environ.get("STABILITY_API_KEY"),
+            cost=float(os.environ.get("STABILITY_COST", 0.08)),
+        ),
+    }
+    names = [name.strip() for name in os.environ.get("IMAGE_PROVIDERS", "imagen").split(",") if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ValueError(f"Unknown image providers {unknown}, expected some of {sorted(available)}")
+    return ProviderRouter(
+        [available[name]() for name in names],
+        alpha=float(os.environ.get("ROUTER_EWMA_ALPHA", 0.2)),
+        error_penalty=float(os.environ.get("ROUTER_ERROR_PENALTY", 4.0)),
+        cost_weight=float(os.environ.get("ROUTER_COST_WEIGHT", 25.0)),
+        failure_threshold=int(os.environ.get("ROUTER_FAILURE_THRESHOLD", 3)),
+        cooldown=float(os.environ.get("ROUTER_COOLDOWN_SECONDS", 30)),
+        stale_after=float(os.environ.get("ROUTER_STALE_SECONDS", 120)),
+        prior_latency=float(os.environ.get("ROUTER_PRIOR_SECONDS", 30)),
+        probe_share=float(os.environ.get("ROUTER_PROBE_SHARE", 0.05)),
+        breakers=breakers,
+        retry_policy=retry_policy,
+    )
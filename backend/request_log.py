@@ -0,0 +1,198 @@
+"""
+Structured, sampled request logging.
+
+Request bodies are multi-megabyte base64 canvases, so the old DEBUG hooks
+that logged every body were one of the most expensive things a request did.
+Each request now gets one JSON log line with its method, path, status,
+latency and body size. The parsed payload is logged too, but strings longer
+than LOG_MAX_FIELD_LENGTH are replaced by their length and a hash, and
+secret-looking keys are redacted. Successful requests are sampled at
+LOG_SAMPLE_RATE; errors and slow requests are always logged. Records pass
+through a queue to a background writer thread, so a request thread never
+blocks on stdout or Cloud Logging.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import hashlib
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+SECRET_KEY_PARTS = ("api_key", "apikey", "token", "secret", "password", "authorization", "cookie")
+
+# Items kept from a logged list (e.g. the items of a batch)
+MAX_LOGGED_ITEMS = 10
+
+
+def digest(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def is_secret(key):
+    key = str(key).lower()
+    return any(part in key for part in SECRET_KEY_PARTS)
+
+
+def redact(value, max_length=256):
+    """Copy of value that is safe and cheap to log."""
+    if isinstance(value, dict):
+        return {key: "[redacted]" if is_secret(key) else redact(item, max_length) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        redacted = [redact(item, max_length) for item in value[:MAX_LOGGED_ITEMS]]
+        if len(value) > MAX_LOGGED_ITEMS:
+            redacted.append(f"... {len(value) - MAX_LOGGED_ITEMS} more")
+        return redacted
+    if isinstance(value, str) and len(value) > max_length:
+        return {"length": len(value), "sha256": digest(value)}
+    if isinstance(value, (bytes, bytearray)):
+        # Binary uploads (see transport.py)
+        return {"bytes": len(value), "sha256": digest(value)}
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the field names Cloud Logging picks up."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the writer thread; drops them instead of blocking when it falls behind."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_queue_handler = None
+
+
+def configure_logging():
+    """
+    Send the root logger through a queue to a background writer (JSON lines
+    unless LOG_FORMAT=text). Safe to call more than once.
+    """
+    global _queue_handler
+    if _queue_handler is not None:
+        return _queue_handler
+
+    writer = logging.StreamHandler(sys.stdout)
+    if os.environ.get("LOG_FORMAT", "json") == "text":
+        writer.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        writer.setFormatter(JsonFormatter())
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=int(os.environ.get("LOG_QUEUE_SIZE", 10000))))
+    listener = QueueListener(_queue_handler.queue, writer, respect_handler_level=True)
+    listener.start()
+    # Flush what is still queued on shutdown
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    root.addHandler(_queue_handler)
+    return _queue_handler
+
+
+class RequestLogger:
+    def __init__(self, sample_rate=0.1, slow_ms=10000, max_field_length=256, logger=None):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_field_length = max_field_length
+        self.logger = logger or logging.getLogger("sketchify.requests")
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "logged": 0, "sampled_out": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            sample_rate=float(os.environ.get("LOG_SAMPLE_RATE", 0.1)),
+            slow_ms=float(os.environ.get("LOG_SLOW_MS", 10000)),
+            max_field_length=int(os.environ.get("LOG_MAX_FIELD_LENGTH", 256)),
+        )
+
+    def should_log(self, status, duration_ms):
+        if status >= 400 or duration_ms >= self.slow_ms:
+            return True
+        return random.random() < self.sample_rate
+
+    def log(self, method, path, status, duration_ms, body_bytes=None, payload=None):
+        """
+        Log one finished request. The payload is only redacted (and its long
+        strings hashed) when the request is actually logged.
+        """
+        logged = self.should_log(status, duration_ms)
+        with self._lock:
+            self._counters["requests"] += 1
+            self._counters["logged" if logged else "sampled_out"] += 1
+        if not logged:
+            return False
+
+        fields = {
+            "method": method,
+            "path": path,
+            "status": status,
+            "duration_ms": round(duration_ms, 1),
+            "body_bytes": body_bytes,
+        }
+        if payload is not None:
+            fields["request"] = redact(payload, self.max_field_length)
+        level = logging.ERROR if status >= 500 else logging.WARNING if status >= 400 else logging.INFO
+        self.logger.log(level, f"{method} {path} {status}", extra={"fields": fields})
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["sample_rate"] = self.sample_rate
+        stats["dropped"] = _queue_handler.dropped if _queue_handler is not None else 0
+        stats["queued"] = _queue_handler.queue.qsize() if _queue_handler is not None else 0
+        return stats
+
+
+def install_flask_hooks(app, request_logger):
+    """Replace per-request DEBUG dumps with one sampled, structured line per request."""
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        started = g.get("request_started", time.perf_counter())
+        fields = (request.method, request.path, response.status_code)
+        body_bytes = request.content_length
+        payload = request.get_json(silent=True) if request.is_json else None
+
+        # Logged once the body is sent, so streamed responses report their full duration
+        def log_closed():
+            request_logger.log(*fields, (time.perf_counter() - started) * 1000, body_bytes=body_bytes, payload=payload)
+
+        response.call_on_close(log_closed)
+        return response
@@ -0,0 +1,271 @@
+"""
+Deadlines, retries and circuit breakers for upstream calls.
+
+Every /generate-prompt request gets one Deadline. Each stage (the Gemini
+analysis, the image render) also has its own timeout, and every call gets
+whichever is shorter. Transient failures (timeouts, connection errors, 429
+and 5xx responses) are retried with capped exponential backoff and full
+jitter as long as the deadline allows. A circuit breaker per upstream opens
+after repeated failures and fails calls fast until a trial call succeeds.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+
+import httpx
+import requests
+
+# Total seconds one generation request may spend on upstream calls
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", 90))
+# Per-stage timeouts, further capped by the request deadline
+STAGE_TIMEOUTS = {
+    "analysis": float(os.environ.get("STAGE_ANALYSIS_TIMEOUT", 30)),
+    "image": float(os.environ.get("STAGE_IMAGE_TIMEOUT", 60)),
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds=None):
+        self.seconds = REQUEST_DEADLINE_SECONDS if seconds is None else seconds
+        self.expires_at = time.monotonic() + self.seconds
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def timeout(self, stage):
+        """Seconds the next call in this stage may take; raises once the deadline has passed."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Request deadline of {self.seconds:g}s exceeded before the {stage} stage")
+        return min(STAGE_TIMEOUTS.get(stage, remaining), remaining)
+
+
+def is_transient(error):
+    """True for errors worth retrying: timeouts, dropped connections, 429 and 5xx."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # openai's APIConnectionError/APITimeoutError carry no status code
+    if type(error).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return True
+    return isinstance(error, (httpx.TransportError, requests.ConnectionError, requests.Timeout, TimeoutError))
+
+
+def upstream_error_status(error):
+    """HTTP status to report for an upstream failure."""
+    if isinstance(error, DeadlineExceeded):
+        return 504
+    if isinstance(error, CircuitOpenError):
+        return 503
+    return 500
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive transient failures. While open,
+    calls fail fast; after reset_timeout one trial call is let through
+    (half-open), and its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._counters = {"calls": 0, "successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may go ahead now."""
+        with self._lock:
+            self._counters["calls"] += 1
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._trial_running = False
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            self._counters["rejected"] += 1
+        raise CircuitOpenError(f"Circuit for {self.name} is open")
+
+    def record_success(self):
+        with self._lock:
+            self._counters["successes"] += 1
+            self.consecutive_failures = 0
+            self._trial_running = False
+            if self.state != CLOSED:
+                logging.info(f"Circuit for {self.name} closed")
+            self.state = CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._counters["failures"] += 1
+            self.consecutive_failures += 1
+            self._trial_running = False
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self._counters["opened"] += 1
+                    logging.warning(f"Circuit for {self.name} opened after {self.consecutive_failures} failures")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def record_ignored(self):
+        """A non-transient error: says nothing about the upstream's health."""
+        with self._lock:
+            self._trial_running = False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["state"] = self.state
+            stats["consecutive_failures"] = self.consecutive_failures
+            if self.state == OPEN:
+                stats["retry_in"] = round(max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0), 1)
+        stats["failure_threshold"] = self.failure_threshold
+        stats["reset_timeout"] = self.reset_timeout
+        return stats
+
+
+class BreakerRegistry:
+    """One CircuitBreaker per upstream name, created on first use."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            failure_threshold=int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5)),
+            reset_timeout=float(os.environ.get("BREAKER_RESET_SECONDS", 30)),
+        )
+
+    def get(self, name):
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.stats() for breaker in breakers}
+
+
+class RetryPolicy:
+    def __init__(self, attempts=3, base_delay=0.25, max_delay=4.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._counters = {"retries": 0, "gave_up": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            attempts=int(os.environ.get("RETRY_ATTEMPTS", 3)),
+            base_delay=float(os.environ.get("RETRY_BASE_DELAY", 0.25)),
+            max_delay=float(os.environ.get("RETRY_MAX_DELAY", 4.0)),
+        )
+
+    def backoff(self, attempt):
+        """Full jitter: uniform between 0 and the capped exponential delay."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _next_delay(self, attempt, error, deadline):
+        """Seconds to sleep before the next attempt, or None to give up."""
+        delay = self.backoff(attempt)
+        if attempt + 1 >= self.attempts or not is_transient(error) or delay >= deadline.remaining():
+            with self._lock:
+                self._counters["gave_up"] += 1
+            return None
+        with self._lock:
+            self._counters["retries"] += 1
+        return delay
+
+    def call(self, fn, breaker, deadline, stage):
+        """
+        Call fn(timeout) within the deadline, retrying transient errors and
+        reporting every outcome to the breaker.
+        """
+        attempt = 0
+        while True:
+            timeout = deadline.timeout(stage)
+            breaker.allow()
+            try:
+                result = fn(timeout)
+            except Exception as e:
+                if is_transient(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_ignored()
+                delay = self._next_delay(attempt, e, deadline)
+                if delay is None:
+                    raise
+                logging.warning(f"Retrying {breaker.name} in {delay:.2f}s after: {e}")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                # Cancelled (e.g. a losing hedge) or interrupted: frees a half-open trial
+                breaker.record_ignored()
+                raise
+            breaker.record_success()
+            return result
+
+    async def call_async(self, make_call, breaker, deadline, stage):
+        """Async version of call(); make_call(timeout) returns an awaitable."""
+        attempt = 0
+        while True:
+            timeout = deadline.timeout(stage)
+            breaker.allow()
+            try:
+                result = await make_call(timeout)
+            except Exception as e:
+                if is_transient(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_ignored()
+                delay = self._next_delay(attempt, e, deadline)
+                if delay is None:
+                    raise
+                logging.warning(f"Retrying {breaker.name} in {delay:.2f}s after: {e}")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                breaker.record_ignored()
+                raise
+            breaker.record_success()
+            return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["attempts"] = self.attempts
+        return stats
@@ -0,0 +1,173 @@
+"""
+Content-addressed cache for finished /generate-prompt results.
+
+Entries are keyed on a hash of the normalized sketch bytes plus the request
+options, evicted least-recently-used first, expire after a TTL and are kept
+under a total byte budget. Setting a directory persists entries as JSON files
+so the cache survives restarts; entries are serialized and written outside
+the lock, which only covers renaming the finished file into place.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def sketch_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def make_cache_key(image_bytes, theme, prompt="", complexity="standard"):
+    """
+    Key for one generation request. Options are normalized so that requests
+    the pipeline treats identically share an entry.
+    """
+    options = json.dumps([theme, (prompt or "").strip(), (complexity or "standard").lower()])
+    digest = hashlib.sha256()
+    digest.update(sketch_hash(image_bytes).encode("ascii"))
+    digest.update(options.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_entries=256, ttl=3600, max_bytes=128 * 1024 * 1024, directory=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._lock = threading.Lock()
+        # key -> (stored_at, size, value), oldest first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._counters = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "stores": 0}
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load()
+
+    @classmethod
+    def from_env(cls, prefix="RESULT_CACHE"):
+        return cls(
+            max_entries=int(os.environ.get(f"{prefix}_MAX_ENTRIES", 256)),
+            ttl=float(os.environ.get(f"{prefix}_TTL", 3600)),
+            max_bytes=int(os.environ.get(f"{prefix}_MAX_BYTES", 128 * 1024 * 1024)),
+            directory=os.environ.get(f"{prefix}_DIR") or None,
+        )
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load(self):
+        """Reload persisted entries, oldest first, dropping anything expired."""
+        loaded = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    record = json.load(f)
+                loaded.append((record["stored_at"], name[:-len(".json")], record["value"]))
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Skipping unreadable cache file {path}: {e}")
+
+        now = time.time()
+        for stored_at, key, value in sorted(loaded, key=lambda item: item[0]):
+            if now - stored_at > self.ttl:
+                self._remove_file(key)
+                continue
+            self._insert(key, value, len(json.dumps(value)), stored_at)
+        logging.info(f"Loaded {len(self._entries)} cached results from {self.directory}")
+
+    def _remove_file(self, key):
+        if not self.directory:
+            return
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _write_tmp(self, key, value, stored_at):
+        """Write an entry to a temporary file for _insert to move into place; returns its path."""
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f"{key}.", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"stored_at": stored_at, "value": value}, f)
+            return tmp_path
+        except OSError as e:
+            logging.warning(f"Could not persist cache entry {key}: {e}")
+            return None
+
+    def _move_file(self, key, tmp_path):
+        try:
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logging.warning(f"Could not persist cache entry {key}: {e}")
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        self._remove_file(key)
+
+    def _insert(self, key, value, size, stored_at, tmp_path=None):
+        if key in self._entries:
+            self._drop(key)
+        while self._entries and (len(self._entries) >= self.max_entries or self._bytes + size > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self._counters["evictions"] += 1
+        self._entries[key] = (stored_at, size, value)
+        self._bytes += size
+        if tmp_path is not None:
+            self._move_file(key, tmp_path)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            stored_at, _, value = entry
+            if time.time() - stored_at > self.ttl:
+                self._drop(key)
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        stored_at = time.time()
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        tmp_path = self._write_tmp(key, value, stored_at) if self.directory else None
+        with self._lock:
+            self._insert(key, value, size, stored_at, tmp_path)
+            self._counters["stores"] += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["max_entries"] = self.max_entries
+        stats["max_bytes"] = self.max_bytes
+        stats["ttl"] = self.ttl
+        stats["persistent"] = bool(self.directory)
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,168 @@
+"""
+Perceptual-hash index of analysed sketches.
+
+Sketches that differ by a stray pixel or a slightly different canvas size hash
+to nearby 128-bit dHash values. The hash keeps the strokes' aspect ratio and
+compares neighbours both across and down: a plain crop stretched to the hash
+grid, compared across only, gave a line and a filled bar the same hash. The
+index finds the closest stored hash within
+a Hamming distance using multi-index hashing: the hash is split into
+max_distance + 1 chunks, and by the pigeonhole principle any hash within that
+distance matches at least one chunk exactly, so a lookup only has to verify
+the few entries sharing a chunk instead of scanning the whole index.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageChops
+
+HASH_BITS = 128
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _content_box(gray):
+    """Bounding box of everything that isn't the (white) canvas background."""
+    background = Image.new("L", gray.size, 255)
+    return ImageChops.difference(gray, background).getbbox()
+
+
+def _square_crop(gray, box):
+    """The strokes centred on a white square, so the shrink doesn't stretch them."""
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+    side = max(width, height)
+    square = Image.new("L", (side, side), 255)
+    square.paste(gray.crop(box), ((side - width) // 2, (side - height) // 2))
+    return square
+
+
+def _gradient_bits(pixels, count, step):
+    # One bit per pixel: brighter than the neighbour `step` bytes further on
+    value = 0
+    for offset in count:
+        value = (value << 1) | (pixels[offset] > pixels[offset + step])
+    return value
+
+
+def dhash(image, hash_size=8):
+    """
+    128-bit difference hash of the drawn content: flatten transparency onto
+    white, crop to the strokes on a square canvas, shrink to grayscale and
+    record whether each pixel is brighter than its right-hand neighbour, then
+    whether it is brighter than the one below.
+    """
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        flattened = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+        flattened.alpha_composite(rgba)
+        image = flattened
+    gray = image.convert("L")
+
+    box = _content_box(gray)
+    if box:
+        gray = _square_crop(gray, box)
+
+    across = gray.resize((hash_size + 1, hash_size), Image.BILINEAR).tobytes()
+    down = gray.resize((hash_size, hash_size + 1), Image.BILINEAR).tobytes()
+    cells = range(hash_size)
+    horizontal = _gradient_bits(across, [row * (hash_size + 1) + col for row in cells for col in cells], 1)
+    vertical = _gradient_bits(down, [row * hash_size + col for row in cells for col in cells], hash_size)
+    return (horizontal << (hash_size * hash_size)) | vertical
+
+
+class SketchIndex:
+    """
+    Thread-safe near-duplicate index mapping perceptual hashes to stored
+    values, partitioned by namespace (e.g. theme + user prompt) and capped at
+    max_entries with least-recently-used eviction.
+    """
+
+    def __init__(self, max_distance=3, max_entries=200000):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        chunks = min(max_distance + 1, HASH_BITS)
+        bounds = [i * HASH_BITS // chunks for i in range(chunks + 1)]
+        self._chunks = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+
+        self._lock = threading.Lock()
+        # (namespace, hash) -> value, oldest first
+        self._entries = OrderedDict()
+        # (namespace, chunk index, chunk value) -> set of hashes
+        self._buckets = {}
+        self._counters = {"lookups": 0, "hits": 0, "inserts": 0, "evictions": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_distance=int(os.environ.get("SKETCH_INDEX_MAX_DISTANCE", 3)),
+            max_entries=int(os.environ.get("SKETCH_INDEX_MAX_ENTRIES", 200000)),
+        )
+
+    def _bucket_keys(self, namespace, value):
+        return [(namespace, i, (value >> shift) & mask) for i, (shift, mask) in enumerate(self._chunks)]
+
+    def _remove(self, namespace, value):
+        self._entries.pop((namespace, value), None)
+        for bucket_key in self._bucket_keys(namespace, value):
+            bucket = self._buckets.get(bucket_key)
+            if bucket is not None:
+                bucket.discard(value)
+                if not bucket:
+                    del self._buckets[bucket_key]
+
+    def add(self, value, namespace, payload):
+        with self._lock:
+            key = (namespace, value)
+            if key in self._entries:
+                self._entries[key] = payload
+                self._entries.move_to_end(key)
+                return
+            while len(self._entries) >= self.max_entries:
+                old_namespace, old_value = next(iter(self._entries))
+                self._remove(old_namespace, old_value)
+                self._counters["evictions"] += 1
+            self._entries[key] = payload
+            for bucket_key in self._bucket_keys(namespace, value):
+                self._buckets.setdefault(bucket_key, set()).add(value)
+            self._counters["inserts"] += 1
+
+    def lookup(self, value, namespace):
+        """
+        Return (distance, payload) for the closest stored hash within
+        max_distance in this namespace, or None.
+        """
+        with self._lock:
+            self._counters["lookups"] += 1
+            best = None
+            seen = set()
+            for bucket_key in self._bucket_keys(namespace, value):
+                for candidate in self._buckets.get(bucket_key, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = hamming(value, candidate)
+                    if distance <= self.max_distance and (best is None or distance < best[0]):
+                        best = (distance, candidate)
+                        if distance == 0:
+                            break
+            if best is None:
+                return None
+            key = (namespace, best[1])
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return best[0], self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+        stats["max_distance"] = self.max_distance
+        stats["max_entries"] = self.max_entries
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
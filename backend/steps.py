@@ -0,0 +1,233 @@
+"""
+One generation pipeline for the Flask and the asyncio server.
+
+The pipeline in app.py is written once, as generators. Besides the
+(event, payload) pairs for the client, a pipeline yields a Step wherever it
+needs blocking work done (an upstream call, a disk cache lookup, image
+encoding) and gets the step's result, or its exception, sent back in. The
+runner driving the generator decides how each step runs:
+
+- StepRunner (app.py) calls the named function in the calling thread,
+- AsyncStepRunner (asgi_app.py) awaits the server's async version when it
+  has one and runs the sync function on a worker thread otherwise, so no
+  step ever blocks the event loop.
+
+Sub-pipelines that return a value instead of yielding events are run with
+`yield from`; completed() runs several of them at once.
+"""
+import asyncio
+import weakref
+from concurrent.futures import as_completed
+
+
+class Step:
+    """Blocking work for the runner: the operation `name` called with args."""
+
+    __slots__ = ("name", "args", "kwargs")
+
+    def __init__(self, name, *args, **kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return f"Step({self.name!r})"
+
+
+def relay(pipeline, handle):
+    """
+    Sub-pipeline that passes pipeline's steps up to the runner and hands each
+    of its events to `handle`, a generator function, so the handler can run
+    steps and yield events of its own. Returns the pipeline's return value.
+    """
+    send, error = None, None
+    try:
+        while True:
+            try:
+                item = pipeline.throw(error) if error is not None else pipeline.send(send)
+            except StopIteration as stop:
+                return stop.value
+            send, error = None, None
+            if isinstance(item, Step):
+                try:
+                    send = yield item
+                except Exception as e:
+                    error = e
+            else:
+                yield from handle(item)
+    finally:
+        pipeline.close()
+
+
+def collect(pipeline):
+    """Sub-pipeline returning the events of `pipeline` as a list."""
+    events = []
+
+    def keep(item):
+        events.append(item)
+        yield from ()
+
+    yield from relay(pipeline, keep)
+    return events
+
+
+def completed(event, pipelines, pool):
+    """
+    Run sub-pipelines at once on the runner's `pool` and yield (event, result)
+    for each as it finishes. Ones not yet started are dropped if the
+    consumer goes away.
+    """
+    group = yield Step("start_all", pipelines, pool)
+    try:
+        for _ in pipelines:
+            yield event, (yield Step("next_done", group))
+    finally:
+        group.cancel()
+
+
+class _ThreadGroup:
+    def __init__(self, futures):
+        self.futures = futures
+        self.done = as_completed(futures)
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+
+class _TaskGroup:
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.done = iter(asyncio.as_completed(tasks))
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+
+class StepRunner:
+    """
+    Runs pipelines in the calling thread. `operation(name)` returns the
+    function for a step; `pools` maps the pool names used with completed()
+    to executors.
+    """
+
+    def __init__(self, operation, pools=None):
+        self.operation = operation
+        self.pools = pools or {}
+
+    def perform(self, step):
+        if step.name == "start_all":
+            pipelines, pool = step.args
+            return _ThreadGroup([self.pools[pool].submit(self.run, pipeline) for pipeline in pipelines])
+        if step.name == "next_done":
+            return next(step.args[0].done).result()
+        return self.operation(step.name)(*step.args, **step.kwargs)
+
+    def _advance(self, pipeline):
+        """Perform steps until the pipeline yields an event; returns (finished, event or return value)."""
+        send, error = None, None
+        while True:
+            try:
+                item = pipeline.throw(error) if error is not None else pipeline.send(send)
+            except StopIteration as stop:
+                return True, stop.value
+            send, error = None, None
+            if not isinstance(item, Step):
+                return False, item
+            try:
+                send = self.perform(item)
+            except Exception as e:
+                error = e
+
+    def events(self, pipeline):
+        """The pipeline's events, with its steps performed along the way."""
+        try:
+            while True:
+                finished, item = self._advance(pipeline)
+                if finished:
+                    return
+                yield item
+        finally:
+            pipeline.close()
+
+    def run(self, pipeline):
+        """Run a sub-pipeline to completion and return its result."""
+        finished, result = self._advance(pipeline)
+        if not finished:
+            pipeline.close()
+            raise RuntimeError(f"Expected a result from the pipeline, got the event {result!r}")
+        return result
+
+
+class AsyncStepRunner:
+    """
+    Runs pipelines on the event loop. `operation(name)` returns the async
+    function for a step, or None to run `fallback`'s sync one with
+    asyncio.to_thread. `limits` caps how many sub-pipelines of a pool run
+    at once on each loop.
+    """
+
+    def __init__(self, operation, fallback, limits=None):
+        self.operation = operation
+        self.fallback = fallback
+        self.limits = limits or {}
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _limit(self, pool):
+        loop = asyncio.get_running_loop()
+        semaphores = self._semaphores.setdefault(loop, {})
+        if pool not in semaphores:
+            semaphores[pool] = asyncio.Semaphore(self.limits[pool])
+        return semaphores[pool]
+
+    async def _run_in(self, pool, pipeline):
+        if pool not in self.limits:
+            return await self.run(pipeline)
+        async with self._limit(pool):
+            return await self.run(pipeline)
+
+    async def perform(self, step):
+        if step.name == "start_all":
+            pipelines, pool = step.args
+            return _TaskGroup([asyncio.ensure_future(self._run_in(pool, pipeline)) for pipeline in pipelines])
+        if step.name == "next_done":
+            return await next(step.args[0].done)
+        operation = self.operation(step.name)
+        if operation is not None:
+            return await operation(*step.args, **step.kwargs)
+        return await asyncio.to_thread(self.fallback.operation(step.name), *step.args, **step.kwargs)
+
+    async def _advance(self, pipeline):
+        send, error = None, None
+        while True:
+            try:
+                item = pipeline.throw(error) if error is not None else pipeline.send(send)
+            except StopIteration as stop:
+                return True, stop.value
+            send, error = None, None
+            if not isinstance(item, Step):
+                return False, item
+            try:
+                send = await self.perform(item)
+            except Exception as e:
+                error = e
+
+    async def events(self, pipeline):
+        """Async version of StepRunner.events()."""
+        try:
+            while True:
+                finished, item = await self._advance(pipeline)
+                if finished:
+                    return
+                yield item
+        finally:
+            pipeline.close()
+
+    async def run(self, pipeline):
+        """Async version of StepRunner.run()."""
+        finished, result = await self._advance(pipeline)
+        if not finished:
+            pipeline.close()
+            raise RuntimeError(f"Expected a result from the pipeline, got the event {result!r}")
+        return result
@@ -0,0 +1,288 @@
+"""
+Structured output for the one-pass Gemini call.
+
+The labelled free-text reply was split with regexes that depended on blank
+lines between sections, and every missed TRANSFORMATION_PROMPT quietly fell
+back to create_transformation_prompt. In structured mode (GEMINI_OUTPUT_MODE,
+the default) the call asks for JSON matching ONE_PASS_SCHEMA and the reply is
+parsed with a single json.loads. Replies that are not valid JSON (code fences,
+trailing commas, a cut-off tail) go through TolerantJsonScanner, which reads
+the text once and keeps every complete "key": "string" pair; labelled text is
+still understood after that. Outcomes are counted per theme. Upstreams that
+reject the JSON schema with a 4xx get the request again in labelled mode,
+which is then used for the rest of the process.
+
+The response profile (GEMINI_RESPONSE_PROFILE) sets how much the call asks
+for. Output tokens are the slowest part of the call, so "lean" asks for a
+one-sentence sketch_content (still needed to re-theme the sketch later, see
+analysis_memo.py) and caps every field; "verbose" keeps the detailed
+analysis for debugging. The caps set the word limits in the prompt; max_tokens
+leaves headroom above them, since a reply cut off by max_tokens loses its last
+fields. Token usage and latency are recorded per profile.
+"""
+import os
+import json
+import threading
+
+OUTPUT_MODES = ("structured", "labelled")
+
+ONE_PASS_FIELDS = ("sketch_content", "transformation_prompt", "title", "description")
+
+ONE_PASS_SCHEMA = {
+    "type": "object",
+    "properties": {field: {"type": "string"} for field in ONE_PASS_FIELDS},
+    "required": list(ONE_PASS_FIELDS),
+    "additionalProperties": False,
+}
+
+# Output token cap per field
+RESPONSE_PROFILES = {
+    "lean": {"sketch_content": 40, "transformation_prompt": 200, "title": 16, "description": 90},
+    "verbose": {"sketch_content": 400, "transformation_prompt": 350, "title": 20, "description": 150},
+}
+
+# Room for the JSON keys or section labels around the fields
+FORMAT_TOKENS = 40
+
+# max_tokens over the field caps: models overrun word limits, and a cut-off
+# reply loses the description and often the closing of the prompt
+MAX_TOKENS_HEADROOM = 1.5
+
+# "failed" means no transformation prompt was found and it was built locally
+OUTCOMES = ("json", "tolerant", "labelled", "failed")
+
+
+def output_mode():
+    mode = os.environ.get("GEMINI_OUTPUT_MODE", "structured").lower()
+    if mode not in OUTPUT_MODES:
+        raise ValueError(f"GEMINI_OUTPUT_MODE must be one of {OUTPUT_MODES}, got {mode!r}")
+    return mode
+
+
+def response_profile():
+    profile = os.environ.get("GEMINI_RESPONSE_PROFILE", "lean").lower()
+    if profile not in RESPONSE_PROFILES:
+        raise ValueError(f"GEMINI_RESPONSE_PROFILE must be one of {sorted(RESPONSE_PROFILES)}, got {profile!r}")
+    return profile
+
+
+def profile_max_tokens(profile):
+    """max_tokens for a one-pass call: every field at its cap with headroom, plus the format around them."""
+    return int(sum(RESPONSE_PROFILES[profile].values()) * MAX_TOKENS_HEADROOM) + FORMAT_TOKENS
+
+
+def word_limit(profile, field):
+    # About three words per four tokens of English
+    return max(1, RESPONSE_PROFILES[profile][field] * 3 // 4)
+
+
+def is_schema_rejection(error):
+    """True when the upstream refused the request itself (400/422), e.g. an unsupported response_format."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status in (400, 422)
+
+
+def response_format(name, schema):
+    """The chat completion `response_format` asking for JSON matching schema."""
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def strip_code_fence(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[text.find("\n") + 1:] if "\n" in text else ""
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+    return text.strip()
+
+
+def _unescape(raw):
+    # Models sometimes leave raw newlines and tabs inside strings
+    try:
+        return json.loads('"' + raw.replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t") + '"')
+    except ValueError:
+        return raw
+
+
+class TolerantJsonScanner:
+    """
+    Single-pass scanner for almost-JSON. Text can be fed in chunks (e.g. a
+    streamed completion); values holds every wanted field whose string
+    value is complete so far. Anything that isn't a "key": "string" pair is
+    skipped, so fences, prose and trailing commas around it don't matter.
+    """
+
+    def __init__(self, fields):
+        self.fields = set(fields)
+        self.values = {}
+        self._buffer = ""
+        self._pos = 0
+        # Key whose value comes next
+        self._key = None
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        while self._step():
+            pass
+        return self.values
+
+    def _skip_space(self, pos):
+        while pos < len(self._buffer) and self._buffer[pos].isspace():
+            pos += 1
+        return pos
+
+    def _string_end(self, start):
+        pos = start + 1
+        while pos < len(self._buffer):
+            char = self._buffer[pos]
+            if char == "\\":
+                pos += 2
+            elif char == '"':
+                return pos
+            else:
+                pos += 1
+        return None
+
+    def _step(self):
+        """Consume one token; False when more text is needed."""
+        buffer = self._buffer
+        if self._key is not None:
+            start = self._skip_space(self._pos)
+            if start == len(buffer):
+                return False
+            if buffer[start] != '"':
+                # Not a string value (number, object, list...)
+                self._key = None
+                self._pos = start
+                return True
+        else:
+            start = buffer.find('"', self._pos)
+            if start == -1:
+                self._pos = len(buffer)
+                return False
+
+        end = self._string_end(start)
+        if end is None:
+            self._pos = start
+            return False
+        text = buffer[start + 1:end]
+
+        if self._key is not None:
+            key, self._key = self._key, None
+            value = _unescape(text).strip()
+            if key in self.fields and key not in self.values and value:
+                self.values[key] = value
+            self._pos = end + 1
+            return True
+
+        after = self._skip_space(end + 1)
+        if after == len(buffer):
+            # Can't tell a key from a value yet
+            self._pos = start
+            return False
+        if buffer[after] == ":":
+            self._key = _unescape(text).strip().lower()
+            self._pos = after + 1
+        else:
+            self._pos = end + 1
+        return True
+
+
+def parse_json_fields(text, fields):
+    """
+    String fields of a JSON reply. Returns (values, outcome): outcome is
+    "json" when the reply parsed as JSON, "tolerant" when only the scanner
+    found fields, or None when neither did.
+    """
+    body = strip_code_fence(text)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        values = {}
+        for key, value in data.items():
+            key = str(key).lower()
+            if key in fields and isinstance(value, str) and value.strip():
+                values[key] = value.strip()
+        return values, "json"
+
+    values = TolerantJsonScanner(fields).feed(body)
+    return values, "tolerant" if values else None
+
+
+class ParseStats:
+    """Parse outcomes of the one-pass reply, per theme."""
+
+    def __init__(self, mode="structured"):
+        # The output mode in use; it drops to "labelled" after a schema rejection
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._themes = {}
+        self._schema_rejections = 0
+
+    def schema_rejected(self):
+        with self._lock:
+            self._schema_rejections += 1
+            self.mode = "labelled"
+
+    def record(self, theme, outcome):
+        with self._lock:
+            counts = self._themes.setdefault(theme, dict.fromkeys(OUTCOMES, 0))
+            counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            themes = {theme: dict(counts) for theme, counts in self._themes.items()}
+        for counts in themes.values():
+            total = sum(counts.values())
+            counts["success_rate"] = round(1 - counts["failed"] / total, 4) if total else 0.0
+        total = sum(sum(counts[outcome] for outcome in OUTCOMES) for counts in themes.values())
+        failed = sum(counts["failed"] for counts in themes.values())
+        return {
+            "mode": self.mode,
+            "schema_rejections": self._schema_rejections,
+            "parsed": total,
+            "success_rate": round(1 - failed / total, 4) if total else 0.0,
+            "themes": themes,
+        }
+
+
+class ProfileStats:
+    """Token usage and latency of the one-pass call, per response profile."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = {}
+
+    def record(self, profile, seconds, usage=None):
+        """usage is the completion's usage object, when the upstream reports one."""
+        with self._lock:
+            counts = self._profiles.setdefault(profile, {
+                "calls": 0, "seconds": 0.0, "reported": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            })
+            counts["calls"] += 1
+            counts["seconds"] += seconds
+            if usage is not None:
+                counts["reported"] += 1
+                counts["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+                counts["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+    def stats(self):
+        with self._lock:
+            profiles = {profile: dict(counts) for profile, counts in self._profiles.items()}
+        stats = {}
+        for profile, counts in profiles.items():
+            reported = counts["reported"]
+            stats[profile] = {
+                "calls": counts["calls"],
+                "avg_latency_ms": round(counts["seconds"] / counts["calls"] * 1000, 1),
+                "avg_prompt_tokens": round(counts["prompt_tokens"] / reported, 1) if reported else None,
+                "avg_completion_tokens": round(counts["completion_tokens"] / reported, 1) if reported else None,
+                "prompt_tokens": counts["prompt_tokens"],
+                "completion_tokens": counts["completion_tokens"],
+                "max_tokens": profile_max_tokens(profile),
+            }
+        return stats
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, render_metrics
+
+
+def test_full_queue_is_rejected_at_once():
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    ticket = controller.acquire()
+    start = time.monotonic()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire()
+    assert time.monotonic() - start < 0.1
+    assert rejected.value.reason == "queue_full"
+    assert 1 <= rejected.value.retry_after <= 60
+
+    ticket.release()
+    ticket.release()
+    controller.acquire().release()
+    stats = controller.stats()
+    assert stats["admitted"] == 2
+    assert stats["active"] == 0
+    assert stats["rejected"] == {"queue_full": 1, "timeout": 0}
+
+
+def test_released_slot_goes_to_the_oldest_waiter():
+    controller = AdmissionController(max_concurrent=1, max_queue=2)
+    ticket = controller.acquire()
+    order = []
+
+    def wait(name):
+        controller.acquire().release()
+        order.append(name)
+
+    threads = []
+    for name in ("first", "second"):
+        thread = threading.Thread(target=wait, args=(name,))
+        thread.start()
+        threads.append(thread)
+        while controller.stats()["queue_depth"] < len(threads):
+            time.sleep(0.001)
+
+    ticket.release()
+    for thread in threads:
+        thread.join(1)
+    assert order == ["first", "second"]
+    assert controller.stats()["active"] == 0
+
+
+def test_standing_queue_sheds_at_target_delay():
+    controller = AdmissionController(max_concurrent=1, max_queue=4, max_wait=0.3, target_delay=0.01, interval=0.05)
+    ticket = controller.acquire()
+
+    # A queued request waits out max_wait, which is well past the target delay
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire()
+    assert rejected.value.reason == "timeout"
+
+    # The queue has stood above target for a whole interval: shed quickly
+    time.sleep(0.06)
+    start = time.monotonic()
+    with pytest.raises(AdmissionRejected):
+        controller.acquire()
+    assert time.monotonic() - start < 0.2
+    assert controller.stats()["overloaded"] is True
+    ticket.release()
+
+
+def test_async_acquire_waits_for_a_slot():
+    controller = AdmissionController(max_concurrent=1, max_queue=1)
+
+    async def run():
+        ticket = await controller.acquire_async()
+        waiting = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0.01)
+        assert controller.stats()["queue_depth"] == 1
+        ticket.release()
+        (await waiting).release()
+
+        # A cancelled waiter leaves the queue
+        ticket = await controller.acquire_async()
+        waiting = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        ticket.release()
+
+    asyncio.run(run())
+    stats = controller.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["active"] == 0
+
+
+def test_render_metrics():
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    ticket = controller.acquire()
+    with pytest.raises(AdmissionRejected):
+        controller.acquire()
+    text = render_metrics(controller.stats())
+    assert "sketchify_admission_active 1" in text
+    assert "sketchify_admission_queue_depth 0" in text
+    assert 'sketchify_admission_rejected_total{reason="queue_full"} 1' in text
+    ticket.release()
+
+
+def test_limits_fit_in_the_thread_pool(monkeypatch):
+    monkeypatch.delenv("ADMISSION_MAX_CONCURRENT", raising=False)
+    monkeypatch.delenv("ADMISSION_MAX_QUEUE", raising=False)
+    for threads in (1, 2, 8, 32):
+        controller = AdmissionController.from_env(threads)
+        assert controller.max_concurrent >= 1
+        assert controller.max_concurrent + controller.max_queue < max(threads, 2)
+    controller = AdmissionController.from_env(32)
+    assert (controller.max_concurrent, controller.max_queue) == (8, 20)
+    assert (AdmissionController.from_env().max_concurrent, AdmissionController.from_env().max_queue) == (8, 16)
@@ -0,0 +1,288 @@
+import asyncio
+import base64
+import io
+import json
+
+import httpx
+import pytest
+from PIL import Image
+
+import app as app_module
+import asgi_app
+from analysis_memo import AnalysisMemo
+
+
+def call(method, path, **kwargs):
+    """Send one request through the ASGI app and return the response"""
+    async def send():
+        transport = httpx.ASGITransport(app=asgi_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.request(method, path, **kwargs)
+    return asyncio.run(send())
+
+
+@pytest.fixture(autouse=True)
+def fresh_analysis_memo(monkeypatch):
+    monkeypatch.setattr(app_module, "analysis_memo", AnalysisMemo())
+
+
+@pytest.fixture
+def sample_image():
+    """Create a sample test image"""
+    img = Image.new('RGB', (100, 100), color='white')
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='PNG')
+    return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+
+
+def test_home_endpoint():
+    """Test the ASGI home endpoint matches the Flask one"""
+    response = call("GET", "/")
+    assert response.status_code == 200
+    assert response.json()["message"] == "Welcome to Sketchify.ai Single-Call API"
+    assert response.headers["access-control-allow-origin"] == "*"
+
+
+def test_unknown_route():
+    response = call("GET", "/missing")
+    assert response.status_code == 404
+
+
+def test_generate_prompt_no_image():
+    """Test generate-prompt endpoint with missing image"""
+    response = call("POST", "/generate-prompt", json={"theme": "Minimalism"})
+    assert response.status_code == 400
+    assert "error" in response.json()
+
+
+def test_malformed_json_is_rejected():
+    """Test a body that isn't valid JSON gets 400, not 500"""
+    response = call("POST", "/generate-prompt", content=b"{not json", headers={"content-type": "application/json"})
+    assert response.status_code == 400
+    assert "error" in response.json()
+
+
+@pytest.mark.parametrize("fake_async_upstream", [{"analysis": {
+    "sketch_content": "A house",
+    "transformation_prompt": "A minimalist house",
+    "title": "Quiet House",
+    "description": "A small house drawn with clean lines.",
+}}], indirect=True)
+def test_generate_prompt_runs_async_pipeline(fake_async_upstream, sample_image):
+    """Test the async pipeline keeps the Flask response contract"""
+    response = call("POST", "/generate-prompt", json={
+        "image": f"data:image/png;base64,{sample_image}",
+        "theme": "Minimalism",
+    })
+    assert response.status_code == 200
+    data = response.json()
+    assert data == {
+        "image": "aW1n",
+        "description": "A small house drawn with clean lines.",
+        "prompt": "A small house drawn with clean lines.",
+        "title": "Quiet House",
+    }
+    assert fake_async_upstream.requests["imagen"][0]["prompt"] == "A minimalist house"
+
+
+@pytest.mark.parametrize("fake_async_upstream", [{"analysis": {
+    "sketch_content": "A boat",
+    "transformation_prompt": "An anime boat",
+    "title": "Boat at Dawn",
+    "description": "A small boat at dawn.",
+}}], indirect=True)
+def test_generate_prompt_streams_ndjson(fake_async_upstream, sample_image):
+    """Test NDJSON streaming mode on the ASGI app"""
+
+    response = call("POST", "/generate-prompt?stream=ndjson", json={
+        "image": f"data:image/png;base64,{sample_image}",
+        "theme": "Anime",
+        "prompt": "a boat",
+    })
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.strip().split("\n")]
+    assert [line["event"] for line in lines] == ["title", "description", "image", "timing"]
+    assert lines[0]["title"] == "Boat at Dawn"
+
+
+@pytest.mark.parametrize("fake_async_upstream", [{"analysis": {
+    "sketch_content": "A fish",
+    "transformation_prompt": "A watercolor fish",
+    "title": "Blue Fish",
+    "description": "A fish in blue washes.",
+}}], indirect=True)
+def test_generate_batch_streams_items(fake_async_upstream, sample_image):
+    """Test the ASGI batch endpoint streams one line per item and a summary"""
+
+    response = call("POST", "/generate-batch", json={"items": [
+        {"image": sample_image, "theme": "Watercolor", "prompt": "a batch fish"},
+        {"theme": "Watercolor"},
+    ]})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.strip().split("\n")]
+    assert sorted(line["status"] for line in lines[:-1]) == [200, 400]
+    assert lines[-1] == {"event": "done", "items": 2, "succeeded": 1, "failed": 1}
+
+
+def test_generate_prompt_theme_fanout(monkeypatch, sample_image, fake_async_upstream):
+    """Test the async multi-theme pipeline renders every theme from one analysis"""
+    analyses = []
+
+    async def fake_analysis(image_base64, theme_names, user_prompt="", deadline=None, complexity="standard"):
+        analyses.append(theme_names)
+        return {
+            "sketch_content": "A bridge",
+            "title": "Long Bridge",
+            "themes": {name: {"transformation_prompt": f"A {name} bridge", "description": f"A {name} bridge."} for name in theme_names},
+        }
+
+    def image(kwargs):
+        if "Realism" in kwargs["prompt"]:
+            raise RuntimeError("quota exceeded")
+        return "aW1n"
+
+    fake_async_upstream.image = image
+    monkeypatch.setattr(asgi_app, "multi_theme_gemini_request", fake_analysis)
+
+    response = call("POST", "/generate-prompt", json={
+        "image": sample_image,
+        "themes": ["Abstract", "Realism"],
+        "prompt": "an async fanout bridge",
+    })
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results["Abstract"]["description"] == "A Abstract bridge."
+    assert results["Realism"]["status"] == 500
+    assert analyses == [["Abstract", "Realism"]]
+
+
+@pytest.mark.parametrize("fake_async_upstream", [{
+    "analysis": {
+        "sketch_content": "A windmill in a field",
+        "transformation_prompt": "A realistic windmill",
+        "title": "Turning Sails",
+        "description": "A windmill at noon.",
+    },
+    "chat": "TRANSFORMATION_PROMPT: A cartoon windmill\n\nDESCRIPTION: A cheerful cartoon windmill.",
+}], indirect=True)
+def test_retheme_skips_vision_call(monkeypatch, sample_image, fake_async_upstream):
+    """Test the async pipeline re-themes a known sketch with a text-only call"""
+    monkeypatch.setattr(app_module, "sketch_index", None)
+
+    call("POST", "/generate-prompt", json={"image": sample_image, "theme": "Realism", "prompt": "async memo windmill"})
+    response = call("POST", "/generate-prompt", json={"image": sample_image, "theme": "Cartoon", "prompt": "async memo windmill"})
+    assert response.json()["description"] == "A cheerful cartoon windmill."
+    assert response.json()["title"] == "Turning Sails"
+    assert fake_async_upstream.calls.count("gemini") == 1
+    assert "A windmill in a field" in fake_async_upstream.requests["chat"][0]["messages"][1]["content"]
+
+
+@pytest.mark.parametrize("fake_async_upstream", [{"analysis": {
+    "sketch_content": "A boat",
+    "transformation_prompt": "A watercolor boat",
+    "title": "Harbor Morning",
+    "description": "A boat in a calm harbor.",
+}}], indirect=True)
+def test_metrics_endpoint(monkeypatch, sample_image, fake_async_upstream):
+    """Test the ASGI pipeline records stage latency and serves /metrics"""
+    from metrics import PipelineMetrics
+
+    metrics = PipelineMetrics()
+    monkeypatch.setattr(app_module, "pipeline_metrics", metrics)
+    app_module.result_cache.clear()
+
+    response = call("POST", "/generate-prompt", json={"image": sample_image, "theme": "Realism", "prompt": "asgi metrics boat"})
+    assert response.status_code == 200
+
+    labels = {"theme": "Realism", "complexity": "standard"}
+    assert metrics.stage_seconds.count(stage="image", **labels) == 1
+    assert metrics.stage_seconds.count(stage="serialize", **labels) == 1
+
+    response = call("GET", "/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'sketchify_stage_seconds_count{stage="decode",theme="Realism",complexity="standard"} 1' in response.text
+
+
+def test_requests_are_logged_without_payloads(monkeypatch, caplog):
+    """Test the ASGI app logs one structured line per request with the response status"""
+    import logging
+
+    monkeypatch.setattr(app_module.request_logger, "sample_rate", 1.0)
+    with caplog.at_level(logging.INFO, logger="sketchify.requests"):
+        call("POST", "/generate-prompt", json={"theme": "Minimalism", "image": ""})
+        call("GET", "/missing")
+
+    records = [record.fields for record in caplog.records if record.name == "sketchify.requests"]
+    assert [(fields["path"], fields["status"]) for fields in records] == [("/generate-prompt", 400), ("/missing", 404)]
+    assert records[0]["request"] == {"theme": "Minimalism", "image": ""}
+
+
+@pytest.mark.parametrize("fake_async_upstream", [{"analysis": {
+    "sketch_content": "A lantern",
+    "transformation_prompt": "An anime lantern",
+    "title": "Paper Lantern",
+    "description": "A glowing paper lantern.",
+}}], indirect=True)
+def test_raw_image_upload_with_multipart_response(fake_async_upstream, sample_image):
+    """Test a raw image/png body with query fields can get multipart/mixed back"""
+    import email
+
+    fake_async_upstream.image = sample_image
+    app_module.result_cache.clear()
+
+    image = base64.b64decode(sample_image)
+    response = call(
+        "POST", "/generate-prompt?theme=Anime&prompt=raw%20lantern",
+        content=image, headers={"Content-Type": "image/png", "Accept": "multipart/mixed"},
+    )
+    assert response.status_code == 200
+    message = email.message_from_bytes(f"Content-Type: {response.headers['content-type']}\r\n\r\n".encode() + response.content)
+    metadata, image_part = message.get_payload()
+    assert json.loads(metadata.get_payload(decode=True))["title"] == "Paper Lantern"
+    assert image_part.get_payload(decode=True) == image
+
+
+@pytest.mark.parametrize("fake_async_upstream", [{"analysis": {
+    "sketch_content": "A teapot",
+    "transformation_prompt": "A minimalist teapot",
+    "title": "Tea Time",
+    "description": "A simple teapot.",
+}}], indirect=True)
+def test_generate_prompt_transcodes_output(fake_async_upstream, sample_image):
+    """Test the ASGI app transcodes generated images to the requested format"""
+    fake_async_upstream.image = sample_image
+    app_module.result_cache.clear()
+
+    response = call("POST", "/generate-prompt", json={
+        "theme": "Minimalism", "prompt": "transcoded teapot", "image": sample_image,
+        "output_format": "webp", "tiers": "thumbnail,full",
+    })
+    assert response.status_code == 200
+    data = response.json()
+    assert data["output"]["mimetype"] == "image/webp"
+    assert data["output"]["tier"] == "full"
+    assert "thumbnail" in data["tiers"]
+
+    response = call("POST", "/generate-prompt", json={"theme": "Minimalism", "image": sample_image, "tiers": ["poster"]})
+    assert response.status_code == 400
+
+
+def test_generate_prompt_sheds_load(monkeypatch, sample_image):
+    from admission import AdmissionController
+
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    monkeypatch.setattr(asgi_app, "admission", controller)
+    ticket = controller.acquire()
+
+    response = call("POST", "/generate-prompt", json={"theme": "Anime", "image": sample_image})
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+
+    ticket.release()
+    response = call("POST", "/generate-prompt", json={"theme": "Anime"})
+    assert response.status_code == 400
+    assert controller.stats()["active"] == 0
+    assert controller.stats()["rejected"]["queue_full"] == 1
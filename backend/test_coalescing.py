@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+
+from coalescing import SingleFlight
+
+
+def test_followers_share_the_leader_outcome():
+    """Test concurrent joins on one key get a single leader and its outcome"""
+    flights = SingleFlight()
+    flight, leader = flights.join("key")
+    assert leader
+
+    results = []
+
+    def follower():
+        other, is_leader = flights.join("key")
+        assert not is_leader
+        results.append(other.wait(5))
+
+    threads = [threading.Thread(target=follower) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while flights.stats()["coalesced"] < 3:
+        time.sleep(0.01)
+    flights.finish("key", flight, [("image", {"image": "aW1n"})])
+    for thread in threads:
+        thread.join()
+
+    assert results == [[("image", {"image": "aW1n"})]] * 3
+    stats = flights.stats()
+    assert stats["in_flight"] == 0
+    assert stats["upstream_calls_saved"] == 6
+
+    # The key is free again once the leader has finished
+    assert flights.join("key")[1]
+
+
+def test_async_wait_is_woken_from_another_thread():
+    flights = SingleFlight()
+    flight, _ = flights.join("key")
+
+    async def main():
+        threading.Timer(0.05, flights.finish, args=("key", flight, ["done"])).start()
+        return await flight.wait_async(5)
+
+    assert asyncio.run(main()) == ["done"]
+
+
+def test_timed_out_follower_counts_as_rerun():
+    flights = SingleFlight(wait_timeout=0.01)
+    flights.join("key")
+    flight, leader = flights.join("key")
+    assert not leader
+    assert flight.wait(flights.wait_timeout) is None
+    flights.record_rerun()
+    assert flights.stats()["upstream_calls_saved"] == 0
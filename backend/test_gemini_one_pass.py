@@ -3,7 +3,11 @@ import base64
 from PIL import Image
 import io
 import json
+import logging
+from types import SimpleNamespace
 from app import app, create_transformation_prompt, all_in_one_gemini_request
+from analysis_memo import AnalysisMemo
+from resilience import DeadlineExceeded
 
 @pytest.fixture
 def client():
@@ -13,6 +17,15 @@ def client():
         yield client
 
 
+# Every test sees the sample sketch for the first time
+@pytest.fixture(autouse=True)
+def fresh_analysis_memo(monkeypatch):
+    import app as app_module
+    memo = AnalysisMemo()
+    monkeypatch.setattr(app_module, "analysis_memo", memo)
+    return memo
+
+
 # This Function is utilized to createa  simple image translated to a base 64 string
 @pytest.fixture
 def sample_image():
@@ -102,4 +115,737 @@ def test_generate_prompt_valid_request(client, sample_image):
         assert "description" in data
         assert "prompt" in data
     else:
-        assert response.status_code in [401, 403, 500]
\ No newline at end of file
+        assert response.status_code in [401, 403, 500]
+
+# The upstream client is shared across requests instead of rebuilt per call
+def test_get_client_is_shared(monkeypatch):
+    """Test get_client reuses the pooled upstream client"""
+    import app as app_module
+    monkeypatch.setattr(app_module, "api_key", "test-key")
+    assert app_module.get_client() is app_module.get_client()
+
+def test_stats_endpoint(client):
+    """Test stats endpoint exposes upstream pool usage"""
+    response = client.get('/stats')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert "upstream" in data
+    assert data["upstream"]["pool_size"] > 0
+    assert "connections" in data["upstream"]
+
+def test_pool_fits_every_upstream_worker(monkeypatch):
+    """Test the default pool has a connection for every thread that can call upstream"""
+    from upstream import UpstreamClientManager, pipeline_threads
+    monkeypatch.delenv("UPSTREAM_POOL_SIZE", raising=False)
+    monkeypatch.setenv("TITLE_WORKERS", "3")
+    monkeypatch.setenv("HEDGE_ENABLED", "0")
+    assert UpstreamClientManager().pool_size == pipeline_threads() + 3
+    monkeypatch.setenv("HEDGE_ENABLED", "1")
+    monkeypatch.setenv("HEDGE_WORKERS", "5")
+    assert UpstreamClientManager().pool_size == pipeline_threads() + 8
+
+# Resubmitting the same sketch is served from the result cache
+@pytest.mark.parametrize("fake_upstream", [{"analysis": {
+    "sketch_content": "A fox",
+    "transformation_prompt": "An anime fox",
+    "title": "Fox in the Snow",
+    "description": "A fox sitting in fresh snow.",
+}}], indirect=True)
+def test_generate_prompt_uses_result_cache(client, sample_image, fake_upstream):
+    """Test an identical resubmission skips the Gemini and Imagen calls"""
+    import app as app_module
+    app_module.result_cache.clear()
+
+    payload = {"image": f"data:image/png;base64,{sample_image}", "theme": "Anime", "prompt": "snow"}
+    first = client.post('/generate-prompt', json=payload)
+    second = client.post('/generate-prompt', json=payload)
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert json.loads(first.data) == json.loads(second.data)
+    assert fake_upstream.calls == ["gemini", "imagen"]
+
+# Near-duplicate sketches reuse the earlier Gemini analysis
+@pytest.mark.parametrize("fake_upstream", [{"analysis": {
+    "sketch_content": "A house",
+    "transformation_prompt": "A cartoon house",
+    "title": "Little Red House",
+    "description": "A cheerful little house.",
+}}], indirect=True)
+def test_generate_prompt_reuses_similar_analysis(client, fake_upstream):
+    """Test a sketch differing by a stray pixel only runs the Imagen step"""
+    from PIL import ImageDraw
+
+    def house(stray_pixel):
+        img = Image.new('RGB', (200, 200), color='white')
+        draw = ImageDraw.Draw(img)
+        draw.rectangle([50, 90, 150, 170], outline='black', width=4)
+        if stray_pixel:
+            draw.point((120, 130), fill='black')
+        buffer = io.BytesIO()
+        img.save(buffer, format='PNG')
+        return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+    for stray_pixel in (False, True):
+        response = client.post('/generate-prompt', json={"image": house(stray_pixel), "theme": "Cartoon"})
+        assert response.status_code == 200
+        assert json.loads(response.data)["title"] == "Little Red House"
+    assert fake_upstream.calls == ["gemini", "imagen", "imagen"]
+
+# Opt-in streaming sends the text before the image
+@pytest.mark.parametrize("fake_upstream", [{"analysis": {
+    "sketch_content": "A tree",
+    "transformation_prompt": "A realistic oak tree",
+    "title": "Lonely Oak",
+    "description": "A single oak tree on a hill.",
+}}], indirect=True)
+def test_generate_prompt_streams_events(client, sample_image, fake_upstream):
+    """Test SSE mode emits title, description, image and timing events in order"""
+
+
+    response = client.post('/generate-prompt', json={
+        "image": f"data:image/png;base64,{sample_image}",
+        "theme": "Realism",
+        "prompt": "an oak",
+    }, headers={"Accept": "text/event-stream"})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    events = [block.split("\n") for block in response.get_data(as_text=True).strip().split("\n\n")]
+    names = [lines[0][len("event: "):] for lines in events]
+    assert names == ["title", "description", "image", "timing"]
+    assert json.loads(events[0][1][len("data: "):]) == {"title": "Lonely Oak"}
+    assert json.loads(events[2][1][len("data: "):]) == {"image": "aW1n"}
+
+# Jobs accept the /generate-prompt payload and run it in the background
+@pytest.mark.parametrize("fake_upstream", [{"analysis": {
+    "sketch_content": "A cat",
+    "transformation_prompt": "An abstract cat",
+    "title": "Curious Cat",
+    "description": "A cat made of swirling shapes.",
+}}], indirect=True)
+def test_job_endpoints(client, sample_image, fake_upstream):
+    """Test POST /jobs returns an id and GET /jobs/<id> long-polls for the result"""
+
+
+    response = client.post('/jobs', json={"image": sample_image, "theme": "Abstract", "prompt": "a cat"})
+    assert response.status_code == 202
+    job = json.loads(response.data)
+    assert job["status_url"] == f"/jobs/{job['id']}"
+
+    response = client.get(f"/jobs/{job['id']}?wait=5")
+    assert response.status_code == 200
+    job = json.loads(response.data)
+    assert job["status"] == "succeeded"
+    assert job["result"]["title"] == "Curious Cat"
+
+    assert client.get('/jobs/unknown').status_code == 404
+    assert client.post('/jobs', json={"theme": "Abstract"}).status_code == 400
+
+# Identical requests that arrive while the first is still running share its result
+def test_concurrent_duplicates_are_coalesced(sample_image, monkeypatch, fake_upstream):
+    """Test duplicate in-flight requests make a single set of upstream calls"""
+    import time
+    import threading
+    import app as app_module
+
+    release = threading.Event()
+
+    def slow_gemini(**kwargs):
+        release.wait(5)
+        return {
+            "sketch_content": "A kite",
+            "transformation_prompt": "An abstract kite",
+            "title": "Kite",
+            "description": "A kite over a windy hill.",
+        }
+
+    fake_upstream.analysis = slow_gemini
+    monkeypatch.setattr(app_module, "sketch_index", None)
+    monkeypatch.setattr(app_module, "result_cache", None)
+
+    payload = {"image": sample_image, "theme": "Abstract", "prompt": "a kite", "complexity": "medium"}
+    coalesced_before = app_module.in_flight.stats()["coalesced"]
+    results = []
+
+    def post():
+        response = app_module.app.test_client().post('/generate-prompt', json=payload)
+        results.append((response.status_code, json.loads(response.data)["title"]))
+
+    threads = [threading.Thread(target=post) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while app_module.in_flight.stats()["coalesced"] - coalesced_before < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    coalesced = app_module.in_flight.stats()["coalesced"] - coalesced_before
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert coalesced == 2
+    assert results == [(200, "Kite")] * 3
+    assert fake_upstream.calls.count("gemini") == 1
+
+# Batch items run independently and stream back as they finish
+@pytest.mark.parametrize("fake_upstream", [{"analysis": {
+    "sketch_content": "A tree",
+    "transformation_prompt": "A cartoon tree",
+    "title": "Happy Tree",
+    "description": "A tree with a big smile.",
+}}], indirect=True)
+def test_generate_batch_streams_items(client, sample_image, fake_upstream):
+    """Test one failing item does not fail the rest of the batch"""
+
+
+    response = client.post('/generate-batch', json={"items": [
+        {"image": sample_image, "theme": "Cartoon", "prompt": "a batch tree"},
+        {"theme": "Cartoon"},
+        "not an item",
+    ]})
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.data.decode().strip().split("\n")]
+
+    items = {line["index"]: line for line in lines if line["event"] == "item"}
+    assert items[0]["status"] == 200
+    assert items[0]["title"] == "Happy Tree"
+    assert items[1]["status"] == 400
+    assert items[2]["status"] == 400
+    assert lines[-1] == {"event": "done", "items": 3, "succeeded": 1, "failed": 2}
+
+    assert client.post('/generate-batch', json={"items": []}).status_code == 400
+
+# One analysis shared by several themes
+def test_parse_multi_theme_response_falls_back_per_theme():
+    """Test missing theme sections get local defaults"""
+    from app import parse_multi_theme_response
+
+    analysis = parse_multi_theme_response(
+        "SKETCH_CONTENT: A cat on a fence\n\nTITLE: \"Fence Sitter\"\n\n"
+        "PROMPT_1: A minimalist cat on a fence\n\nDESCRIPTION_1: Clean lines trace a cat.",
+        ["Minimalism", "Anime"],
+    )
+    assert analysis["title"] == "Fence Sitter"
+    assert analysis["themes"]["Minimalism"] == {
+        "transformation_prompt": "A minimalist cat on a fence",
+        "description": "Clean lines trace a cat.",
+    }
+    assert "Anime style" in analysis["themes"]["Anime"]["transformation_prompt"]
+    assert "A cat on a fence" in analysis["themes"]["Anime"]["transformation_prompt"]
+    assert analysis["themes"]["Anime"]["description"] == "A anime style artwork based on the sketch."
+
+
+@pytest.mark.parametrize("fake_upstream", [{"chat": (
+    "SKETCH_CONTENT: A rocket\n\nTITLE: Lift Off\n\n"
+    "PROMPT_1: An anime rocket\n\nDESCRIPTION_1: A rocket in anime style.\n\n"
+    "PROMPT_2: A cartoon rocket\n\nDESCRIPTION_2: A rocket in cartoon style."
+)}], indirect=True)
+def test_generate_prompt_theme_fanout(client, sample_image, fake_upstream):
+    """Test a themes list makes one vision call and one Imagen call per theme"""
+    image_prompts = fake_upstream.requests["imagen"]
+
+    response = client.post('/generate-prompt', json={
+        "image": sample_image,
+        "themes": ["Anime", "Cartoon", "Anime"],
+        "prompt": "a fanout rocket",
+    })
+    assert response.status_code == 200
+    results = json.loads(response.data)["results"]
+    assert set(results) == {"Anime", "Cartoon"}
+    assert results["Cartoon"]["title"] == "Lift Off"
+    assert results["Cartoon"]["description"] == "A rocket in cartoon style."
+    assert results["Anime"]["status"] == 200
+    assert fake_upstream.calls.count("chat") == 1
+    assert sorted(kwargs["prompt"] for kwargs in image_prompts) == ["A cartoon rocket", "An anime rocket"]
+
+    # Both themes are now cached for this sketch and prompt
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Anime", "prompt": "a fanout rocket"})
+    assert json.loads(response.data)["title"] == "Lift Off"
+    assert len(image_prompts) == 2
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "themes": ["Vaporwave"]})
+    assert response.status_code == 400
+
+
+# A canvas re-themed after its first analysis skips the vision call
+@pytest.mark.parametrize("fake_upstream", [{
+    "analysis": {
+        "sketch_content": "A lighthouse on a cliff",
+        "transformation_prompt": "A minimalist lighthouse",
+        "title": "Lonely Lighthouse",
+        "description": "A lighthouse in a few clean lines.",
+        "fallback": False,
+    },
+    "chat": "TRANSFORMATION_PROMPT: An anime lighthouse\n\nDESCRIPTION: A lighthouse under an anime sky.",
+}], indirect=True)
+def test_retheme_uses_text_only_call(client, sample_image, monkeypatch, fake_upstream, fresh_analysis_memo):
+    """Test the second theme for a sketch is built from the memoized analysis"""
+    import app as app_module
+
+    monkeypatch.setattr(app_module, "sketch_index", None)
+
+    client.post('/generate-prompt', json={"image": sample_image, "theme": "Minimalism", "prompt": "memo lighthouse"})
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Anime", "prompt": "memo lighthouse"})
+    data = json.loads(response.data)
+
+    assert fake_upstream.calls.count("gemini") == 1
+    assert fake_upstream.calls.count("chat") == 1
+    # The prompt is text-only and carries the memoized analysis
+    text_prompt = fake_upstream.requests["chat"][0]["messages"][1]["content"]
+    assert isinstance(text_prompt, str)
+    assert "A lighthouse on a cliff" in text_prompt
+    assert data["title"] == "Lonely Lighthouse"
+    assert data["description"] == "A lighthouse under an anime sky."
+    assert fresh_analysis_memo.stats()["vision_calls_saved"] == 1
+
+
+def test_retheme_local_template(sample_image, monkeypatch):
+    """Test local mode builds the analysis without any upstream call"""
+    import app as app_module
+
+    memo = AnalysisMemo(mode="local")
+    monkeypatch.setattr(app_module, "analysis_memo", memo)
+    monkeypatch.setattr(app_module, "get_client", lambda: None)
+
+    analysis = app_module.retheme_gemini_request(
+        {"sketch_content": "A dog chasing a ball", "title": "Fetch Time"},
+        "Cartoon", *app_module.get_theme_prompt("Cartoon")[:2], user_prompt="sunny day"
+    )
+    assert analysis["title"] == "Fetch Time"
+    assert "Cartoon style" in analysis["transformation_prompt"]
+    assert "A dog chasing a ball" in analysis["transformation_prompt"]
+    assert "sunny day" in analysis["transformation_prompt"]
+    assert memo.stats()["local"] == 1
+
+
+# Upstream calls share one request deadline; running out of it is a 504
+def test_generate_prompt_deadline_exceeded(client, sample_image, monkeypatch):
+    """Test a request whose deadline runs out returns 504 and shows up on /breakers"""
+    import app as app_module
+
+    def slow_gemini(**kwargs):
+        raise DeadlineExceeded("Request deadline of 90s exceeded before the analysis stage")
+
+    monkeypatch.setattr(app_module, "all_in_one_gemini_request", slow_gemini)
+    app_module.result_cache.clear()
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Anime", "prompt": "deadline"})
+    assert response.status_code == 504
+
+    breakers = json.loads(client.get('/breakers').data)
+    assert "breakers" in breakers
+    assert breakers["retries"]["attempts"] >= 1
+
+
+# Per-stage latency and pipeline counters are exposed for Prometheus
+@pytest.mark.parametrize("fake_upstream", [{
+    "chat": "SKETCH_CONTENT: A kite\n\nTITLE: High Flyer\n\nDESCRIPTION: A kite in the wind.",
+}], indirect=True)
+def test_metrics_endpoint(client, sample_image, monkeypatch, fake_upstream):
+    """Test a generation shows up in the /metrics histograms and counters"""
+    import app as app_module
+    from metrics import PipelineMetrics
+
+    metrics = PipelineMetrics()
+    monkeypatch.setattr(app_module, "pipeline_metrics", metrics)
+    app_module.result_cache.clear()
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Anime", "prompt": "metrics kite", "complexity": "HD"})
+    assert response.status_code == 200
+
+    labels = {"theme": "Anime", "complexity": "hd"}
+    for stage in ("decode", "gemini", "parse", "image", "serialize"):
+        assert metrics.stage_seconds.count(stage=stage, **labels) == 1
+    # No TRANSFORMATION_PROMPT in the response, so the regex parse fell back
+    assert metrics.fallbacks.value(kind="parse", **labels) == 1
+    assert metrics.cache_events.value(cache="result", outcome="miss", **labels) == 1
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    body = response.data.decode()
+    assert 'sketchify_stage_seconds_count{stage="image",theme="Anime",complexity="hd"} 1' in body
+
+
+# Prompts over the user prompt budget are rejected, never silently cut
+def test_long_prompt_is_rejected(client, sample_image, fake_upstream):
+    """Test a prompt over its budget gets 400 before any upstream call"""
+    import app as app_module
+
+    response = client.post('/generate-prompt', json={
+        "image": sample_image, "theme": "Anime", "prompt": "a fox " * (app_module.prompt_budget.budgets["user_prompt"] * 2),
+    })
+    assert response.status_code == 400
+    assert "too long" in json.loads(response.data)["error"]
+    assert fake_upstream.calls == []
+
+
+# Requests are logged as one structured line with sizes and hashes, never the image itself
+def test_request_log_omits_image_payload(client, sample_image, monkeypatch, caplog):
+    """Test the request log line carries the body size and a hash of the image"""
+    import app as app_module
+
+    monkeypatch.setattr(app_module.request_logger, "sample_rate", 1.0)
+    with caplog.at_level(logging.INFO, logger="sketchify.requests"):
+        # Lines are written when the server closes the response
+        client.post('/generate-prompt', json={"theme": "Anime", "prompt": "x" * 300, "image": ""}).close()
+        client.get('/stats').close()
+
+    records = [record for record in caplog.records if record.name == "sketchify.requests"]
+    assert [record.fields["path"] for record in records] == ["/generate-prompt", "/stats"]
+    logged = records[0].fields
+    assert logged["status"] == 400
+    assert logged["body_bytes"] > 300
+    assert logged["request"]["theme"] == "Anime"
+    assert logged["request"]["prompt"]["length"] == 300
+
+
+# Streamed responses are logged when the last event has been sent
+@pytest.mark.parametrize("fake_upstream", [{"analysis": {
+    "sketch_content": "A kite",
+    "transformation_prompt": "An anime kite in the wind",
+    "title": "Kite Day",
+    "description": "A kite soars in anime style.",
+}}], indirect=True)
+def test_streamed_request_logged_after_last_event(client, sample_image, monkeypatch, caplog, fake_upstream):
+    """Test a streamed response is logged once its body is sent, not at the first byte"""
+    import app as app_module
+
+    monkeypatch.setattr(app_module.request_logger, "sample_rate", 1.0)
+    app_module.result_cache.clear()
+    with caplog.at_level(logging.INFO, logger="sketchify.requests"):
+        response = client.post('/generate-prompt?stream=ndjson', json={"theme": "Anime", "prompt": "logged kite", "image": sample_image}, buffered=False)
+        assert not [record for record in caplog.records if record.name == "sketchify.requests"]
+        assert b'"image"' in b"".join(response.response)
+        response.close()
+
+    records = [record for record in caplog.records if record.name == "sketchify.requests"]
+    assert [record.fields["status"] for record in records] == [200]
+
+
+# Binary transport: multipart upload in, raw image out
+@pytest.mark.parametrize("fake_upstream", [{"analysis": {
+    "sketch_content": "A sailboat",
+    "transformation_prompt": "A cartoon sailboat",
+    "title": "Smooth Sailing",
+    "description": "A sailboat on calm water.",
+}}], indirect=True)
+def test_generate_prompt_binary_transport(client, sample_image, fake_upstream):
+    """Test a multipart upload can get the image back as the response body"""
+    import app as app_module
+
+    fake_upstream.image = sample_image
+    app_module.result_cache.clear()
+
+    response = client.post(
+        '/generate-prompt',
+        data={"theme": "Cartoon", "prompt": "binary sailboat", "image": (io.BytesIO(base64.b64decode(sample_image)), "sketch.png")},
+        content_type="multipart/form-data",
+        headers={"Accept": "image/png"},
+    )
+    assert response.status_code == 200
+    assert response.content_type == "image/png"
+    assert response.data == base64.b64decode(sample_image)
+    assert response.headers["X-Sketchify-Title"] == "Smooth%20Sailing"
+
+    # JSON stays the default for the same upload
+    response = client.post(
+        '/generate-prompt',
+        data={"theme": "Cartoon", "prompt": "binary sailboat", "image": (io.BytesIO(base64.b64decode(sample_image)), "sketch.png")},
+        content_type="multipart/form-data",
+    )
+    assert json.loads(response.data)["title"] == "Smooth Sailing"
+
+
+# Output transcoding: smaller formats and size tiers for mobile clients
+@pytest.mark.parametrize("fake_upstream", [{"analysis": {
+    "sketch_content": "A bicycle",
+    "transformation_prompt": "A realistic bicycle",
+    "title": "Morning Ride",
+    "description": "A bicycle leaning on a wall.",
+}}], indirect=True)
+def test_generate_prompt_transcodes_output(client, sample_image, fake_upstream):
+    """Test output_format and tiers replace the PNG with smaller renditions"""
+    import app as app_module
+
+    fake_upstream.image = sample_image
+    app_module.result_cache.clear()
+
+    response = client.post('/generate-prompt', json={
+        "theme": "Realism", "prompt": "transcoded bicycle", "image": sample_image,
+        "output_format": "jpeg", "output_quality": 70, "tiers": ["thumbnail", "screen"],
+    })
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data["title"] == "Morning Ride"
+    assert data["output"]["format"] == "jpeg"
+    assert data["output"]["tier"] == "screen"
+    assert base64.b64decode(data["image"])[:3] == b"\xff\xd8\xff"
+    assert set(data["tiers"]) == {"thumbnail"}
+
+    # The cached PNG result is transcoded for the binary response too
+    response = client.post('/generate-prompt', json={
+        "theme": "Realism", "prompt": "transcoded bicycle", "image": sample_image, "output_format": "webp",
+    }, headers={"Accept": "image/png"})
+    assert response.content_type == "image/webp"
+
+    response = client.post('/generate-prompt', json={"theme": "Realism", "image": sample_image, "output_format": "tiff"})
+    assert response.status_code == 400
+
+
+# Structured output: the one-pass reply is requested and parsed as JSON
+@pytest.mark.parametrize("fake_upstream", [{"chat": json.dumps({
+    "sketch_content": "A snail",
+    "transformation_prompt": "A cartoon snail racing",
+    "title": "Slow and Steady",
+    "description": "A snail sprints in cartoon style.",
+})}], indirect=True)
+def test_one_pass_structured_output(client, sample_image, monkeypatch, fake_upstream):
+    """Test the one-pass call asks for a JSON schema and counts the parse per theme"""
+    import app as app_module
+    from structured_output import ParseStats
+
+    chat_calls = fake_upstream.requests["chat"]
+    monkeypatch.setattr(app_module, "parse_stats", ParseStats("structured"))
+    app_module.result_cache.clear()
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Cartoon", "prompt": "structured snail"})
+    assert response.status_code == 200
+    assert json.loads(response.data)["title"] == "Slow and Steady"
+    assert chat_calls[0]["response_format"]["type"] == "json_schema"
+
+    parsing = json.loads(client.get('/stats').data)["parsing"]
+    assert parsing["themes"]["Cartoon"]["json"] == 1
+    assert parsing["success_rate"] == 1.0
+
+
+# Structured output: an upstream that rejects the JSON schema gets labelled text instead
+def test_schema_rejection_switches_to_labelled(client, sample_image, monkeypatch, fake_upstream):
+    """Test a 400 for the response_format is retried once in labelled mode and remembered"""
+    import app as app_module
+    from structured_output import ParseStats
+
+    class SchemaRejected(Exception):
+        status_code = 400
+
+    def chat(request):
+        if "response_format" in request:
+            raise SchemaRejected("response_format is not supported")
+        return "SKETCH_CONTENT: A boat\n\nTRANSFORMATION_PROMPT: A realistic boat at sea\n\nTITLE: Harbour Light\n\nDESCRIPTION: A boat in oils."
+
+    fake_upstream.chat_content = chat
+    chat_calls = fake_upstream.requests["chat"]
+    monkeypatch.setattr(app_module, "parse_stats", ParseStats("structured"))
+    app_module.result_cache.clear()
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Realism", "prompt": "rejected boat"})
+    assert response.status_code == 200
+    assert json.loads(response.data)["title"] == "Harbour Light"
+    assert len(chat_calls) == 2
+    assert "Follow this format exactly" in chat_calls[1]["messages"][1]["content"][0]["text"]
+
+    # Later calls go straight to labelled mode
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Realism", "prompt": "second boat"})
+    assert response.status_code == 200
+    assert len(chat_calls) == 3
+    parsing = json.loads(client.get('/stats').data)["parsing"]
+    assert parsing["mode"] == "labelled"
+    assert parsing["schema_rejections"] == 1
+
+
+# Response profiles: a lean reply cut off by max_tokens keeps the fields it finished
+@pytest.mark.parametrize("fake_upstream", [{
+    "chat": '{"sketch_content": "A kettle", "transformation_prompt": "An anime kettle whistling on a stove", '
+            '"title": "Whistle Stop", "description": "A kettle steams in anime st',
+}], indirect=True)
+def test_truncated_lean_reply(client, sample_image, monkeypatch, fake_upstream):
+    """Test a lean reply truncated mid-description still uses the model's prompt and title"""
+    import app as app_module
+    from structured_output import ParseStats
+
+    monkeypatch.setattr(app_module, "GEMINI_RESPONSE_PROFILE", "lean")
+    monkeypatch.setattr(app_module, "parse_stats", ParseStats("structured"))
+    app_module.result_cache.clear()
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Anime", "prompt": "truncated kettle"})
+    assert response.status_code == 200
+    assert json.loads(response.data)["title"] == "Whistle Stop"
+    assert fake_upstream.requests["imagen"][0]["prompt"].startswith("An anime kettle whistling on a stove")
+    assert json.loads(client.get('/stats').data)["parsing"]["themes"]["Anime"]["tolerant"] == 1
+
+
+# Response profiles: the lean profile caps what the one-pass call asks for
+@pytest.mark.parametrize("fake_upstream", [{
+    "chat": json.dumps({
+        "sketch_content": "A kettle",
+        "transformation_prompt": "An anime kettle whistling",
+        "title": "Whistle Stop",
+        "description": "A kettle steams in anime style.",
+    }),
+    "usage": SimpleNamespace(prompt_tokens=900, completion_tokens=80),
+}], indirect=True)
+def test_lean_response_profile(client, sample_image, monkeypatch, fake_upstream):
+    """Test the lean profile caps max_tokens and records token usage per profile"""
+    import app as app_module
+    from structured_output import ProfileStats, profile_max_tokens
+
+    chat_calls = fake_upstream.requests["chat"]
+    monkeypatch.setattr(app_module, "GEMINI_RESPONSE_PROFILE", "lean")
+    monkeypatch.setattr(app_module, "profile_stats", ProfileStats())
+    app_module.result_cache.clear()
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Anime", "prompt": "lean kettle"})
+    assert response.status_code == 200
+    assert chat_calls[0]["max_tokens"] == profile_max_tokens("lean")
+    prompt_text = chat_calls[0]["messages"][1]["content"][0]["text"]
+    assert "detailed factual analysis" not in prompt_text
+    assert "at most" in prompt_text
+
+    profiles = json.loads(client.get('/stats').data)["response_profiles"]
+    assert profiles["active"] == "lean"
+    assert profiles["lean"]["completion_tokens"] == 80
+
+
+# Theme registry: themes added through THEMES_FILE are usable without a redeploy
+@pytest.mark.parametrize("fake_upstream", [{"analysis": {
+    "sketch_content": "A boat",
+    "transformation_prompt": "A watercolor boat",
+    "title": "Harbor Light",
+    "description": "A boat in soft washes.",
+}}], indirect=True)
+def test_theme_from_registry_file(client, sample_image, monkeypatch, tmp_path, fake_upstream):
+    """Test a theme loaded from a theme file renders and is counted in /stats"""
+    import app as app_module
+    from theme_registry import ThemeRegistry
+
+    path = tmp_path / "themes.json"
+    path.write_text(json.dumps({"version": "2024-06", "themes": {"Watercolor": {
+        "system_content": "You are a watercolor specialist. Use soft washes and bleeding edges.",
+        "user_text": "Translate this sketch into a watercolor description. Focus on soft washes.",
+        "temperature": 0.6,
+    }}}))
+    monkeypatch.setattr(app_module, "theme_registry", ThemeRegistry(path=str(path)))
+
+    app_module.result_cache.clear()
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Watercolor", "prompt": "registry boat"})
+    assert response.status_code == 200
+    assert "watercolor specialist" in fake_upstream.requests["gemini"][0]["theme_context"]
+
+    themes = json.loads(client.get('/stats').data)["themes"]
+    assert themes["version"] == "2024-06"
+    assert themes["usage"] == {"Watercolor": 1}
+
+
+# Prompt budgets: stable prompt prefix, bounded Imagen prompt
+@pytest.mark.parametrize("fake_upstream", [{
+    "chat": json.dumps({
+        "sketch_content": "A windmill",
+        "transformation_prompt": "A realistic windmill in a field of tulips. " * 20,
+        "title": "Turning Slowly",
+        "description": "A windmill over tulip fields.",
+    }),
+    "usage": SimpleNamespace(prompt_tokens=700, completion_tokens=120),
+}], indirect=True)
+def test_prompt_budget(client, sample_image, monkeypatch, fake_upstream):
+    """Test the user request ends the one-pass prompt and long Imagen prompts are trimmed"""
+    import app as app_module
+    from prompt_budget import PromptBudget, estimate_tokens
+
+    monkeypatch.setattr(app_module, "prompt_budget", PromptBudget(image_prompt=30))
+    chat_calls = fake_upstream.requests["chat"]
+    app_module.result_cache.clear()
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Realism", "prompt": "budget windmill"})
+    assert response.status_code == 200
+
+    prompt_text = chat_calls[0]["messages"][1]["content"][0]["text"]
+    assert prompt_text.rstrip().endswith("IMPORTANT USER REQUEST: budget windmill")
+    assert "diffusion model" not in prompt_text
+    assert estimate_tokens(fake_upstream.requests["imagen"][0]["prompt"]) <= 30
+
+    budget = json.loads(client.get('/stats').data)["prompt_budget"]
+    assert budget["parts"]["image_prompt"]["trimmed"] == 1
+    assert budget["usage"]["analysis"]["actual"] == 700
+
+# Past the admission limits /generate-prompt answers 429 at once instead of queueing
+def test_generate_prompt_sheds_load(client, sample_image, monkeypatch):
+    """Test a full admission queue gets 429 with Retry-After and shows up in /metrics"""
+    import app as app_module
+    from admission import AdmissionController
+
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    monkeypatch.setattr(app_module, "admission", controller)
+    ticket = controller.acquire()
+
+    response = client.post('/generate-prompt', json={"image": sample_image, "theme": "Anime"})
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["Retry-After"]) <= 60
+    assert "busy" in json.loads(response.data)["error"]
+
+    ticket.release()
+    response = client.post('/generate-prompt', json={"theme": "Anime"})
+    assert response.status_code == 400
+    assert controller.stats()["active"] == 0
+
+    metrics = client.get('/metrics').data.decode()
+    assert 'sketchify_admission_rejected_total{reason="queue_full"} 1' in metrics
+    assert json.loads(client.get('/stats').data)["admission"]["admitted"] == 2
+
+# Under gunicorn the overflow must be shed while it still holds a thread, not left in the socket backlog
+def test_generate_prompt_sheds_load_at_the_thread_limit(sample_image, monkeypatch):
+    """Test a burst as large as the thread pool is queued and shed with 429 by the controller"""
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from flask import jsonify
+    import app as app_module
+    from admission import AdmissionController
+
+    threads = 8
+    monkeypatch.delenv("ADMISSION_MAX_CONCURRENT", raising=False)
+    monkeypatch.delenv("ADMISSION_MAX_QUEUE", raising=False)
+    controller = AdmissionController.from_env(threads)
+    monkeypatch.setattr(app_module, "admission", controller)
+    unblock = threading.Event()
+
+    def slow_pipeline():
+        unblock.wait(5)
+        return jsonify({"title": "ok"}), 200
+
+    monkeypatch.setattr(app_module, "generate_prompt_response", slow_pipeline)
+
+    def post():
+        # One gunicorn thread per request
+        with app.test_client() as thread_client:
+            return thread_client.post('/generate-prompt', json={"image": sample_image}).status_code
+
+    # A burst that fills every server thread
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [pool.submit(post) for _ in range(threads)]
+        deadline = time.monotonic() + 2
+        while controller.stats()["rejected"]["queue_full"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        stats = controller.stats()
+        assert stats["active"] == controller.max_concurrent
+        assert stats["queue_depth"] == controller.max_queue
+        assert stats["rejected"]["queue_full"] == threads - controller.max_concurrent - controller.max_queue
+        unblock.set()
+        statuses = sorted(future.result(5) for future in futures)
+
+    assert statuses.count(429) == threads - controller.max_concurrent - controller.max_queue
+    assert statuses.count(200) == controller.max_concurrent + controller.max_queue
+    assert controller.stats()["active"] == 0
+
+# A degraded analysis is not cached, so resubmitting retries Gemini
+def test_fallback_results_are_not_cached(client, sample_image, monkeypatch, fake_upstream):
+    """Test a result built from the local fallback prompt skips the result cache"""
+    import app as app_module
+
+    fake_upstream.analysis = lambda **kwargs: app_module.fallback_gemini_response("Anime", "", "")
+    monkeypatch.setattr(app_module, "sketch_index", None)
+    app_module.result_cache.clear()
+
+    payload = {"image": sample_image, "theme": "Anime", "prompt": "degraded fox"}
+    assert client.post('/generate-prompt', json=payload).status_code == 200
+    assert client.post('/generate-prompt', json=payload).status_code == 200
+    assert fake_upstream.calls.count("gemini") == 2
@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from hedging import Hedger
+
+
+def warm(hedger, tier, seconds, count=20):
+    for _ in range(count):
+        hedger._record(tier, seconds)
+
+
+def test_delay_follows_rolling_percentile():
+    hedger = Hedger(min_samples=10, min_delay=0.01)
+    assert hedger.delay("standard") is None
+    for value in range(1, 11):
+        hedger._record("standard", value / 10)
+    assert hedger.delay("standard") == 1.0
+    # Tiers are tracked separately
+    assert hedger.delay("hd") is None
+
+
+def test_hedge_wins_over_slow_first_call():
+    """Test a hedge fires after the delay and the faster call's result is returned"""
+    hedger = Hedger(min_samples=20, min_delay=0.01)
+    warm(hedger, "standard", 0.05)
+    calls = []
+    release = threading.Event()
+
+    def generate():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)
+            return "slow"
+        return "fast"
+
+    assert hedger.call("standard", generate) == "fast"
+    release.set()
+    stats = hedger.stats()
+    assert stats["fired"] == 1
+    assert stats["won"] == 1
+
+
+def test_budget_caps_hedges_per_minute():
+    hedger = Hedger(min_samples=20, min_delay=0.01, budget_per_minute=1)
+    warm(hedger, "standard", 0.01)
+
+    def slow():
+        time.sleep(0.05)
+        return "done"
+
+    assert hedger.call("standard", slow) == "done"
+    assert hedger.call("standard", slow) == "done"
+    stats = hedger.stats()
+    assert stats["fired"] == 1
+    assert stats["budget_exhausted"] == 1
+
+
+def test_failed_call_falls_back_to_the_other():
+    hedger = Hedger(min_samples=20, min_delay=0.01)
+    warm(hedger, "standard", 0.01)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(0.05)
+            raise RuntimeError("upstream error")
+        time.sleep(0.1)
+        return "ok"
+
+    assert hedger.call("standard", flaky) == "ok"
+
+
+def test_async_hedge_cancels_the_loser():
+    hedger = Hedger(min_samples=20, min_delay=0.01)
+    warm(hedger, "hd", 0.02)
+    cancelled = []
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        if len(calls) == 1:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+            return "slow"
+        return "fast"
+
+    async def main():
+        result = await hedger.call_async("hd", generate)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(main()) == "fast"
+    assert cancelled == [1]
+    assert hedger.stats()["won"] == 1
+
+
+def test_errors_propagate_without_hedging():
+    hedger = Hedger()
+
+    def broken():
+        raise ValueError("bad prompt")
+
+    with pytest.raises(ValueError):
+        hedger.call("standard", broken)
+
+
+def test_losers_are_sampled():
+    """Test the slow call that lost to a hedge still counts towards the delay"""
+    hedger = Hedger(min_samples=20, window=40, min_delay=0.01)
+    warm(hedger, "standard", 0.02)
+    calls = []
+
+    def generate():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(0.3)
+            return "slow"
+        return "fast"
+
+    assert hedger.call("standard", generate) == "fast"
+    deadline = time.monotonic() + 2
+    while hedger.stats()["tiers"]["standard"]["samples"] < 22 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert hedger.stats()["tiers"]["standard"]["samples"] == 22
+    assert max(hedger._latencies["standard"]) >= 0.3
+
+
+def test_no_hedge_when_every_worker_is_busy():
+    """Test a saturated executor waits for the primary instead of queueing a hedge"""
+    hedger = Hedger(min_samples=20, min_delay=0.01, workers=1)
+    warm(hedger, "standard", 0.01)
+
+    def slow():
+        time.sleep(0.05)
+        return "done"
+
+    assert hedger.call("standard", slow) == "done"
+    stats = hedger.stats()
+    assert stats["fired"] == 0
+    assert stats["saturated"] == 1
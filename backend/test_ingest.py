@@ -0,0 +1,84 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from ingest import SketchIngestor, png_dimensions, sniff_format
+
+
+def encode(img, fmt='PNG'):
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def png_bytes():
+    return encode(Image.new('RGBA', (120, 80), color=(255, 255, 255, 0)))
+
+
+def test_sniff_format(png_bytes):
+    assert sniff_format(png_bytes[:16]) == "png"
+    assert sniff_format(encode(Image.new('RGB', (4, 4)), 'JPEG')[:16]) == "jpeg"
+    assert sniff_format(b"not an image") is None
+
+
+def test_png_dimensions_reads_header_only(png_bytes):
+    """Test dimensions come from IHDR, even with the pixel data cut off"""
+    assert png_dimensions(png_bytes[:40]) == (120, 80)
+    corrupted = png_bytes[:20] + b"\x01" + png_bytes[21:]
+    assert png_dimensions(corrupted) is None
+
+
+def test_clean_png_is_forwarded_untouched(png_bytes):
+    """Test a clean PNG keeps its original base64 string"""
+    ingestor = SketchIngestor()
+    original = base64.b64encode(png_bytes).decode('utf-8')
+    sketch = ingestor.ingest(f"data:image/png;base64,{original}")
+    assert sketch.path == "passthrough"
+    assert sketch.base64 == original
+    assert sketch.png_bytes == png_bytes
+    assert (sketch.width, sketch.height) == (120, 80)
+    assert sketch.image.size == (120, 80)
+
+
+def test_line_wrapped_png_is_only_rebased(png_bytes):
+    """Test a PNG whose base64 needs cleaning skips the PIL re-encode"""
+    ingestor = SketchIngestor()
+    original = base64.b64encode(png_bytes).decode('utf-8')
+    wrapped = original[:40] + "\n" + original[40:]
+    sketch = ingestor.ingest(wrapped)
+    assert sketch.path == "rebased"
+    assert sketch.base64 == original
+    assert sketch.png_bytes == png_bytes
+
+
+def test_other_formats_are_normalized_to_png():
+    ingestor = SketchIngestor()
+    jpeg = base64.b64encode(encode(Image.new('RGB', (30, 20), 'white'), 'JPEG')).decode('utf-8')
+    sketch = ingestor.ingest(f"data:image/jpeg;base64,{jpeg}")
+    assert sketch.path == "normalized"
+    assert sniff_format(sketch.png_bytes[:16]) == "png"
+    assert ingestor.stats()["normalized"] == 1
+
+
+def test_oversized_images_are_rejected(png_bytes):
+    ingestor = SketchIngestor(max_pixels=100)
+    with pytest.raises(ValueError):
+        ingestor.ingest(base64.b64encode(png_bytes).decode('utf-8'))
+    assert ingestor.stats()["rejected"] == 1
+
+
+def test_binary_upload_skips_base64_decode(png_bytes):
+    """Test raw PNG bytes are passed through and only base64-encoded for the upstream"""
+    ingestor = SketchIngestor()
+    sketch = ingestor.ingest(png_bytes)
+    assert sketch.path == "passthrough"
+    assert sketch.png_bytes == png_bytes
+    assert sketch.base64 == base64.b64encode(png_bytes).decode('utf-8')
+    assert "decode" not in sketch.timings
+
+    jpeg = ingestor.ingest(encode(Image.new('RGB', (30, 20), 'white'), 'JPEG'))
+    assert jpeg.path == "normalized"
+    assert sniff_format(jpeg.png_bytes[:16]) == "png"
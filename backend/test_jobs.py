@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+
+from jobs import FAILED, SUCCEEDED, JobQueueFull, JobRunner, MemoryJobStore, SQLiteJobStore
+
+
+def slow_pipeline(release):
+    def pipeline(payload):
+        release.wait(5)
+        if payload.get("fail"):
+            return {"error": "No image provided"}, 400
+        return {"title": payload["title"]}, 200
+    return pipeline
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryJobStore()
+    return SQLiteJobStore(str(tmp_path / "jobs.db"), poll_interval=0.05)
+
+
+def test_job_runs_in_background(store):
+    """Test submit returns immediately and wait long-polls for the result"""
+    release = threading.Event()
+    runner = JobRunner(slow_pipeline(release), store, workers=1)
+    job = runner.submit({"title": "Fox"})
+    assert job["status"] == "queued"
+    assert store.wait(job["id"], 0.05)["status"] in ("queued", "running")
+
+    release.set()
+    finished = store.wait(job["id"], 5)
+    assert finished["status"] == SUCCEEDED
+    assert finished["result"] == {"title": "Fox"}
+    assert finished["status_code"] == 200
+
+
+def test_failed_job_keeps_error(store):
+    release = threading.Event()
+    release.set()
+    runner = JobRunner(slow_pipeline(release), store, workers=1)
+    job = runner.submit({"fail": True})
+    finished = store.wait(job["id"], 5)
+    assert finished["status"] == FAILED
+    assert finished["status_code"] == 400
+    assert finished["error"] == "No image provided"
+
+
+def test_queue_is_bounded():
+    """Test submissions beyond the queue size are rejected"""
+    release = threading.Event()
+    runner = JobRunner(slow_pipeline(release), MemoryJobStore(), workers=1, max_queue=1)
+    runner.submit({"title": "a"})
+    runner.submit({"title": "b"})
+    with pytest.raises(JobQueueFull):
+        runner.submit({"title": "c"})
+    release.set()
+    assert runner.stats()["rejected"] == 1
+
+
+def test_sqlite_store_survives_restart(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    store = SQLiteJobStore(path)
+    store.create("done")
+    store.update("done", status=SUCCEEDED, status_code=200, result={"title": "Fox"})
+    store.create("interrupted")
+
+    restarted = SQLiteJobStore(path)
+    assert restarted.get("done")["result"] == {"title": "Fox"}
+    assert restarted.get("interrupted")["status"] == FAILED
+    assert restarted.get("missing") is None
+
+
+def test_memory_store_expires_oldest_finished_jobs():
+    """Test expiry drops stale finished jobs and caps the store oldest first"""
+    store = MemoryJobStore(ttl=60, max_jobs=2)
+    store.create("old")
+    store.update("old", status=SUCCEEDED)
+    store._jobs["old"]["updated_at"] -= 120
+    store.create("running")
+    store._jobs["running"]["updated_at"] -= 120
+    store.create("new")
+    # Expired finished jobs go; unfinished ones stay whatever their age
+    assert store.get("old") is None
+    assert store.get("running") is not None
+    store.create("newer")
+    store.create("newest")
+    assert store.get("running") is None
+    assert store.get("new") is not None
+
+
+def test_store_error_does_not_leak_queue_slots():
+    """Test a store failure while starting a job still frees its slot"""
+    class FlakyStore(MemoryJobStore):
+        def update(self, job_id, **fields):
+            if fields.get("status") == "running":
+                raise RuntimeError("database is locked")
+            super().update(job_id, **fields)
+
+    store = FlakyStore()
+    runner = JobRunner(lambda payload: ({"title": "x"}, 200), store, workers=1, max_queue=0)
+    job = runner.submit({})
+    assert store.wait(job["id"], 5)["status"] == FAILED
+    assert runner.stats()["in_progress"] == 0
+    runner.submit({})
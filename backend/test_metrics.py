@@ -0,0 +1,68 @@
+import pytest
+
+from metrics import Counter, Histogram, PipelineMetrics, error_type
+from resilience import CircuitOpenError, DeadlineExceeded
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"upstream returned {status_code}")
+        self.status_code = status_code
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("stage_seconds", "Stage time.", ("stage",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage="gemini")
+    histogram.observe(0.5, stage="gemini")
+    histogram.observe(5.0, stage="gemini")
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP stage_seconds Stage time.", "# TYPE stage_seconds histogram"]
+    assert 'stage_seconds_bucket{stage="gemini",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="gemini",le="1.0"} 2' in lines
+    assert 'stage_seconds_bucket{stage="gemini",le="+Inf"} 3' in lines
+    assert 'stage_seconds_count{stage="gemini"} 3' in lines
+    assert histogram.count(stage="gemini") == 3
+
+
+def test_counter_checks_and_escapes_labels():
+    counter = Counter("fallbacks_total", "Fallbacks.", ("theme",))
+    counter.inc(theme='Say "hi"')
+    assert 'fallbacks_total{theme="Say \\"hi\\""} 1' in counter.render()
+    with pytest.raises(ValueError):
+        counter.inc(kind="parse")
+
+
+def test_stage_tracks_in_flight_and_latency():
+    metrics = PipelineMetrics()
+    labels = {"theme": "Anime", "complexity": "hd"}
+    with metrics.stage("gemini", labels):
+        assert metrics.in_flight.value(stage="gemini", **labels) == 1
+    assert metrics.in_flight.value(stage="gemini", **labels) == 0
+    assert metrics.stage_seconds.count(stage="gemini", **labels) == 1
+
+    with pytest.raises(RuntimeError):
+        with metrics.stage("image", labels):
+            raise RuntimeError("quota exceeded")
+    # Failed stages are timed too
+    assert metrics.stage_seconds.count(stage="image", **labels) == 1
+    assert metrics.in_flight.value(stage="image", **labels) == 0
+
+
+def test_error_type():
+    assert error_type(DeadlineExceeded("late")) == "deadline"
+    assert error_type(CircuitOpenError("open")) == "circuit_open"
+    assert error_type(UpstreamError(429)) == "rate_limited"
+    assert error_type(UpstreamError(503)) == "server_error"
+    assert error_type(UpstreamError(400)) == "client_error"
+    assert error_type(TimeoutError()) == "connection"
+    assert error_type(ValueError("bad")) == "other"
+
+
+def test_render_includes_every_metric():
+    metrics = PipelineMetrics()
+    metrics.fallback("parse", {"theme": "Anime", "complexity": "standard"})
+    body = metrics.render()
+    for name in ("sketchify_stage_seconds", "sketchify_stage_in_flight", "sketchify_upstream_errors_total",
+                 "sketchify_cache_events_total", "sketchify_fallbacks_total"):
+        assert f"# TYPE {name} " in body
+    assert 'sketchify_fallbacks_total{kind="parse",theme="Anime",complexity="standard"} 1' in body
@@ -0,0 +1,67 @@
+from PIL import Image, ImageDraw
+
+from preprocess import SketchPreprocessor
+
+
+def canvas(size=(1600, 1200), color='black', transparent=False):
+    """Draw a small stroke in the middle of a large canvas"""
+    if transparent:
+        img = Image.new('RGBA', size, (0, 0, 0, 0))
+    else:
+        img = Image.new('RGB', size, color='white')
+    ImageDraw.Draw(img).line([(700, 500), (900, 700)], fill=color, width=6)
+    return img
+
+
+def test_crops_and_converts_line_art():
+    """Test whitespace is cropped and black strokes become grayscale"""
+    png_bytes, report = SketchPreprocessor(padding=10).process(canvas(), bytes_before=10 ** 6)
+    assert report["size_after"][0] < 250
+    assert report["size_after"][1] < 250
+    assert report["mode"] == "L"
+    assert report["bytes_after"] == len(png_bytes)
+    assert report["ms"] >= 0
+
+
+def test_keeps_colour_sketches_in_colour():
+    _, report = SketchPreprocessor().process(canvas(color='red'))
+    assert report["mode"] == "RGB"
+
+
+def test_flattens_transparent_canvas():
+    _, report = SketchPreprocessor(color_mode="1bit").process(canvas(transparent=True))
+    assert report["mode"] == "1"
+    assert report["size_after"][0] < 250
+
+
+def test_caps_longest_side():
+    img = Image.new('RGB', (2000, 1000), color='white')
+    ImageDraw.Draw(img).rectangle([0, 0, 1999, 999], outline='black', width=8)
+    _, report = SketchPreprocessor(max_side=512).process(img)
+    assert max(report["size_after"]) == 512
+
+
+def test_stats_accumulate():
+    preprocessor = SketchPreprocessor()
+    preprocessor.process(canvas(), bytes_before=50000)
+    stats = preprocessor.stats()
+    assert stats["requests"] == 1
+    assert stats["bytes_before"] == 50000
+    assert stats["ratio"] is not None
+
+
+def test_unchanged_canvas_is_not_reencoded():
+    """Test a canvas preprocessing would not change is forwarded as it arrived"""
+    img = Image.new('RGB', (300, 200), color='white')
+    ImageDraw.Draw(img).rectangle([0, 0, 299, 199], outline='red', width=4)
+    preprocessor = SketchPreprocessor(padding=0)
+    upload, report = preprocessor.process_base64(img, bytes_before=1234, original_base64="b3JpZ2luYWw=")
+    assert upload == "b3JpZ2luYWw="
+    assert report["unchanged"] is True
+    assert report["bytes_after"] == 1234
+
+    # Without the original, or when something changes, the sketch is re-encoded
+    upload, report = preprocessor.process_base64(canvas(), original_base64="b3JpZ2luYWw=")
+    assert upload != "b3JpZ2luYWw="
+    assert report["unchanged"] is False
+    assert preprocessor.stats()["unchanged"] == 1
@@ -0,0 +1,61 @@
+from prompt_budget import (
+    IMAGE_TOKENS,
+    PromptBudget,
+    compress_boilerplate,
+    estimate_chat_tokens,
+    estimate_tokens,
+    trim_to_tokens,
+)
+from themes import THEMES
+
+
+def test_boilerplate_is_removed():
+    context = THEMES["Anime"]["system_content"]
+    compressed = compress_boilerplate(context)
+    assert "diffusion model" not in compressed
+    assert "1-2 sentences" not in compressed
+    assert "anime and manga" in compressed
+    assert ".these" not in compressed and "  " not in compressed
+
+
+def test_trim_prefers_sentence_boundaries():
+    text = "First sentence is here. Second sentence is a little longer. Third one trails off"
+    assert trim_to_tokens(text, 100) == text
+    assert trim_to_tokens(text, 15) == "First sentence is here. Second sentence is a little longer."
+    assert estimate_tokens(trim_to_tokens("word " * 200, 10)) <= 10
+
+
+def test_fit_counts_saved_tokens():
+    budget = PromptBudget(user_prompt=5)
+    assert budget.fit("user_prompt", "make it snowy") == "make it snowy"
+    assert budget.fit("user_prompt", "make it snowy with a big red barn and horses") == "make it snowy with"
+    parts = budget.stats()["parts"]["user_prompt"]
+    assert parts["fitted"] == 2
+    assert parts["trimmed"] == 1
+    assert parts["saved_tokens"] > 0
+    assert PromptBudget(enabled=False).fit("user_prompt", "x" * 1000) == "x" * 1000
+
+
+def test_long_user_prompts_are_rejected_not_cut():
+    budget = PromptBudget(user_prompt=5)
+    assert budget.check("user_prompt", "make it snowy") is None
+    assert budget.check("user_prompt", None) is None
+    assert "too long" in budget.check("user_prompt", "make it snowy with a big red barn and horses")
+    assert PromptBudget(enabled=False).check("user_prompt", "x" * 1000) is None
+
+
+def test_estimated_usage_is_compared_with_reported():
+    messages = [
+        {"role": "system", "content": "x" * 40},
+        {"role": "user", "content": [{"type": "text", "text": "y" * 400}, {"type": "image_url", "image_url": {}}]},
+    ]
+    estimated = estimate_chat_tokens(messages)
+    assert estimated == 10 + 100 + IMAGE_TOKENS
+
+    budget = PromptBudget()
+    budget.record_usage("analysis", estimated, type("Usage", (), {"prompt_tokens": 400})())
+    budget.record_usage("analysis", estimated, None)
+    usage = budget.stats()["usage"]["analysis"]
+    assert usage["calls"] == 2
+    assert usage["reported"] == 1
+    assert usage["estimate_ratio"] == round(estimated / 400, 3)
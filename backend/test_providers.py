@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import pytest
+
+from providers import Provider, ProviderError, ProviderRouter, router_from_env
+
+
+class FakeProvider(Provider):
+    def __init__(self, name, delay=0.0, fail=False, cost=0.0):
+        super().__init__(cost)
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    def generate(self, prompt, quality, timeout=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ProviderError(f"{self.name} is down")
+        return f"{self.name}:{prompt}"
+
+
+def test_router_prefers_the_fastest_provider():
+    slow = FakeProvider("slow", delay=0.05)
+    fast = FakeProvider("fast", delay=0.0)
+    router = ProviderRouter([slow, fast], probe_share=1.0)
+
+    # Each provider is probed once, then the faster one takes the traffic
+    router.generate("a cat", "standard")
+    router.generate("a cat", "standard")
+    assert router.order()[0] is fast
+    assert router.generate("a cat", "standard") == ("fast:a cat", "fast")
+
+
+def test_router_fails_over_and_cools_down_a_failing_provider():
+    """Test errors move the request to the next provider and repeated errors eject the provider"""
+    broken = FakeProvider("broken", fail=True)
+    backup = FakeProvider("backup", cost=1.0)
+    router = ProviderRouter([broken, backup], failure_threshold=2, cooldown=60)
+
+    assert router.generate("a dog", "hd") == ("backup:a dog", "backup")
+    assert router.generate("a dog", "hd") == ("backup:a dog", "backup")
+    assert broken.calls == 2
+
+    # Cooling down: the broken provider is no longer tried first
+    assert router.order() == [backup, broken]
+    router.generate("a dog", "hd")
+    assert broken.calls == 2
+
+    stats = router.stats()
+    assert stats["failovers"] == 2
+    assert stats["providers"]["broken"]["cooling_down"]
+
+
+def test_router_raises_when_every_provider_fails():
+    router = ProviderRouter([FakeProvider("a", fail=True), FakeProvider("b", fail=True)])
+    with pytest.raises(ProviderError):
+        router.generate("a tree", "standard")
+    assert router.stats()["exhausted"] == 1
+
+
+def test_stale_provider_is_probed_again():
+    slow = FakeProvider("slow", delay=0.02)
+    fast = FakeProvider("fast")
+    router = ProviderRouter([fast, slow], stale_after=0.05, probe_share=1.0)
+    router.generate("x", "standard")
+    router.generate("x", "standard")
+    assert router.order()[0] is fast
+
+    time.sleep(0.06)
+    # Both are stale; the one used longest ago is probed first, then the other
+    assert router.generate("x", "standard") == ("fast:x", "fast")
+    assert router.generate("x", "standard") == ("slow:x", "slow")
+    assert router.stats()["probes"] == 4
+
+
+def test_unmeasured_provider_does_not_take_the_traffic():
+    """Test a provider with no measurements is ranked with the pessimistic prior, not first"""
+    known = FakeProvider("known", delay=0.01)
+    new = FakeProvider("new")
+    router = ProviderRouter([known, new], prior_latency=5.0, probe_share=0.0)
+    for _ in range(3):
+        assert router.generate("x", "standard") == ("known:x", "known")
+    assert new.calls == 0
+    assert router.order() == [known, new]
+    assert router.stats()["providers"]["new"]["score"] == 5.0
+
+
+def test_async_failover():
+    router = ProviderRouter([FakeProvider("down", fail=True), FakeProvider("up")])
+    assert asyncio.run(router.agenerate("a boat", "standard")) == ("up:a boat", "up")
+
+
+def test_provider_must_implement_generate():
+    class Incomplete(Provider):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_openai_quality_is_mapped_per_model():
+    """Test the router's standard/hd qualities become each model's own names"""
+    from providers import OpenAIImageProvider
+
+    dalle = OpenAIImageProvider("test-key")._request_kwargs("a fox", "hd", 10)
+    assert dalle["quality"] == "hd"
+    assert dalle["response_format"] == "b64_json"
+    gpt_image = OpenAIImageProvider("test-key", model="gpt-image-1")._request_kwargs("a fox", "standard", 10)
+    assert gpt_image["quality"] == "medium"
+    assert "response_format" not in gpt_image
+    with pytest.raises(ValueError):
+        OpenAIImageProvider("test-key", model="dall-e-2")
+
+
+def test_router_from_env_skips_providers_without_keys(monkeypatch):
+    monkeypatch.setenv("IMAGE_PROVIDERS", "imagen,stability,openai")
+    monkeypatch.delenv("STABILITY_API_KEY", raising=False)
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    router = router_from_env(FakeProvider("imagen"))
+    assert [provider.name for provider in router.providers] == ["imagen", "openai"]
+
+    monkeypatch.setenv("IMAGE_PROVIDERS", "imagen,midjourney")
+    with pytest.raises(ValueError):
+        router_from_env(FakeProvider("imagen"))
@@ -0,0 +1,48 @@
+import json
+import logging
+import queue
+
+from request_log import DroppingQueueHandler, JsonFormatter, RequestLogger, redact
+
+
+def test_redact_hashes_long_strings_and_hides_secrets():
+    image = "iVBORw0KGgo" + "A" * 5000
+    redacted = redact({"image": image, "theme": "Anime", "api_key": "abc", "items": [{"image": image}] * 12})
+    assert redacted["image"]["length"] == len(image)
+    assert len(redacted["image"]["sha256"]) == 16
+    assert redacted["theme"] == "Anime"
+    assert redacted["api_key"] == "[redacted]"
+    assert len(redacted["items"]) == 11
+    assert redacted["items"][-1] == "... 2 more"
+
+
+def test_successes_are_sampled_but_errors_always_logged(caplog):
+    request_logger = RequestLogger(sample_rate=0.0, slow_ms=1000)
+    with caplog.at_level(logging.INFO, logger="sketchify.requests"):
+        assert not request_logger.log("POST", "/generate-prompt", 200, 50.0)
+        assert request_logger.log("POST", "/generate-prompt", 200, 1500.0)
+        assert request_logger.log("POST", "/generate-prompt", 500, 50.0, body_bytes=10, payload={"image": "x" * 1000})
+    assert len(caplog.records) == 2
+    fields = caplog.records[-1].fields
+    assert fields["status"] == 500
+    assert fields["request"]["image"]["length"] == 1000
+    assert request_logger.stats()["sampled_out"] == 1
+
+
+def test_json_formatter_includes_fields():
+    record = logging.LogRecord("sketchify.requests", logging.INFO, __file__, 1, "GET /stats 200", None, None)
+    record.fields = {"status": 200, "duration_ms": 1.5}
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["severity"] == "INFO"
+    assert entry["message"] == "GET /stats 200"
+    assert entry["duration_ms"] == 1.5
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+    logger = logging.getLogger("test_request_log.dropping")
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.warning("first")
+    logger.warning("second")
+    assert handler.dropped == 1
@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+import pytest
+
+from resilience import (
+    BreakerRegistry,
+    CircuitBreaker,
+    CircuitOpenError,
+    Deadline,
+    DeadlineExceeded,
+    RetryPolicy,
+    is_transient,
+    upstream_error_status,
+)
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"upstream returned {status_code}")
+        self.status_code = status_code
+
+
+def flaky(failures, error=None):
+    """A call that raises `error` for the first `failures` attempts, then succeeds."""
+    calls = []
+
+    def call(timeout):
+        calls.append(timeout)
+        if len(calls) <= failures:
+            raise error or UpstreamError(503)
+        return "ok"
+
+    return call, calls
+
+
+def test_is_transient():
+    assert is_transient(UpstreamError(429))
+    assert is_transient(UpstreamError(502))
+    assert is_transient(TimeoutError())
+    assert not is_transient(UpstreamError(400))
+    assert not is_transient(ValueError("bad sketch"))
+
+
+def test_retry_recovers_from_transient_error():
+    policy = RetryPolicy(attempts=3, base_delay=0.001, max_delay=0.001)
+    breaker = CircuitBreaker("gemini")
+    call, calls = flaky(2)
+    assert policy.call(call, breaker, Deadline(5), "analysis") == "ok"
+    assert len(calls) == 3
+    assert policy.stats()["retries"] == 2
+    assert breaker.stats()["state"] == "closed"
+
+
+def test_non_transient_error_is_not_retried():
+    policy = RetryPolicy(attempts=3, base_delay=0.001)
+    breaker = CircuitBreaker("gemini", failure_threshold=1)
+    call, calls = flaky(5, UpstreamError(400))
+    with pytest.raises(UpstreamError):
+        policy.call(call, breaker, Deadline(5), "analysis")
+    assert len(calls) == 1
+    # A bad request says nothing about the upstream's health
+    assert breaker.stats()["state"] == "closed"
+
+
+def test_call_timeout_is_capped_by_stage_and_deadline():
+    policy = RetryPolicy(attempts=1)
+    call, calls = flaky(0)
+    policy.call(call, CircuitBreaker("imagen"), Deadline(2), "image")
+    assert 0 < calls[0] <= 2
+
+
+def test_expired_deadline_raises_before_calling():
+    deadline = Deadline(0)
+    call, calls = flaky(0)
+    with pytest.raises(DeadlineExceeded):
+        RetryPolicy().call(call, CircuitBreaker("imagen"), deadline, "image")
+    assert calls == []
+    assert upstream_error_status(DeadlineExceeded("late")) == 504
+
+
+def test_breaker_opens_then_half_opens_and_closes():
+    breaker = CircuitBreaker("imagen", failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.stats()["state"] == "open"
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.allow()
+    assert upstream_error_status(excinfo.value) == 503
+
+    time.sleep(0.06)
+    # One trial call is let through; a second one is rejected while it runs
+    breaker.allow()
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.stats()["state"] == "closed"
+    breaker.allow()
+
+
+def test_failed_trial_reopens_breaker():
+    breaker = CircuitBreaker("imagen", failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.stats()["state"] == "open"
+    assert breaker.stats()["opened"] == 2
+
+
+def test_open_breaker_stops_retries():
+    policy = RetryPolicy(attempts=5, base_delay=0.001, max_delay=0.001)
+    breakers = BreakerRegistry(failure_threshold=2, reset_timeout=60)
+    call, calls = flaky(10)
+    with pytest.raises(CircuitOpenError):
+        policy.call(call, breakers.get("gemini"), Deadline(5), "analysis")
+    assert len(calls) == 2
+    assert breakers.stats()["gemini"]["rejected"] == 1
+
+
+def test_async_retry():
+    policy = RetryPolicy(attempts=3, base_delay=0.001, max_delay=0.001)
+    calls = []
+
+    async def create(timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            raise UpstreamError(500)
+        return "ok"
+
+    result = asyncio.run(policy.call_async(create, CircuitBreaker("gemini"), Deadline(5), "analysis"))
+    assert result == "ok"
+    assert len(calls) == 2
+
+
+def test_cancelled_trial_frees_half_open_breaker():
+    policy = RetryPolicy(attempts=1)
+    breaker = CircuitBreaker("imagen", failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+
+    async def hang(timeout):
+        await asyncio.sleep(10)
+
+    async def cancel_trial():
+        task = asyncio.ensure_future(policy.call_async(hang, breaker, Deadline(5), "image"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_trial())
+    assert breaker.stats()["state"] == "half_open"
+    # The next call is the new trial instead of being rejected forever
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.stats()["state"] == "closed"
@@ -0,0 +1,84 @@
+import threading
+import time
+
+from result_cache import ResultCache, make_cache_key
+
+
+def test_cache_key_normalizes_options():
+    """Test equivalent requests share a key and different options do not"""
+    key = make_cache_key(b"png", "Anime", "a cat", "standard")
+    assert key == make_cache_key(b"png", "Anime", " a cat ", "STANDARD")
+    assert key != make_cache_key(b"png", "Realism", "a cat", "standard")
+    assert key != make_cache_key(b"png2", "Anime", "a cat", "standard")
+
+
+def test_hit_miss_counters():
+    cache = ResultCache()
+    assert cache.get("k") is None
+    cache.put("k", {"title": "Fox"})
+    assert cache.get("k") == {"title": "Fox"}
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+
+def test_lru_eviction():
+    """Test the least recently used entry is evicted first"""
+    cache = ResultCache(max_entries=2)
+    cache.put("a", {"v": 1})
+    cache.put("b", {"v": 2})
+    cache.get("a")
+    cache.put("c", {"v": 3})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"v": 1}
+    assert cache.get("c") == {"v": 3}
+
+
+def test_byte_budget():
+    cache = ResultCache(max_bytes=40)
+    cache.put("a", {"image": "x" * 20})
+    cache.put("b", {"image": "y" * 20})
+    assert len(cache) == 1
+    assert cache.get("b") is not None
+    cache.put("huge", {"image": "z" * 100})
+    assert cache.get("huge") is None
+
+
+def test_ttl_expiry():
+    cache = ResultCache(ttl=0.01)
+    cache.put("a", {"v": 1})
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_disk_persistence(tmp_path):
+    """Test entries survive a restart when a directory is configured"""
+    cache = ResultCache(directory=str(tmp_path))
+    cache.put("a", {"title": "Fox"})
+    restarted = ResultCache(directory=str(tmp_path))
+    assert restarted.get("a") == {"title": "Fox"}
+
+
+def test_disk_write_happens_outside_the_lock(tmp_path, monkeypatch):
+    """Test a slow disk write doesn't hold up lookups"""
+    cache = ResultCache(directory=str(tmp_path))
+    cache.put("a", {"title": "Fox"})
+    writing, release = threading.Event(), threading.Event()
+    write_tmp = cache._write_tmp
+
+    def slow_write_tmp(*args):
+        writing.set()
+        release.wait(5)
+        return write_tmp(*args)
+
+    monkeypatch.setattr(cache, "_write_tmp", slow_write_tmp)
+    writer = threading.Thread(target=cache.put, args=("b", {"title": "Owl"}))
+    writer.start()
+    assert writing.wait(5)
+    assert not cache._lock.locked()
+    assert cache.get("a") == {"title": "Fox"}
+    release.set()
+    writer.join(5)
+    assert ResultCache(directory=str(tmp_path)).get("b") == {"title": "Owl"}
+    assert not list(tmp_path.glob("*.tmp"))
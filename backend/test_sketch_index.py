@@ -0,0 +1,77 @@
+import random
+
+from PIL import Image, ImageDraw
+
+from sketch_index import SketchIndex, dhash, hamming
+
+
+def draw_house(size=(200, 200), offset=(0, 0), stray_pixel=False):
+    """Draw a simple house outline on a white canvas"""
+    img = Image.new('RGB', size, color='white')
+    draw = ImageDraw.Draw(img)
+    x, y = offset
+    draw.rectangle([x + 50, y + 90, x + 150, y + 170], outline='black', width=4)
+    draw.polygon([(x + 40, y + 90), (x + 100, y + 30), (x + 160, y + 90)], outline='black')
+    if stray_pixel:
+        draw.point((x + 120, y + 130), fill='black')
+    return img
+
+
+def test_dhash_ignores_stray_pixels_and_canvas_size():
+    """Test near-identical sketches hash close together"""
+    base = dhash(draw_house())
+    assert hamming(base, dhash(draw_house(stray_pixel=True))) <= 4
+    assert hamming(base, dhash(draw_house(size=(260, 240), offset=(30, 20)))) <= 4
+
+
+def test_dhash_separates_different_sketches():
+    img = Image.new('RGB', (200, 200), color='white')
+    ImageDraw.Draw(img).ellipse([40, 40, 160, 160], outline='black', width=4)
+    assert hamming(dhash(draw_house()), dhash(img)) > 4
+
+
+def test_differently_shaped_sketches_do_not_match():
+    """Test strokes with the same outline but different shapes stay apart"""
+    line = Image.new('RGB', (200, 200), color='white')
+    ImageDraw.Draw(line).line([(20, 100), (180, 100)], fill='black', width=4)
+    bar = Image.new('RGB', (200, 200), color='white')
+    ImageDraw.Draw(bar).rectangle([20, 60, 180, 140], fill='black')
+    index = SketchIndex()
+    index.add(dhash(line), "Anime", {"title": "Horizon"})
+    assert index.lookup(dhash(bar), "Anime") is None
+    assert index.lookup(dhash(line), "Anime") == (0, {"title": "Horizon"})
+
+
+def test_lookup_within_distance():
+    index = SketchIndex(max_distance=3)
+    index.add(0b1011, "Anime", {"title": "Fox"})
+    assert index.lookup(0b1011, "Anime") == (0, {"title": "Fox"})
+    assert index.lookup(0b1000, "Anime") == (2, {"title": "Fox"})
+    assert index.lookup(0b0100, "Anime") is None
+    assert index.lookup(0b1011, "Realism") is None
+
+
+def test_lookup_finds_neighbours_in_any_chunk():
+    """Test multi-index lookup finds every hash within the distance"""
+    index = SketchIndex(max_distance=4)
+    rng = random.Random(7)
+    stored = [rng.getrandbits(64) for _ in range(2000)]
+    for value in stored:
+        index.add(value, "ns", value)
+    for value in stored[:200]:
+        noisy = value
+        for bit in rng.sample(range(64), 4):
+            noisy ^= 1 << bit
+        distance, payload = index.lookup(noisy, "ns")
+        assert payload == value
+        assert distance == 4
+
+
+def test_eviction_keeps_index_bounded():
+    index = SketchIndex(max_distance=2, max_entries=2)
+    index.add(0xFFFF, "ns", "a")
+    index.add(0xFFFF << 16, "ns", "b")
+    index.add(0xFFFF << 32, "ns", "c")
+    assert len(index) == 2
+    assert index.lookup(0xFFFF, "ns") is None
+    assert index.stats()["evictions"] == 1
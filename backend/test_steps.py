@@ -0,0 +1,83 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from steps import AsyncStepRunner, Step, StepRunner, collect, completed, relay
+
+
+def double(value):
+    return value * 2
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def operations(name):
+    return {"double": double, "fail": fail}[name]
+
+
+def pipeline(value):
+    doubled = yield Step("double", value)
+    yield "doubled", doubled
+    try:
+        yield Step("fail", "boom")
+    except ValueError as e:
+        yield "error", str(e)
+
+
+def sum_of_doubles(values):
+    total = 0
+    for value in values:
+        total += yield Step("double", value)
+    return total
+
+
+def test_runner_performs_steps_and_throws_errors_back():
+    runner = StepRunner(operations)
+    assert list(runner.events(pipeline(3))) == [("doubled", 6), ("error", "boom")]
+    assert runner.run(sum_of_doubles([1, 2, 3])) == 12
+
+
+def test_relay_and_collect_pass_steps_through():
+    def upper(item):
+        event, payload = item
+        yield event.upper(), payload
+
+    runner = StepRunner(operations)
+    assert list(runner.events(relay(pipeline(1), upper))) == [("DOUBLED", 2), ("ERROR", "boom")]
+    assert runner.run(collect(pipeline(1))) == [("doubled", 2), ("error", "boom")]
+
+
+def test_run_rejects_pipelines_that_yield_events():
+    with pytest.raises(RuntimeError):
+        StepRunner(operations).run(pipeline(1))
+
+
+def test_completed_runs_sub_pipelines_on_the_pool():
+    with ThreadPoolExecutor(2) as pool:
+        runner = StepRunner(operations, pools={"work": pool})
+        events = list(runner.events(completed("sum", [sum_of_doubles([1]), sum_of_doubles([2, 3])], "work")))
+    assert sorted(events) == [("sum", 2), ("sum", 10)]
+
+
+def test_async_runner_falls_back_to_sync_steps():
+    """Test steps without an async version run on a worker thread"""
+    async def async_double(value):
+        return value * 2
+
+    runner = AsyncStepRunner(
+        lambda name: async_double if name == "double" else None,
+        StepRunner(operations),
+        limits={"work": 1},
+    )
+
+    async def run():
+        events = [item async for item in runner.events(pipeline(3))]
+        fanned_out = [item async for item in runner.events(completed("sum", [sum_of_doubles([1]), sum_of_doubles([2])], "work"))]
+        return events, fanned_out
+
+    events, fanned_out = asyncio.run(run())
+    assert events == [("doubled", 6), ("error", "boom")]
+    assert sorted(fanned_out) == [("sum", 2), ("sum", 4)]
@@ -0,0 +1,86 @@
+import json
+
+from structured_output import (
+    FORMAT_TOKENS,
+    ONE_PASS_FIELDS,
+    RESPONSE_PROFILES,
+    ParseStats,
+    ProfileStats,
+    profile_max_tokens,
+    TolerantJsonScanner,
+    parse_json_fields,
+    response_format,
+    strip_code_fence,
+    ONE_PASS_SCHEMA,
+)
+
+REPLY = {
+    "sketch_content": "A lighthouse on a cliff",
+    "transformation_prompt": "A watercolor lighthouse at dusk",
+    "title": "Keeper of the Cliff",
+    "description": "A lighthouse glows above the waves.",
+}
+
+
+def test_valid_json_parses_in_one_pass():
+    values, outcome = parse_json_fields(json.dumps(REPLY), ONE_PASS_FIELDS)
+    assert outcome == "json"
+    assert values == REPLY
+
+
+def test_fenced_json_with_trailing_comma_is_recovered():
+    """Test malformed JSON still yields every complete string field"""
+    text = "```json\n" + json.dumps(REPLY)[:-1] + ",\n}\n```"
+    values, outcome = parse_json_fields(text, ONE_PASS_FIELDS)
+    assert outcome == "tolerant"
+    assert values == REPLY
+
+
+def test_truncated_reply_keeps_complete_fields():
+    text = '{"TITLE": "Quoted \\"Lamp\\"", "description": "Line one\nline two", "transformation_prompt": "A lamp in the'
+    values, outcome = parse_json_fields(text, ONE_PASS_FIELDS)
+    assert outcome == "tolerant"
+    assert values == {"title": 'Quoted "Lamp"', "description": "Line one\nline two"}
+
+
+def test_scanner_accepts_chunks():
+    """Test the scanner gives the same fields however the text is split"""
+    text = json.dumps({"title": "Split", "count": 3, "nested": {"description": "Deep"}, "sketch_content": "A \u00e9clair"})
+    scanner = TolerantJsonScanner(ONE_PASS_FIELDS)
+    for index in range(0, len(text), 3):
+        scanner.feed(text[index:index + 3])
+    assert scanner.values == {"title": "Split", "description": "Deep", "sketch_content": "A éclair"}
+
+
+def test_labelled_text_is_left_to_the_label_parser():
+    assert parse_json_fields("TITLE: Plain\n\nDESCRIPTION: No JSON here.", ONE_PASS_FIELDS) == ({}, None)
+    assert strip_code_fence("```\n{}\n```") == "{}"
+
+
+def test_response_format_and_stats():
+    assert response_format("sketch_analysis", ONE_PASS_SCHEMA)["json_schema"]["schema"]["required"] == list(ONE_PASS_FIELDS)
+
+    stats = ParseStats("structured")
+    stats.record("Anime", "json")
+    stats.record("Anime", "failed")
+    stats.record("Cartoon", "tolerant")
+    summary = stats.stats()
+    assert summary["parsed"] == 3
+    assert summary["themes"]["Anime"]["success_rate"] == 0.5
+    assert summary["themes"]["Cartoon"]["tolerant"] == 1
+
+
+def test_lean_profile_asks_for_fewer_tokens():
+    assert profile_max_tokens("lean") < profile_max_tokens("verbose")
+    # max_tokens leaves room for fields that overrun their word limits
+    assert profile_max_tokens("lean") > sum(RESPONSE_PROFILES["lean"].values()) + FORMAT_TOKENS
+
+    stats = ProfileStats()
+    usage = type("Usage", (), {"prompt_tokens": 1200, "completion_tokens": 150})()
+    stats.record("lean", 0.8, usage)
+    stats.record("lean", 1.2, None)
+    lean = stats.stats()["lean"]
+    assert lean["calls"] == 2
+    assert lean["avg_latency_ms"] == 1000.0
+    # Only calls that reported usage count towards the averages
+    assert lean["avg_completion_tokens"] == 150.0
@@ -0,0 +1,77 @@
+import json
+import os
+
+import pytest
+
+from theme_registry import ThemeRegistry, compile_theme
+from themes import THEMES
+
+
+def write_themes(path, document, mtime):
+    path.write_text(json.dumps(document))
+    # Reloads are keyed on the modification time
+    os.utime(path, (mtime, mtime))
+
+
+PIXEL_ART = {
+    "system_content": "You are a pixel art specialist. Use a limited palette and visible pixels.",
+    "user_text": "Translate this sketch into a pixel art description. Focus on crisp pixels and bold shapes.",
+    "temperature": 0.4,
+    "enhancers": "8-bit palette, crisp pixel edges",
+}
+
+
+def test_builtin_themes_are_compiled():
+    registry = ThemeRegistry()
+    anime = registry.get("Anime")
+    assert anime.temperature == THEMES["Anime"]["temperature"]
+    assert "Anime style" in anime.fallback_prompt()
+    assert "expressive eyes" in anime.fallback_prompt()
+    assert anime.fallback_prompt("at night").endswith("Additional details: at night. ")
+    # Unknown names render with Default
+    assert registry.get("Vaporwave").name == "Default"
+    assert "Vaporwave" not in registry
+
+
+def test_invalid_themes_are_rejected():
+    with pytest.raises(ValueError):
+        compile_theme("Broken", {"system_content": "", "user_text": "x"})
+    with pytest.raises(ValueError):
+        compile_theme("Hot", dict(PIXEL_ART, temperature=5))
+    with pytest.raises(ValueError):
+        ThemeRegistry(themes={"Anime": THEMES["Anime"]})
+
+
+def test_theme_file_is_hot_reloaded(tmp_path):
+    path = tmp_path / "themes.json"
+    write_themes(path, {"version": "v1", "themes": {"Pixel Art": PIXEL_ART}}, 1000)
+    registry = ThemeRegistry(path=str(path), reload_interval=0)
+    assert registry.version == "v1"
+    assert "Pixel Art" in registry
+    assert "Anime" in registry
+    assert "8-bit palette" in registry.get("Pixel Art").fallback_prompt()
+
+    write_themes(path, {"version": "v2", "themes": {"Pixel Art": dict(PIXEL_ART, temperature=0.9)}}, 2000)
+    assert registry.get("Pixel Art").temperature == 0.9
+    assert registry.stats()["version"] == "v2"
+    assert registry.stats()["reloads"] == 2
+
+
+def test_bad_reload_keeps_previous_version(tmp_path):
+    path = tmp_path / "themes.json"
+    write_themes(path, {"version": "v1", "themes": {"Pixel Art": PIXEL_ART}}, 1000)
+    registry = ThemeRegistry(path=str(path), reload_interval=0)
+
+    write_themes(path, {"version": "v2", "themes": {"Pixel Art": {"user_text": "missing system prompt"}}}, 2000)
+    assert registry.get("Pixel Art").temperature == 0.4
+    assert registry.stats()["version"] == "v1"
+    assert registry.stats()["reload_failures"] == 1
+
+
+def test_usage_is_counted_per_theme():
+    registry = ThemeRegistry()
+    registry.use("Anime")
+    registry.use("Anime")
+    registry.use("Vaporwave")
+    registry.get("Cartoon")
+    assert registry.stats()["usage"] == {"Anime": 2, "Default": 1}
@@ -0,0 +1,52 @@
+import time
+
+from titles import generate_with_title, local_title
+
+
+def test_local_title_keeps_subject_words():
+    """Test the local title drops filler and style words"""
+    title = local_title("A minimalist sketch of a fox hunting in the snow. Clean lines.", "Minimalism")
+    assert title == "Fox Hunting Snow"
+
+
+def test_local_title_falls_back_to_theme():
+    assert local_title("An abstract artwork.", "abstract") == "Abstract Scene"
+
+
+def test_title_runs_alongside_image():
+    """Test the title and image calls overlap instead of running back to back"""
+    def image_call(deadline):
+        time.sleep(0.2)
+        return "image"
+
+    def title_call(description, theme, deadline):
+        time.sleep(0.2)
+        return "Fox in Snow"
+
+    start = time.monotonic()
+    image, title, source = generate_with_title(image_call, title_call, "A fox", "Anime", grace_seconds=1.0)
+    assert (image, title, source) == ("image", "Fox in Snow", "model")
+    assert time.monotonic() - start < 0.35
+
+
+def test_slow_title_uses_local_fallback():
+    def image_call(deadline):
+        return "image"
+
+    def title_call(description, theme, deadline):
+        time.sleep(0.5)
+        return "Too Late"
+
+    image, title, source = generate_with_title(image_call, title_call, "A red barn at dusk.", "Realism", grace_seconds=0.05)
+    assert image == "image"
+    assert source == "local"
+    assert title == "Red Barn At Dusk"
+
+
+def test_failed_title_uses_local_fallback():
+    def title_call(description, theme, deadline):
+        raise RuntimeError("upstream down")
+
+    _, title, source = generate_with_title(lambda deadline: "image", title_call, "A lighthouse on a cliff.", "Cartoon")
+    assert source == "local"
+    assert title == "Lighthouse On Cliff"
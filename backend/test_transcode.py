@@ -0,0 +1,101 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from result_cache import ResultCache
+from transcode import Transcoder, format_supported, read_tier_list
+
+
+def encode(img, fmt='PNG'):
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+@pytest.fixture
+def generated_png():
+    # A noisy gradient compresses about as badly as a real render
+    image = Image.effect_noise((1024, 1024), 64).convert('RGB')
+    return encode(image)
+
+
+def decode(image_base64):
+    return Image.open(io.BytesIO(base64.b64decode(image_base64)))
+
+
+def test_read_options():
+    transcoder = Transcoder()
+    assert transcoder.read_options({"theme": "Anime"}) == (None, None)
+    assert transcoder.read_options({"output_format": "JPG"}) == ({"format": "jpeg", "quality": 80, "tiers": ["full"]}, None)
+    # Tiers may come as a form field; they are returned smallest first
+    options, _ = transcoder.read_options({"tiers": "full, thumbnail", "output_quality": "60"})
+    assert options == {"format": "webp", "quality": 60, "tiers": ["thumbnail", "full"]}
+
+    assert "output_format" in transcoder.read_options({"output_format": "tiff"})[1]
+    assert "output_quality" in transcoder.read_options({"output_quality": 101})[1]
+    assert read_tier_list(["poster"])[1].startswith("Unknown tiers")
+
+
+def test_tiers_are_resized_and_smaller(generated_png):
+    transcoder = Transcoder()
+    result = transcoder.transcode(generated_png, {"format": "webp", "quality": 75, "tiers": ["thumbnail", "screen", "full"]})
+
+    assert result["output"]["tier"] == "full"
+    assert result["output"]["mimetype"] == "image/webp"
+    assert decode(result["image"]).format == "WEBP"
+    assert decode(result["image"]).size == (1024, 1024)
+    assert decode(result["tiers"]["thumbnail"]["image"]).size == (256, 256)
+    assert result["tiers"]["screen"]["width"] == 768
+    assert result["tiers"]["thumbnail"]["bytes"] < result["tiers"]["screen"]["bytes"] < result["output"]["bytes"]
+    assert result["output"]["bytes"] < len(base64.b64decode(generated_png))
+
+
+def test_renditions_are_cached_per_result(generated_png):
+    transcoder = Transcoder(cache=ResultCache())
+    options = {"format": "jpeg", "quality": 70, "tiers": ["thumbnail"]}
+    first = transcoder.transcode(generated_png, options)
+    second = transcoder.transcode(generated_png, options)
+    assert first == second
+    assert transcoder.stats()["renditions"] == 1
+    assert transcoder.stats()["cache_hits"] == 1
+
+    # Another quality is another rendition
+    transcoder.transcode(generated_png, dict(options, quality=40))
+    assert transcoder.stats()["renditions"] == 2
+
+
+def test_png_full_is_passed_through(generated_png):
+    transcoder = Transcoder(cache=ResultCache())
+    result = transcoder.transcode(generated_png, {"format": "png", "quality": 80, "tiers": ["full"]})
+    assert result["image"] == generated_png
+    assert result["tiers"] == {}
+    assert transcoder.stats()["passthrough"] == 1
+
+
+def test_jpeg_flattens_transparency():
+    transparent = encode(Image.new('RGBA', (40, 40), (0, 0, 0, 0)))
+    result = Transcoder().transcode(transparent, {"format": "jpeg", "quality": 90, "tiers": ["full"]})
+    image = decode(result["image"])
+    assert image.mode == "RGB"
+    assert image.getpixel((20, 20))[0] > 250
+
+
+def test_unsupported_format_falls_back_to_webp(generated_png, monkeypatch):
+    monkeypatch.setattr("transcode.format_supported", lambda fmt: fmt != "avif")
+    transcoder = Transcoder()
+    result = transcoder.transcode(generated_png, {"format": "avif", "quality": 50, "tiers": ["thumbnail"]})
+    assert result["output"]["format"] == "webp"
+    assert transcoder.stats()["format_fallbacks"] == 1
+    assert format_supported("png")
+
+
+def test_only_avif_falls_back(monkeypatch):
+    """Test other formats the Pillow build can't encode are rejected instead of swapped"""
+    monkeypatch.setattr("transcode.format_supported", lambda fmt: fmt not in ("avif", "jpeg"))
+    transcoder = Transcoder()
+    assert transcoder.read_options({"output_format": "avif"})[1] is None
+    options, error = transcoder.read_options({"output_format": "jpeg"})
+    assert options is None
+    assert "not available" in error
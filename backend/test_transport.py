@@ -0,0 +1,73 @@
+import base64
+import email
+import io
+
+from PIL import Image
+from werkzeug.datastructures import MultiDict
+
+from transport import encode_binary_response, read_binary_upload, requested_response_format, upload_fields
+
+
+def png():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'white').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def test_upload_fields_reads_repeated_and_comma_separated_themes():
+    fields = MultiDict([("theme", "Anime"), ("prompt", "a fox"), ("themes", "Anime, Realism"), ("themes", "Abstract")])
+    assert upload_fields(fields.getlist) == {
+        "theme": "Anime",
+        "prompt": "a fox",
+        "themes": ["Anime", "Realism", "Abstract"],
+    }
+
+
+def test_read_multipart_upload():
+    image = png()
+    boundary = "sketchboundary"
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"theme\"\r\n\r\nCartoon\r\n"
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"sketch.png\"\r\n"
+        f"Content-Type: image/png\r\n\r\n"
+    ).encode() + image + f"\r\n--{boundary}--\r\n".encode()
+    data = read_binary_upload(body, f"multipart/form-data; boundary={boundary}", lambda name: [])
+    assert data == {"theme": "Cartoon", "image": image}
+
+
+def test_read_raw_upload_takes_fields_from_query():
+    image = png()
+    query = {"theme": ["Realism"], "complexity": ["hd"]}
+    data = read_binary_upload(image, "image/png", lambda name: query.get(name, []))
+    assert data == {"theme": "Realism", "complexity": "hd", "image": image}
+
+
+def test_requested_response_format():
+    assert requested_response_format(None) is None
+    assert requested_response_format("*/*") is None
+    assert requested_response_format("image/png") == "image"
+    assert requested_response_format("multipart/mixed") == "multipart"
+    assert requested_response_format("image/png", requested="json") is None
+    # Browser defaults list image types but prefer HTML/JSON-compatible types
+    assert requested_response_format("text/html,image/webp,*/*;q=0.8") is None
+
+
+def test_image_response_carries_metadata_headers():
+    image = png()
+    body = {"image": base64.b64encode(image).decode(), "title": "Café Sketch", "description": "A café.", "prompt": "A café."}
+    payload, content_type, headers = encode_binary_response(body, "image")
+    assert payload == image
+    assert content_type == "image/png"
+    assert headers["X-Sketchify-Title"] == "Caf%C3%A9%20Sketch"
+
+
+def test_multipart_mixed_response_parses_back():
+    image = png()
+    body = {"image": base64.b64encode(image).decode(), "title": "Fox", "description": "A fox.", "prompt": "A fox."}
+    payload, content_type, _ = encode_binary_response(body, "multipart")
+    message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + payload)
+    metadata, image_part = message.get_payload()
+    assert metadata.get_content_type() == "application/json"
+    assert b'"title": "Fox"' in metadata.get_payload(decode=True)
+    assert image_part.get_content_type() == "image/png"
+    assert image_part.get_payload(decode=True) == image
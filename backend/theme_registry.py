@@ -0,0 +1,227 @@
+"""
+Theme registry: every theme compiled once into ready-to-use prompt pieces.
+
+create_transformation_prompt used to rebuild the fallback prompt from the
+theme text (a chain of str.replace, split('.') and index('Focus on')) on
+every call, and adding a theme meant editing themes.py and redeploying.
+Themes are now validated and compiled when they are loaded: the fallback
+prompt, the transformation instruction used by the one-pass prompts, the
+style enhancers and the temperature. Setting THEMES_FILE to a JSON or YAML
+file layers its themes over the built-in ones; each worker checks the file's
+modification time every THEMES_RELOAD_SECONDS and swaps in the new version
+without a restart. A file that fails validation is logged and ignored, so
+the previous themes stay live.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from numbers import Number
+
+from themes import THEMES
+
+# Added to the fallback prompt of the built-in themes; file themes can set "enhancers"
+STYLE_ENHANCERS = {
+    "Minimalism": "clean lines, elegant simplicity, essential elements only, minimalist design",
+    "Abstract": "abstract interpretation, non-literal, expressive colors, emotional resonance, abstract art style, free-form shapes",
+    "Realism": "photorealistic details, true-to-life lighting and textures, accurate lighting and shadows, precise proportions, lifelike quality",
+    "Anime": "anime style art, expressive eyes, vibrant colors, manga aesthetics, dynamic poses",
+    "Cartoon": "cartoon style, bold outlines, exaggerated features, vibrant colors, playful aesthetic, whimsical elements, animated look",
+    "Nature": "natural elements, organic forms, environmental harmony"
+}
+
+DEFAULT_THEME = "Default"
+
+
+def build_fallback_prompt(theme_name, theme_context, theme_prompt, enhancers=None):
+    """
+    The local transformation prompt for a theme, without the user's request.
+    Built from the theme's system prompt and user text, as
+    create_transformation_prompt always did.
+    """
+    # Remove instructions that are specific to description tasks
+    clean_context = theme_context.replace("these are instructions for a diffusion model.", "")
+    clean_context = clean_context.replace("Describe the sketch", "Transform the sketch")
+    clean_context = clean_context.replace("in 1-2 sentences", "")
+
+    # Remove instructions about descriptions and focus on style elements
+    focus_points = theme_prompt.replace("Translate this sketch into", "Create")
+    focus_points = focus_points.replace("description", "image")
+
+    transformation_prompt = f"Transform this sketch into a high-quality {theme_name} style image while preserving its key elements and composition. "
+
+    # Use the first couple of sentences that define the style
+    if clean_context and "." in clean_context:
+        style_guidance = ". ".join(clean_context.split(".")[:2]) + "."
+        transformation_prompt += f"{style_guidance} "
+
+    if enhancers:
+        transformation_prompt += f"Include these style elements: {enhancers}. "
+
+    if "Focus on" in focus_points:
+        focus_text = focus_points[focus_points.index("Focus on"):]
+        transformation_prompt += f"{focus_text} "
+
+    return transformation_prompt
+
+
+class CompiledTheme:
+    """One theme with its prompt pieces built up front."""
+
+    def __init__(self, name, system_content, user_text, temperature=0.7, enhancers=None, version=None, context_filter=None):
+        self.name = name
+        self.system_content = system_content
+        self.user_text = user_text
+        self.temperature = temperature
+        self.enhancers = enhancers
+        self.version = version
+        self.fallback_base = build_fallback_prompt(name, system_content, user_text, enhancers)
+        # The style elements quoted to Gemini, e.g. fitted to a token budget (see prompt_budget.py)
+        style_elements = context_filter(system_content) if context_filter else system_content
+        self.transformation_instruction = (
+            f"Create a detailed prompt to transform this sketch into {name} style while preserving "
+            f"the original content. Use these style elements: {style_elements}"
+        )
+
+    def fallback_prompt(self, user_prompt=""):
+        if user_prompt:
+            return self.fallback_base + f"Additional details: {user_prompt}. "
+        return self.fallback_base
+
+
+def compile_theme(name, data, version=None, context_filter=None):
+    """Validate one theme definition and compile it; raises ValueError if it is invalid."""
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError(f"Theme names must be non-empty strings, got {name!r}")
+    if not isinstance(data, dict):
+        raise ValueError(f"Theme {name} must be an object")
+    for field in ("system_content", "user_text"):
+        if not isinstance(data.get(field), str) or not data[field].strip():
+            raise ValueError(f"Theme {name} needs a non-empty {field}")
+    temperature = data.get("temperature", 0.7)
+    if isinstance(temperature, bool) or not isinstance(temperature, Number) or not 0 <= temperature <= 2:
+        raise ValueError(f"Theme {name} temperature must be a number from 0 to 2")
+    enhancers = data.get("enhancers", STYLE_ENHANCERS.get(name))
+    if enhancers is not None and not isinstance(enhancers, str):
+        raise ValueError(f"Theme {name} enhancers must be a string")
+    return CompiledTheme(name, data["system_content"], data["user_text"], temperature, enhancers, version, context_filter)
+
+
+def read_theme_file(path):
+    """(version, themes) from a JSON or YAML theme file."""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("PyYAML is needed to load YAML theme files")
+        document = yaml.safe_load(text)
+    else:
+        document = json.loads(text)
+    if not isinstance(document, dict):
+        raise ValueError("A theme file must hold an object")
+    # {"version": ..., "themes": {...}}, or just the themes
+    if isinstance(document.get("themes"), dict):
+        return document.get("version"), document["themes"]
+    return None, document
+
+
+class ThemeRegistry:
+    def __init__(self, themes=None, path=None, reload_interval=5.0, context_filter=None):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.context_filter = context_filter
+        self._builtin = THEMES if themes is None else themes
+        self._lock = threading.Lock()
+        self._usage = {}
+        self._counters = {"reloads": 0, "reload_failures": 0}
+        self._mtime = None
+        self._next_check = 0.0
+        self.version = "builtin"
+        self.loaded_at = time.time()
+        # Replaced as a whole on reload, so readers never see a half-loaded set
+        self._themes = self._compile(self._builtin, {}, self.version)
+        if self.path:
+            self.check_reload(force=True)
+
+    @classmethod
+    def from_env(cls, context_filter=None):
+        return cls(
+            path=os.environ.get("THEMES_FILE") or None,
+            reload_interval=float(os.environ.get("THEMES_RELOAD_SECONDS", 5)),
+            context_filter=context_filter,
+        )
+
+    def _compile(self, builtin, overrides, version):
+        definitions = dict(builtin)
+        definitions.update(overrides)
+        if DEFAULT_THEME not in definitions:
+            raise ValueError(f"The {DEFAULT_THEME} theme is required")
+        return {name: compile_theme(name, data, version, self.context_filter) for name, data in definitions.items()}
+
+    def check_reload(self, force=False):
+        """
+        Load the theme file if it changed since the last load. Returns True
+        when a new version went live.
+        """
+        if not self.path:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if not force and now < self._next_check:
+                return False
+            self._next_check = now + self.reload_interval
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if not force and mtime == self._mtime:
+                    return False
+                self._mtime = mtime
+                file_version, overrides = read_theme_file(self.path)
+                version = str(file_version) if file_version is not None else f"{os.path.basename(self.path)}@{int(mtime)}"
+                self._themes = self._compile(self._builtin, overrides, version)
+            except Exception as e:
+                self._counters["reload_failures"] += 1
+                logging.error(f"Keeping theme version {self.version}; could not load {self.path}: {e}")
+                return False
+            self.version = version
+            self.loaded_at = time.time()
+            self._counters["reloads"] += 1
+        logging.info(f"Loaded theme version {version} ({len(self._themes)} themes)")
+        return True
+
+    def _current(self):
+        self.check_reload()
+        return self._themes
+
+    def __contains__(self, name):
+        return name in self._current()
+
+    def names(self):
+        return list(self._current())
+
+    def peek(self, name):
+        """The compiled theme, or None if there is no such theme. Not counted as a use."""
+        return self._current().get(name)
+
+    def get(self, name):
+        themes = self._current()
+        return themes.get(name) or themes[DEFAULT_THEME]
+
+    def use(self, name):
+        """The compiled theme for a request (Default for unknown names), counted per theme."""
+        theme = self.get(name)
+        with self._lock:
+            self._usage[theme.name] = self._usage.get(theme.name, 0) + 1
+        return theme
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["usage"] = dict(self._usage)
+        stats["version"] = self.version
+        stats["loaded_at"] = self.loaded_at
+        stats["source"] = self.path or "themes.py"
+        stats["themes"] = sorted(self._themes)
+        return stats
@@ -0,0 +1,79 @@
+"""
+Title helpers shared by the multi-pass servers (gemini.py, gpt-stability.py).
+
+Title generation only needs the description, so it runs alongside the image
+call instead of before or after it. Both share one deadline. Once the image
+is back, the title gets a short grace period, and if it still isn't ready a
+local title built from the description is used instead.
+"""
+import os
+import re
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# Seconds the image + title stage may take in total
+STAGE_DEADLINE_SECONDS = float(os.getenv("STAGE_DEADLINE_SECONDS", 60))
+# Seconds to keep waiting for the title once the image is ready
+TITLE_GRACE_SECONDS = float(os.getenv("TITLE_GRACE_SECONDS", 1.0))
+
+title_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TITLE_WORKERS", os.getenv("GUNICORN_THREADS", 8))),
+    thread_name_prefix="title",
+)
+
+# Words that say nothing about the subject of the image
+FILLER_WORDS = {
+    "a", "an", "the", "this", "that", "these", "image", "picture", "sketch", "drawing",
+    "depicts", "shows", "showing", "features", "featuring", "of", "is", "are", "with",
+    "in", "style", "art", "artwork", "artistic", "ai", "creative", "rendered", "simple",
+    "minimalist", "abstract", "realistic", "photorealistic", "anime", "cartoon",
+}
+
+
+def remaining(deadline):
+    """Seconds left before a time.monotonic() deadline (never negative)."""
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def local_title(description, theme):
+    """
+    Fast title from the description alone: the first few meaningful words of
+    its first sentence, title-cased.
+    """
+    first_sentence = re.split(r"[.!?\n]", description.strip(), maxsplit=1)[0]
+    words = re.findall(r"[A-Za-z][A-Za-z'-]*", first_sentence)
+    theme_word = theme.lower()
+    content = [word for word in words if word.lower() not in FILLER_WORDS and word.lower() != theme_word]
+    if not content:
+        return f"{theme.capitalize()} Scene"
+    return " ".join(word.capitalize() for word in content[:5])
+
+
+def generate_with_title(image_call, title_call, description, theme,
+                        deadline_seconds=None, grace_seconds=None):
+    """
+    Run title_call(description, theme, deadline) on the title pool while
+    image_call(deadline) runs on the calling thread.
+    Returns (image_result, title, title_source) where title_source is
+    "model" or "local".
+    """
+    deadline = time.monotonic() + (STAGE_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds)
+    grace = TITLE_GRACE_SECONDS if grace_seconds is None else grace_seconds
+
+    title_future = title_executor.submit(title_call, description, theme, deadline)
+    try:
+        image_result = image_call(deadline)
+    except Exception:
+        title_future.cancel()
+        raise
+
+    try:
+        title = title_future.result(timeout=min(grace, remaining(deadline)))
+        return image_result, title, "model"
+    except FutureTimeoutError:
+        logging.warning("Title generation overran the image call, using a local title")
+    except Exception as e:
+        logging.error(f"Title generation failed: {e}")
+    title_future.cancel()
+    return image_result, local_title(description, theme), "local"
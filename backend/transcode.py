@@ -0,0 +1,208 @@
+"""
+Output transcoding for generated images.
+
+Imagen returns a full-size PNG, which mobile clients mostly show at
+thumbnail size first. A request can ask for the image in another format
+(`output_format`: webp, jpeg, avif or png), at a given `output_quality`
+(1-100), and in one or more size tiers (`tiers`: thumbnail, screen, full).
+The response's "image" is the largest requested tier; the smaller ones are
+returned under "tiers". Renditions are cached per hash of the generated
+image plus format, quality and tier, so cached results and re-requests of
+the same image don't re-encode. AVIF needs a Pillow build with AVIF
+support; without it, AVIF requests get WebP.
+"""
+import os
+import base64
+import logging
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+from ingest import sniff_format
+from result_cache import ResultCache, sketch_hash
+
+# format name -> (PIL format, mimetype)
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+    "avif": ("AVIF", "image/avif"),
+}
+FORMAT_ALIASES = {"jpg": "jpeg"}
+
+# AVIF needs a Pillow built with libavif; without it WebP is the next smallest.
+# Other formats the build can't encode are rejected
+FORMAT_FALLBACKS = {"avif": "webp"}
+
+# Smallest first; "full" keeps the generated size
+TIERS = ("thumbnail", "screen", "full")
+
+# Response fields added by transcoding (besides the replaced "image")
+OUTPUT_FIELDS = ("output", "tiers")
+
+
+def format_supported(fmt):
+    Image.init()
+    return FORMATS[fmt][0] in Image.SAVE
+
+
+def read_tier_list(tiers):
+    """Requested tiers as a list or comma-separated string; returns (tiers, error)."""
+    if isinstance(tiers, str):
+        tiers = tiers.split(",")
+    if not isinstance(tiers, list) or not tiers:
+        return None, f"tiers must be a non-empty list of {', '.join(TIERS)}"
+    requested = {str(tier).strip().lower() for tier in tiers}
+    unknown = sorted(requested - set(TIERS))
+    if unknown:
+        return None, f"Unknown tiers {unknown}, expected some of {list(TIERS)}"
+    return [tier for tier in TIERS if tier in requested], None
+
+
+class Transcoder:
+    def __init__(self, cache=None, thumbnail_size=256, screen_size=768, default_format="webp", default_quality=80):
+        self.cache = cache
+        # Longest side in pixels; images are never scaled up
+        self.sizes = {"thumbnail": thumbnail_size, "screen": screen_size, "full": None}
+        self.default_format = default_format
+        self.default_quality = default_quality
+        self._lock = threading.Lock()
+        self._counters = {
+            "requests": 0, "renditions": 0, "cache_hits": 0, "passthrough": 0,
+            "format_fallbacks": 0, "bytes_in": 0, "bytes_out": 0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        cache = None
+        if os.environ.get("TRANSCODE_CACHE_ENABLED", "1") != "0":
+            cache = ResultCache.from_env(prefix="TRANSCODE_CACHE")
+        return cls(
+            cache=cache,
+            thumbnail_size=int(os.environ.get("TRANSCODE_THUMBNAIL_SIZE", 256)),
+            screen_size=int(os.environ.get("TRANSCODE_SCREEN_SIZE", 768)),
+            default_format=os.environ.get("TRANSCODE_DEFAULT_FORMAT", "webp"),
+            default_quality=int(os.environ.get("TRANSCODE_DEFAULT_QUALITY", 80)),
+        )
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self._counters[name] += amount
+
+    def read_options(self, data):
+        """
+        Returns (options, error). options is None when the request asks for
+        no transcoding, so the generated PNG is returned as is.
+        """
+        if not isinstance(data, dict) or all(data.get(name) in (None, "") for name in ("output_format", "output_quality", "tiers")):
+            return None, None
+
+        fmt = str(data.get("output_format") or self.default_format).strip().lower()
+        fmt = FORMAT_ALIASES.get(fmt, fmt)
+        if fmt not in FORMATS:
+            return None, f"Unknown output_format {fmt!r}, expected one of {sorted(FORMATS)}"
+        if not format_supported(fmt) and not format_supported(FORMAT_FALLBACKS.get(fmt, fmt)):
+            return None, f"output_format {fmt!r} is not available on this server"
+
+        quality = data.get("output_quality")
+        try:
+            quality = self.default_quality if quality in (None, "") else int(quality)
+        except (TypeError, ValueError):
+            return None, "output_quality must be an integer from 1 to 100"
+        if not 1 <= quality <= 100:
+            return None, "output_quality must be an integer from 1 to 100"
+
+        tiers, error = read_tier_list(data["tiers"]) if data.get("tiers") not in (None, "") else (["full"], None)
+        if error:
+            return None, error
+        return {"format": fmt, "quality": quality, "tiers": tiers}, None
+
+    def _resolve_format(self, fmt):
+        if format_supported(fmt):
+            return fmt
+        fallback = FORMAT_FALLBACKS[fmt]
+        logging.warning(f"Pillow cannot encode {fmt}; falling back to {fallback}")
+        self._count(format_fallbacks=1)
+        return fallback
+
+    def _render(self, image, fmt, quality, tier):
+        size = self.sizes[tier]
+        if size and max(image.size) > size:
+            image = image.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+        if fmt == "jpeg" and image.mode != "RGB":
+            # JPEG has no alpha; flatten onto white like the canvas background
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+            image = background
+        buffered = BytesIO()
+        if fmt == "png":
+            image.save(buffered, format="PNG")
+        else:
+            image.save(buffered, format=FORMATS[fmt][0], quality=quality)
+        data = buffered.getvalue()
+        return {"image": base64.b64encode(data).decode("utf-8"), "width": image.width, "height": image.height, "bytes": len(data)}
+
+    def transcode(self, image_base64, options):
+        """
+        Renditions of a generated base64 image. Returns the response fields
+        that replace "image": the largest requested tier as "image", its
+        details as "output" and any smaller tiers under "tiers".
+        """
+        source = base64.b64decode(image_base64)
+        fmt = self._resolve_format(options["format"])
+        quality = options["quality"]
+        result_hash = sketch_hash(source)
+        image = None
+        renditions = {}
+
+        for tier in options["tiers"]:
+            if fmt == "png" and tier == "full" and sniff_format(source[:16]) == "png":
+                # Already what the client asked for
+                with Image.open(BytesIO(source)) as opened:
+                    width, height = opened.size
+                renditions[tier] = {"image": image_base64, "width": width, "height": height, "bytes": len(source)}
+                self._count(passthrough=1)
+                continue
+
+            cache_key = f"{result_hash}:{fmt}:{quality}:{tier}"
+            rendition = self.cache.get(cache_key) if self.cache is not None else None
+            if rendition is not None:
+                self._count(cache_hits=1)
+            else:
+                if image is None:
+                    image = Image.open(BytesIO(source))
+                    image.load()
+                rendition = self._render(image, fmt, quality, tier)
+                self._count(renditions=1)
+                if self.cache is not None:
+                    self.cache.put(cache_key, rendition)
+            renditions[tier] = rendition
+
+        largest = options["tiers"][-1]
+        primary = renditions.pop(largest)
+        self._count(requests=1, bytes_in=len(source), bytes_out=primary["bytes"] + sum(r["bytes"] for r in renditions.values()))
+        return {
+            "image": primary["image"],
+            "output": {
+                "format": fmt,
+                "mimetype": FORMATS[fmt][1],
+                "quality": quality,
+                "tier": largest,
+                "width": primary["width"],
+                "height": primary["height"],
+                "bytes": primary["bytes"],
+            },
+            "tiers": renditions,
+        }
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["bytes_saved_ratio"] = round(1 - stats["bytes_out"] / stats["bytes_in"], 4) if stats["bytes_in"] else 0.0
+        stats["formats"] = [fmt for fmt in FORMATS if format_supported(fmt)]
+        stats["sizes"] = dict(self.sizes)
+        stats["cache"] = self.cache.stats() if self.cache is not None else None
+        return stats
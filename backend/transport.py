@@ -0,0 +1,136 @@
+"""
+Binary transport for /generate-prompt.
+
+Base64 inside JSON adds about a third to every image and makes both ends
+parse a multi-megabyte string. Besides the default JSON body, the endpoint
+accepts a multipart/form-data upload (an "image" file part plus theme,
+prompt, complexity... form fields) or a raw image/* body with those fields
+in the query string. Clients that send `Accept: image/png` (or image/*) get
+the image back as the body with its metadata in percent-encoded X-Sketchify-*
+headers; `Accept: multipart/mixed` returns a JSON metadata part followed by
+the image part. JSON with base64 stays the default in both directions.
+"""
+import json
+import uuid
+import base64
+from io import BytesIO
+from urllib.parse import quote
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.formparser import FormDataParser
+from werkzeug.http import parse_accept_header, parse_options_header
+
+from ingest import sniff_format
+
+# Generation fields read from form fields or the query string of a binary upload
+UPLOAD_FIELDS = ("theme", "prompt", "complexity", "stream", "response", "output_format", "output_quality", "tiers")
+
+BINARY_FORMATS = ("image", "multipart")
+
+METADATA_HEADERS = {
+    "title": "X-Sketchify-Title",
+    "description": "X-Sketchify-Description",
+    "prompt": "X-Sketchify-Prompt",
+}
+
+IMAGE_MIMETYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "gif": "image/gif",
+    "bmp": "image/bmp",
+    "avif": "image/avif",
+}
+
+
+def is_binary_upload(mimetype):
+    return mimetype == "multipart/form-data" or (mimetype or "").startswith("image/")
+
+
+def upload_fields(getlist):
+    """
+    Generation fields from form or query values; getlist(name) returns every
+    value sent for name. `themes` may be repeated or comma-separated.
+    """
+    data = {}
+    for name in UPLOAD_FIELDS:
+        values = getlist(name)
+        if values:
+            data[name] = values[0]
+    themes = [theme.strip() for value in getlist("themes") for theme in value.split(",") if theme.strip()]
+    if themes:
+        data["themes"] = themes
+    return data
+
+
+def read_form_upload(form, files):
+    """Payload for a multipart/form-data upload, with the image as bytes."""
+    data = upload_fields(form.getlist)
+    upload = files.get("image") or next(iter(files.values()), None)
+    data["image"] = upload.read() if upload is not None else None
+    return data
+
+
+def read_raw_upload(body, getlist):
+    """Payload for a raw image/* body, with the fields taken from the query string."""
+    data = upload_fields(getlist)
+    data["image"] = body or None
+    return data
+
+
+def read_binary_upload(body, content_type, getlist):
+    """Payload of a multipart or raw image body, for servers without a form parser."""
+    mimetype, options = parse_options_header(content_type)
+    if mimetype == "multipart/form-data":
+        _, form, files = FormDataParser().parse(BytesIO(body), mimetype, len(body), options)
+        return read_form_upload(form, files)
+    return read_raw_upload(body, getlist)
+
+
+def requested_response_format(accept_header, requested=None):
+    """
+    Binary response format asked for through a `response` value or the
+    Accept header ("image" or "multipart"), or None for JSON.
+    """
+    if requested:
+        requested = str(requested).lower()
+        return requested if requested in BINARY_FORMATS else None
+    # JSON is offered first, so "*/*" and browser defaults keep getting JSON
+    best = parse_accept_header(accept_header or "", MIMEAccept).best_match(
+        ["application/json", "image/png", "multipart/mixed"], default="application/json"
+    )
+    return {"image/png": "image", "multipart/mixed": "multipart"}.get(best)
+
+
+def image_mimetype(image_bytes):
+    return IMAGE_MIMETYPES.get(sniff_format(image_bytes[:16]), "application/octet-stream")
+
+
+def metadata_headers(body):
+    """Response metadata as header values: percent-encoded UTF-8, so any title is header-safe."""
+    headers = {header: quote(body[field]) for field, header in METADATA_HEADERS.items() if body.get(field) is not None}
+    # Lets browser clients read them through CORS
+    headers["Access-Control-Expose-Headers"] = ", ".join(METADATA_HEADERS.values())
+    return headers
+
+
+def encode_binary_response(body, response_format):
+    """
+    Encode a generation response body for a binary response format.
+    Returns (payload, content_type, headers).
+    """
+    image_bytes = base64.b64decode(body["image"])
+    mimetype = image_mimetype(image_bytes)
+    if response_format == "image":
+        return image_bytes, mimetype, metadata_headers(body)
+
+    boundary = uuid.uuid4().hex
+    metadata = json.dumps({key: value for key, value in body.items() if key != "image"}).encode("utf-8")
+    payload = b"".join([
+        f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode("latin-1"),
+        metadata,
+        f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Disposition: inline; name=\"image\"\r\n\r\n".encode("latin-1"),
+        image_bytes,
+        f"\r\n--{boundary}--\r\n".encode("latin-1"),
+    ])
+    return payload, f"multipart/mixed; boundary={boundary}", {}
@@ -0,0 +1,323 @@
+"""
+Process-wide upstream client manager.
+
+All OpenAI-compatible clients (Gemini, OpenAI) and the HTTP session used for
+Stability share keep-alive connection pools that live for the whole process,
+so a request reuses warm TLS connections instead of opening new ones.
+"""
+import os
+import asyncio
+import threading
+import logging
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from openai import OpenAI, AsyncOpenAI
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/openai/"
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def pipeline_threads():
+    """
+    Threads in this process that can run pipeline stages at once: the server's
+    request threads plus the theme fan-out, batch and job pools.
+    """
+    return sum(_env_int(name, default) for name, default in (
+        ("GUNICORN_THREADS", 8), ("THEME_FANOUT_WORKERS", 8), ("BATCH_CONCURRENCY", 4), ("JOB_WORKERS", 4),
+    ))
+
+
+def upstream_workers():
+    """
+    Threads that can hold an upstream connection at once: the pipeline
+    threads, the title workers (see titles.py) and, with hedging on, the
+    hedge workers (see hedging.py).
+    """
+    threads = pipeline_threads()
+    workers = threads + _env_int("TITLE_WORKERS", _env_int("GUNICORN_THREADS", 8))
+    if os.environ.get("HEDGE_ENABLED", "0") == "1":
+        workers += _env_int("HEDGE_WORKERS", 2 * threads)
+    return workers
+
+
+def http2_available():
+    """HTTP/2 needs the optional `h2` package; fall back to HTTP/1.1 without it."""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class _CountingTransport(httpx.HTTPTransport):
+    """
+    HTTP transport that reports in-flight requests to the manager. httpx has
+    no public view of its pool, so `active` (requests holding a connection)
+    is counted here.
+    """
+
+    def __init__(self, manager, **kwargs):
+        super().__init__(**kwargs)
+        self._manager = manager
+        self.active = 0
+
+    def handle_request(self, request):
+        self._manager._request_started(self)
+        try:
+            return super().handle_request(request)
+        except Exception:
+            self._manager._request_failed()
+            raise
+        finally:
+            self._manager._request_finished(self)
+
+
+class _CountingAsyncTransport(httpx.AsyncHTTPTransport):
+    """Async counterpart of _CountingTransport, used by the ASGI entry point."""
+
+    def __init__(self, manager, **kwargs):
+        super().__init__(**kwargs)
+        self._manager = manager
+        self.active = 0
+
+    async def handle_async_request(self, request):
+        self._manager._request_started(self)
+        try:
+            return await super().handle_async_request(request)
+        except Exception:
+            self._manager._request_failed()
+            raise
+        finally:
+            self._manager._request_finished(self)
+
+
+class UpstreamClientManager:
+    """
+    Owns the shared httpx client, the OpenAI clients built on top of it and a
+    pooled requests.Session. Safe to use from every gunicorn thread.
+    """
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None,
+                 keepalive_expiry=None, http2=None):
+        # One connection per thread that can call upstream, so none of them queues for the pool
+        self.pool_size = pool_size or _env_int("UPSTREAM_POOL_SIZE", upstream_workers())
+        # The async pool is not tied to a thread count, so it can hold far
+        # more concurrent upstream waits than the threaded server
+        self.async_pool_size = _env_int("UPSTREAM_ASYNC_POOL_SIZE", 256)
+        self.connect_timeout = connect_timeout or _env_float("UPSTREAM_CONNECT_TIMEOUT", 10.0)
+        self.read_timeout = read_timeout or _env_float("UPSTREAM_READ_TIMEOUT", 120.0)
+        self.keepalive_expiry = keepalive_expiry or _env_float("UPSTREAM_KEEPALIVE_EXPIRY", 60.0)
+        if http2 is None:
+            http2 = os.environ.get("UPSTREAM_HTTP2", "1") != "0"
+        self.http2 = http2 and http2_available()
+
+        self._lock = threading.Lock()
+        self._transport = None
+        self._http_client = None
+        self._clients = {}
+        self._session = None
+        # Async clients are bound to the event loop that created them
+        self._async = weakref.WeakKeyDictionary()
+        self._counters = {
+            "clients_created": 0,
+            "requests": 0,
+            "errors": 0,
+            "in_flight": 0,
+            "peak_in_flight": 0,
+            "session_requests": 0,
+        }
+
+    def timeout(self):
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+    def requests_timeout(self):
+        """(connect, read) tuple for calls made through the requests session."""
+        return (self.connect_timeout, self.read_timeout)
+
+    # Counters updated by the transport and session hooks
+    def _request_started(self, transport):
+        with self._lock:
+            transport.active += 1
+            self._counters["requests"] += 1
+            self._counters["in_flight"] += 1
+            if self._counters["in_flight"] > self._counters["peak_in_flight"]:
+                self._counters["peak_in_flight"] = self._counters["in_flight"]
+
+    def _request_failed(self):
+        with self._lock:
+            self._counters["errors"] += 1
+
+    def _request_finished(self, transport):
+        with self._lock:
+            transport.active -= 1
+            self._counters["in_flight"] -= 1
+
+    def _session_response(self, response, *args, **kwargs):
+        with self._lock:
+            self._counters["session_requests"] += 1
+        return response
+
+    def http_client(self):
+        with self._lock:
+            if self._http_client is None:
+                limits = httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                    keepalive_expiry=self.keepalive_expiry,
+                )
+                self._transport = _CountingTransport(self, http2=self.http2, limits=limits)
+                self._http_client = httpx.Client(transport=self._transport, timeout=self.timeout())
+                logging.info(
+                    f"Created upstream connection pool (size={self.pool_size}, http2={self.http2})"
+                )
+            return self._http_client
+
+    def get_client(self, api_key=None, base_url=GEMINI_BASE_URL, max_retries=None):
+        """
+        Return the shared OpenAI client for this key/base URL. Pass
+        base_url=None for the default OpenAI endpoint, and max_retries=0 when
+        the caller retries on its own (see resilience.py).
+        """
+        key = (api_key, base_url, max_retries)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        http_client = self.http_client()
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                kwargs = {"api_key": api_key, "http_client": http_client, "timeout": self.timeout()}
+                if base_url:
+                    kwargs["base_url"] = base_url
+                if max_retries is not None:
+                    kwargs["max_retries"] = max_retries
+                client = OpenAI(**kwargs)
+                self._clients[key] = client
+                self._counters["clients_created"] += 1
+            return client
+
+    def get_async_client(self, api_key=None, base_url=GEMINI_BASE_URL, max_retries=None):
+        """
+        Return the shared AsyncOpenAI client for the running event loop.
+        Must be called from inside a coroutine.
+        """
+        loop = asyncio.get_running_loop()
+        key = (api_key, base_url, max_retries)
+        with self._lock:
+            state = self._async.get(loop)
+            if state is None:
+                limits = httpx.Limits(
+                    max_connections=self.async_pool_size,
+                    max_keepalive_connections=self.async_pool_size,
+                    keepalive_expiry=self.keepalive_expiry,
+                )
+                transport = _CountingAsyncTransport(self, http2=self.http2, limits=limits)
+                state = {
+                    "transport": transport,
+                    "http_client": httpx.AsyncClient(transport=transport, timeout=self.timeout()),
+                    "clients": {},
+                }
+                self._async[loop] = state
+                logging.info(
+                    f"Created async upstream connection pool (size={self.async_pool_size}, http2={self.http2})"
+                )
+            client = state["clients"].get(key)
+            if client is None:
+                kwargs = {"api_key": api_key, "http_client": state["http_client"], "timeout": self.timeout()}
+                if base_url:
+                    kwargs["base_url"] = base_url
+                if max_retries is not None:
+                    kwargs["max_retries"] = max_retries
+                client = AsyncOpenAI(**kwargs)
+                state["clients"][key] = client
+                self._counters["clients_created"] += 1
+            return client
+
+    async def aclose(self):
+        """Close the async pool belonging to the running event loop."""
+        with self._lock:
+            state = self._async.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state["http_client"].aclose()
+
+    def get_session(self):
+        """Pooled requests.Session for upstreams that aren't OpenAI-compatible."""
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.hooks["response"].append(self._session_response)
+                self._session = session
+            return self._session
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            active = self._transport.active if self._transport else 0
+            async_active = sum(state["transport"].active for state in self._async.values())
+        stats["pool_size"] = self.pool_size
+        stats["async_pool_size"] = self.async_pool_size
+        stats["http2"] = self.http2
+        stats["timeouts"] = {"connect": self.connect_timeout, "read": self.read_timeout}
+        stats["connections"] = {"active": active, "limit": self.pool_size}
+        stats["async_connections"] = {"active": async_active, "limit": self.async_pool_size}
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._http_client is not None:
+                self._http_client.close()
+            if self._session is not None:
+                self._session.close()
+            self._transport = None
+            self._http_client = None
+            self._session = None
+            self._clients = {}
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = UpstreamClientManager()
+    return _manager
+
+
+def get_client(api_key=None, base_url=GEMINI_BASE_URL, max_retries=None):
+    return get_manager().get_client(api_key=api_key, base_url=base_url, max_retries=max_retries)
+
+
+def get_async_client(api_key=None, base_url=GEMINI_BASE_URL, max_retries=None):
+    return get_manager().get_async_client(api_key=api_key, base_url=base_url, max_retries=max_retries)
+
+
+def get_http_session():
+    return get_manager().get_session()
+
+
+def upstream_stats():
+    return get_manager().stats()